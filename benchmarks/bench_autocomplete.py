@@ -0,0 +1,68 @@
+# /nah_vc のオートコンプリート候補生成の速さを測るベンチマーク。索引の構築時間と、クエリ毎の遅延を報告する。
+#   python benchmarks/bench_autocomplete.py --channels 5000
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+WORDS = ["general", "study", "work", "gaming", "music", "lounge", "meeting", "room", "voice", "chill", "team", "raid", "雑談", "作業", "勉強"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    import nekochanbot2 as nb
+    rng = random.Random(args.seed)
+    guild = harness.FakeGuild(1 << 22, harness.FakeHTTP())
+    nb.bot.get_guild = {guild.id: guild}.get
+    for i in range(args.channels):
+        guild.add_voice_channel(f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}")
+    names = [vc.name.lower() for vc in guild.voice_channels]
+
+    started = time.perf_counter()
+    nb.channel_index.rebuild_guild(guild)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(names)
+        kind = rng.random()
+        if kind < 0.4: queries.append(name[:rng.randint(1, len(name))]) # 入力途中の前方一致
+        elif kind < 0.7: start = rng.randrange(len(name) - 2); queries.append(name[start:start + rng.randint(3, 8)]) # 部分一致
+        else: queries.append("".join(c if rng.random() > 0.15 else rng.choice(string.ascii_lowercase) for c in name)) # 打ち間違い
+    latencies, empty = [], 0
+    for query in queries:
+        t = time.perf_counter()
+        suggestions = nb.channel_index.suggest_voice_channels(guild, query)
+        latencies.append(time.perf_counter() - t)
+        empty += not suggestions
+
+    linear = []
+    for query in queries[:200]: # 索引なしの線形走査(旧nah_vcと同じ比較)との比較用
+        t = time.perf_counter()
+        [vc for vc in guild.voice_channels if query.lower() in vc.name.lower()]
+        linear.append(time.perf_counter() - t)
+
+    print(f"channels={args.channels} queries={args.queries}")
+    print(f"  index build             {build_ms:10.1f} ms")
+    print(f"  suggest latency p50     {harness.percentile(latencies, 50) * 1000:10.3f} ms")
+    print(f"  suggest latency p99     {harness.percentile(latencies, 99) * 1000:10.3f} ms")
+    print(f"  suggest latency max     {max(latencies) * 1000:10.3f} ms")
+    print(f"  queries with no result  {empty:10d}")
+    print(f"  linear scan p50         {harness.percentile(linear, 50) * 1000:10.3f} ms  (substring only, no ranking)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# アクティブ/スタンバイ切り替えのベンチマーク。ネットワーク不要。
+#   python benchmarks/bench_failover.py --guilds 500 --tracked-per-guild 2
+# 1. プロセス内リースで、正常終了(リース解放)とクラッシュ(期限切れ待ち)それぞれの引き継ぎ時間と、2台同時アクティブの有無を測る
+# 2. スタンバイが偽Firestoreのスナップショットリスナーで追跡情報を追いかける時間と、昇格してから表示のずれが解消するまでの時間を測る
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+async def wait_until(predicate, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline: return False
+        await asyncio.sleep(0.002)
+    return True
+
+
+async def measure_takeover(nb, crash):
+    store = nb.MemoryLeaseStore()
+    old, new = nb.LeaderLease("bench", "old", enabled=True), nb.LeaderLease("bench", "new", enabled=True)
+    old.start(store)
+    await wait_until(lambda: old.active)
+    new.start(store)
+    await asyncio.sleep(nb.LEASE_POLL_INTERVAL_SECONDS * (2 + random.random())) # ポーリングの位相をずらす
+    overlap = [0]
+    async def sample():
+        while True:
+            if old.active and new.active: overlap[0] += 1
+            await asyncio.sleep(0.001)
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    if crash: old.task.cancel() # 解放せずに止まる
+    else: await old.release()
+    await wait_until(lambda: new.active)
+    elapsed = time.perf_counter() - started
+    sampler.cancel(); new.task.cancel()
+    return elapsed, overlap[0], new.epoch
+
+
+async def run(args):
+    import nekochanbot2 as nb
+    nb.LEASE_TTL_SECONDS = args.lease_ttl
+    nb.LEASE_RENEW_INTERVAL_SECONDS = args.lease_ttl / 3
+    nb.LEASE_SAFETY_MARGIN_SECONDS = args.lease_ttl / 5
+    nb.LEASE_POLL_INTERVAL_SECONDS = args.lease_poll
+    print(f"lease ttl={args.lease_ttl}s renew={nb.LEASE_RENEW_INTERVAL_SECONDS:.2f}s margin={nb.LEASE_SAFETY_MARGIN_SECONDS:.2f}s poll={args.lease_poll}s")
+    for crash in (False, True):
+        elapsed, overlap, epoch = await measure_takeover(nb, crash)
+        print(f"  takeover after {'crash   ' if crash else 'shutdown'}  {elapsed * 1000:10.0f} ms  (both active samples={overlap}, epoch={epoch})")
+
+    nb.REST_GLOBAL_RATE_PER_SECOND = args.rest_rate
+    nb.rest_dispatcher.tokens = args.rest_rate
+    http = harness.FakeHTTP()
+    world = harness.build_world(nb, guilds=args.guilds, channels_per_guild=args.tracked_per_guild + 4, members=args.members,
+                                tracked_per_guild=args.tracked_per_guild, summary_ratio=0.5, http=http, seed=args.seed)
+    world.install()
+    await nb.refresh_all_status_channels() # まだ単独構成なので表示を揃えておく
+    await harness.wait_for_idle(nb)
+
+    # ここからスタンバイ。Firestoreの内容だけを持ち、追跡情報はリスナーから受け取る
+    fake_db = harness.FakeFirestore()
+    fake_db.collections[nb.FIRESTORE_COLLECTION_NAME] = {str(k): dict(v) for k, v in nb.vc_tracking.items()}
+    fake_db.collections[nb.SUMMARY_FIRESTORE_COLLECTION_NAME] = {str(k): {"summary_vc_id": v} for k, v in nb.summary_vc_tracking.items()}
+    expected_vc, expected_summary = len(nb.vc_tracking), len(nb.summary_vc_tracking)
+    nb.vc_tracking.clear(); nb.summary_vc_tracking.clear(); nb.channel_index.rebuild_status_links(nb.vc_tracking)
+    nb.leader_lease.enabled, nb.leader_lease.held = True, False
+    started = time.perf_counter()
+    nb.tracking_mirror.start(fake_db)
+    await wait_until(lambda: len(nb.vc_tracking) == expected_vc and len(nb.summary_vc_tracking) == expected_summary)
+    initial_sync = time.perf_counter() - started
+
+    # アクティブ側が追跡を解除したものがリスナー経由で届くまでの時間
+    rng = random.Random(args.seed)
+    removed = rng.sample(sorted(nb.vc_tracking), min(args.changes, len(nb.vc_tracking)))
+    batch = fake_db.batch()
+    for cid in removed: batch.delete((nb.FIRESTORE_COLLECTION_NAME, str(cid)))
+    started = time.perf_counter()
+    await batch.commit()
+    await wait_until(lambda: not any(cid in nb.vc_tracking for cid in removed))
+    change_lag = time.perf_counter() - started
+    world.tracked = [t for t in world.tracked if t[1].id not in removed]
+
+    # スタンバイ中のボイスステート変化ではリネームしない
+    http.counts = {k: 0 for k in http.counts}
+    by_guild_channels = {g.id: [c for c in g.voice_channels if not c.category_id] for g in world.guilds.values()}
+    for i in range(args.events):
+        member = world.members[rng.randrange(len(world.members))]
+        before, after = world.move(member, rng.choice(by_guild_channels[member.guild.id]))
+        await nb.on_voice_state_update(member, before, after)
+        if i % 50 == 0: await asyncio.sleep(0)
+    await harness.wait_for_idle(nb)
+    standby_edits, stale_before = http.counts["edit"], len(world.stale_channels())
+
+    # 昇格: リースを取った時と同じ経路で追いつきリネームを走らせる
+    nb.leader_lease.held, nb.leader_lease.valid_until = True, time.monotonic() + 3600
+    started = time.perf_counter()
+    nb.handle_lease_change(True)
+    await wait_until(lambda: not world.stale_channels(), timeout=args.drain_timeout)
+    catch_up = time.perf_counter() - started
+
+    print(f"world: guilds={args.guilds} tracked={expected_vc} summaries={expected_summary} members={len(world.members)} rest_rate={args.rest_rate}/s")
+    print(f"  standby initial sync    {initial_sync * 1000:10.1f} ms  (snapshot listeners, {expected_vc + expected_summary} docs)")
+    print(f"  standby change lag      {change_lag * 1000:10.1f} ms  ({len(removed)} removals in one commit)")
+    print(f"  standby renames         {standby_edits:10d}  during {args.events} voice events")
+    print(f"  stale at takeover       {stale_before:10d}  channels")
+    print(f"  catch-up after takeover {catch_up * 1000:10.1f} ms  (left stale: {len(world.stale_channels())}, renames: {http.counts['edit']})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--tracked-per-guild", type=int, default=2)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--changes", type=int, default=100)
+    parser.add_argument("--lease-ttl", type=float, default=3.0)
+    parser.add_argument("--lease-poll", type=float, default=0.2)
+    parser.add_argument("--rest-rate", type=float, default=40.0, help="既定はボットの既定値と同じ")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# ログ出力のスループットとイベントループのブロック時間を、同期書き込み(従来)と非同期ライターで比較する。
+# 子プロセスのstdoutを、親プロセスがわざと遅く読むパイプにつないで遅いログドライバを再現する。
+#   python benchmarks/bench_logging.py --records 20000 --reader-delay 0.002
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def child_main(records, result_path):
+    import nekochanbot2 as nb
+    lags = []
+    done = asyncio.Event()
+
+    async def lag_monitor():
+        interval = 0.001
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - started - interval)
+
+    monitor = asyncio.create_task(lag_monitor())
+    await asyncio.sleep(0.05)
+    call_time = 0.0
+    started = time.perf_counter()
+    for i in range(records):
+        t = time.perf_counter()
+        nb.print_info("voice state update %d processed", i, guild_id=1234567890, channel_id=i)
+        nb.print_debug("debug line %d", i) # レベル判定で捨てられる
+        call_time += time.perf_counter() - t
+        if i % 100 == 0: await asyncio.sleep(0)
+    produce_elapsed = time.perf_counter() - started
+    done.set()
+    await monitor
+    nb.shutdown_log_writer(timeout=120)
+    total_elapsed = time.perf_counter() - started
+    with open(result_path, "w") as f:
+        json.dump({
+            "calls_per_sec": records / call_time if call_time else 0.0,
+            "produce_elapsed": produce_elapsed,
+            "total_elapsed": total_elapsed,
+            "lag_p99_ms": percentile(lags, 99) * 1000,
+            "lag_max_ms": max(lags) * 1000 if lags else 0.0,
+        }, f)
+
+
+def run_mode(async_writer, args, tmp):
+    result_path = os.path.join(tmp, f"result_{async_writer}.json")
+    env = dict(os.environ, LOG_ASYNC_WRITER="true" if async_writer else "false", LOG_LEVEL_PRINT="INFO", LOG_FORMAT=args.format)
+    proc = subprocess.Popen([sys.executable, __file__, "--child", "--records", str(args.records), "--result", result_path],
+                            stdout=subprocess.PIPE, env=env)
+    while proc.stdout.read(args.chunk):
+        time.sleep(args.reader_delay)
+    proc.wait()
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--reader-delay", type=float, default=0.002, help="親プロセスが1チャンク読むごとに待つ秒数")
+    parser.add_argument("--chunk", type=int, default=4096)
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    parser.add_argument("--child", action="store_true")
+    parser.add_argument("--result")
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(child_main(args.records, args.result)); return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {"sync (before)": run_mode(False, args, tmp), "async writer": run_mode(True, args, tmp)}
+    print(f"records={args.records} format={args.format} reader_delay={args.reader_delay}s/{args.chunk}B")
+    for mode, r in results.items():
+        print(f"  {mode:<14s} calls/s={r['calls_per_sec']:>10.0f}  loop lag p99={r['lag_p99_ms']:7.2f}ms max={r['lag_max_ms']:8.2f}ms  "
+              f"produce={r['produce_elapsed']:.2f}s drained={r['total_elapsed']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# discord.py の本物の Guild / ConnectionState に合成GUILD_CREATEとMESSAGE_CREATEを流し込み、
+# 省メモリモードのオン/オフでRSSとキャッシュ件数を比べる。VC人数の集計結果が変わらないことも確認する。
+#   python benchmarks/bench_member_cache.py --members 100000 --guilds 10
+# 比較用に、members特権Intentを有効にした場合の既定キャッシュ (全メンバーをキャッシュ) も測る。
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PROFILES = ("default", "low-memory", "members-intent")
+CHANNELS_PER_GUILD = 20
+
+
+def guild_payload(guild_id, members, voice_members, first_member_id):
+    channels = [{"id": str(guild_id + 1 + i), "type": 2, "name": f"VC {i}", "position": i, "permission_overwrites": [],
+                 "bitrate": 64000, "user_limit": 0} for i in range(CHANNELS_PER_GUILD)]
+    channels.append({"id": str(guild_id + 100), "type": 0, "name": "general", "position": 0, "permission_overwrites": []})
+    member_payloads = [{"user": {"id": str(first_member_id + i), "username": f"user{i}", "discriminator": "0", "avatar": None, "global_name": None},
+                        "roles": [], "joined_at": "2020-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0} for i in range(members)]
+    voice_states = [{"user_id": str(first_member_id + i), "channel_id": channels[i % CHANNELS_PER_GUILD]["id"], "session_id": "s",
+                     "deaf": False, "mute": False, "self_deaf": False, "self_mute": False, "self_video": False, "suppress": False}
+                    for i in range(voice_members)]
+    return {"id": str(guild_id), "name": f"guild-{guild_id}", "member_count": members, "members": member_payloads,
+            "voice_states": voice_states, "channels": channels, "emojis": [], "stickers": [], "features": [],
+            "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+                       "hoist": False, "managed": False, "mentionable": False}]}
+
+
+def message_payload(guild_id, message_id, author_id):
+    return {"id": str(message_id), "channel_id": str(guild_id + 100), "guild_id": str(guild_id), "content": "spam " * 20,
+            "author": {"id": str(author_id), "username": "user", "discriminator": "0", "avatar": None, "global_name": None},
+            "member": {"roles": [], "joined_at": "2020-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0},
+            "timestamp": "2024-01-01T00:00:00+00:00", "edited_timestamp": None, "tts": False, "mention_everyone": False,
+            "mentions": [], "mention_roles": [], "attachments": [], "embeds": [], "pinned": False, "type": 0}
+
+
+def child(profile, guilds, members, voice_ratio, messages):
+    import discord
+    import harness
+    import nekochanbot2 as nb
+    if profile == "members-intent":
+        intents = nb.build_intents(False); intents.members = True
+        options = {}
+    else:
+        low_memory = profile == "low-memory"
+        intents, options = nb.build_intents(low_memory), nb.build_cache_options(low_memory)
+    client = discord.Client(intents=intents, **options)
+    state = client._connection
+    gc.collect()
+    rss_before = harness.rss_mb()
+    per_guild = members // guilds
+    voice_per_guild = int(per_guild * voice_ratio)
+    for g in range(guilds):
+        guild_id = (g + 1) << 22
+        guild = discord.Guild(data=guild_payload(guild_id, per_guild, voice_per_guild, 10**15 + g * per_guild), state=state)
+        state._add_guild(guild)
+        for m in range(messages // guilds):
+            state.parse_message_create(message_payload(guild_id, 10**17 + g * 10**6 + m, 10**15 + g * per_guild + m % per_guild))
+    gc.collect()
+    rss_after = harness.rss_mb()
+    cached_members = sum(len(g.members) for g in state.guilds)
+    occupancy = sum(len([m for m in vc.members if not m.bot]) for g in state.guilds for vc in g.voice_channels)
+    print(json.dumps({"rss_delta_mb": rss_after - rss_before, "cached_members": cached_members, "cached_messages": len(state._messages or ()),
+                      "occupancy": occupancy, "expected_occupancy": voice_per_guild * guilds}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--members", type=int, default=50000)
+    parser.add_argument("--voice-ratio", type=float, default=0.02)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--child", choices=PROFILES)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.guilds, args.members, args.voice_ratio, args.messages); return
+
+    print(f"guilds={args.guilds} members={args.members} voice_ratio={args.voice_ratio} messages={args.messages}")
+    for profile in PROFILES:
+        out = subprocess.run([sys.executable, __file__, "--child", profile, "--guilds", str(args.guilds), "--members", str(args.members),
+                              "--voice-ratio", str(args.voice_ratio), "--messages", str(args.messages)],
+                             capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        per_10k = r["rss_delta_mb"] / args.members * 10000
+        ok = "ok" if r["occupancy"] == r["expected_occupancy"] else f"MISMATCH (expected {r['expected_occupancy']})"
+        print(f"  {profile:<15s} RSS/10k members={per_10k:7.2f} MB  cached members={r['cached_members']:>7d}  "
+              f"cached messages={r['cached_messages']:>5d}  occupancy={r['occupancy']} {ok}")
+
+
+if __name__ == "__main__":
+    main()
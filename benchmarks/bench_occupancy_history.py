@@ -0,0 +1,97 @@
+# 人数履歴ストアのメモリ/永続化サイズとクエリ速度を測るベンチマーク。合成時刻で数日分の入退室を流し込む。
+#   python benchmarks/bench_occupancy_history.py --channels 2000 --days 30
+# 報告: 系列あたりのメモリ, 圧縮後のFirestoreドキュメントサイズ, チャンネル・日あたりのバイト数, 記録/クエリの遅延,
+#       1系列について全イベントから求めた正解との最大/平均の比較
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+def brute_force(events, now, window):
+    # events: [(t, value)] の時刻順。区間 [now-window, now) の最大と時間加重平均
+    start = now - window
+    peak, area, value, last = 0, 0, 0, start
+    for t, v in events:
+        if t >= now: break
+        if t > start:
+            area += value * (t - last); last = t
+            peak = max(peak, v)
+        elif t <= start: value = v; continue
+        value = v
+    area += value * (now - last)
+    return max(peak, value), area / window
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--events-per-channel-day", type=int, default=40)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    import nekochanbot2 as nb
+    rng = random.Random(args.seed)
+    start = 1_700_000_000
+    end = start + args.days * 86400
+    history = nb.OccupancyHistory()
+    rss_before = harness.rss_mb()
+
+    # 全チャンネルのイベントを時刻順にまとめて流す (実運用と同じく系列を跨いで時刻が進む)
+    schedule = []
+    for cid in range(args.channels):
+        for _ in range(args.days * args.events_per_channel_day):
+            schedule.append((rng.randrange(start, end), cid))
+    schedule.sort()
+    values = [0] * args.channels
+    truth = []
+    record_started = time.perf_counter()
+    for t, cid in schedule:
+        values[cid] = max(0, values[cid] + (1 if values[cid] == 0 or rng.random() < 0.5 else -1))
+        history.record(("vc", cid), 1, values[cid], now=t)
+        if cid == 0: truth.append((t, values[cid]))
+    record_elapsed = time.perf_counter() - record_started
+    rss_after = harness.rss_mb()
+
+    series_bytes = history.nbytes() / len(history.series)
+    docs = [series.encode() for series in history.series.values()]
+    doc_bytes = sum(len(doc["data"]) + 64 for doc in docs) / len(docs) # 64はフィールド名などのおおよその上乗せ
+    retained_days = min(args.days, max(size * slots for size, slots in nb.HISTORY_LEVELS) / 86400)
+
+    windows = [3600, 86400, 7 * 86400, 30 * 86400]
+    latencies = []
+    keys = list(history.series)
+    for i in range(args.queries):
+        t = time.perf_counter()
+        history.summarize(keys[i % len(keys)], windows[i % len(windows)], now=end)
+        latencies.append(time.perf_counter() - t)
+
+    decoded = nb.OccupancySeries.decode(history.series[("vc", 0)].encode())
+    roundtrip_ok = decoded is not None and decoded.summarize(end, 86400) == history.summarize(("vc", 0), 86400, now=end)
+
+    print(f"channels={args.channels} days={args.days} events={len(schedule)}")
+    print(f"  record throughput       {len(schedule) / record_elapsed:12.0f} events/s")
+    print(f"  memory per series       {series_bytes:12.0f} B  (arrays only; RSS grew {rss_after - rss_before:.1f} MB incl. event schedule)")
+    print(f"  persisted doc per series{doc_bytes:12.0f} B  (zlib)")
+    print(f"  bytes per channel-day   {doc_bytes / retained_days:12.1f} B persisted, {series_bytes / retained_days:.1f} B in memory")
+    print(f"  query latency p50       {harness.percentile(latencies, 50) * 1e6:12.1f} us")
+    print(f"  query latency p99       {harness.percentile(latencies, 99) * 1e6:12.1f} us")
+    print(f"  encode/decode roundtrip {'ok' if roundtrip_ok else 'MISMATCH':>12s}")
+    for window in windows:
+        if window > args.days * 86400: continue
+        got = history.summarize(("vc", 0), window, now=end)
+        want = brute_force(truth, end, window)
+        print(f"  window {window // 3600:>4d}h   peak {got[0]:>3d} (exact {want[0]:>3d})  avg {got[1]:7.3f} (exact {want[1]:7.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# 孤立した追跡情報の掃除を測るベンチマーク。追跡VCの一部をオフライン中に消えた想定でキャッシュから消し、
+# 巡回1回あたりのCPU時間(=イベントループを止める時間。実時間には人数表示用VC削除のREST待ちが含まれる)、掃除前後の定期更新1周の時間、Firestoreのバッチ数を報告する。
+#   python benchmarks/bench_orphan_sweep.py --guilds 2000 --tracked-per-guild 5 --orphan-ratio 0.3
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+async def run(args):
+    import nekochanbot2 as nb
+    nb.ORPHAN_SWEEP_SLICE = args.slice
+    fake_db = harness.FakeFirestore()
+    nb.db = fake_db
+    world = harness.build_world(nb, guilds=args.guilds, channels_per_guild=args.tracked_per_guild + 2, members=0,
+                                tracked_per_guild=args.tracked_per_guild, summary_ratio=0.5, seed=args.seed)
+    world.install()
+    rng = random.Random(args.seed)
+    orphans = 0
+    for guild, original_vc, status_vc in world.tracked:
+        if rng.random() < args.orphan_ratio:
+            guild.remove_channel(rng.choice([original_vc.id, status_vc.id])); orphans += 1
+    left_guilds = [g for g in world.guilds.values() if rng.random() < args.left_guild_ratio]
+    for guild in left_guilds: world.guilds.pop(guild.id) # オフライン中にサーバーから外れた
+    tracked_before = len(nb.vc_tracking) + len(nb.summary_vc_tracking)
+
+    started = time.perf_counter()
+    await nb.refresh_all_status_channels()
+    cycle_before = time.perf_counter() - started
+
+    step_times, step_walls, passes = [], [], 0
+    for now in (0, nb.ORPHAN_GRACE_SECONDS + 1): # 1周目で保留、猶予後の2周目で削除
+        while True:
+            t, w = time.process_time(), time.perf_counter()
+            await nb.orphan_sweeper.step(now=now)
+            step_times.append(time.process_time() - t); step_walls.append(time.perf_counter() - w)
+            if nb.orphan_sweeper.pass_started is None: break
+        passes += 1
+    await nb.firestore_writer.flush()
+    tracked_after = len(nb.vc_tracking) + len(nb.summary_vc_tracking)
+
+    started = time.perf_counter()
+    await nb.refresh_all_status_channels()
+    cycle_after = time.perf_counter() - started
+
+    print(f"guilds={args.guilds} tracked={tracked_before} orphaned channels={orphans} left guilds={len(left_guilds)} slice={args.slice}")
+    print(f"  entries removed         {tracked_before - tracked_after:10d}  (last pass {nb.orphan_sweeper.last_pass})")
+    print(f"  sweep steps             {len(step_times):10d}  over {passes} passes")
+    print(f"  step CPU time p50       {harness.percentile(step_times, 50) * 1000:10.2f} ms")
+    print(f"  step CPU time max       {max(step_times) * 1000:10.2f} ms")
+    print(f"  step wall time max      {max(step_walls) * 1000:10.2f} ms  (REST待ちを含む)")
+    print(f"  periodic cycle before   {cycle_before * 1000:10.1f} ms")
+    print(f"  periodic cycle after    {cycle_after * 1000:10.1f} ms  {nb.last_status_cycle_stats}")
+    print(f"  Firestore batch commits {fake_db.commits:10d}  (FIRESTORE_BATCH_MAX_OPS={nb.FIRESTORE_BATCH_MAX_OPS})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--tracked-per-guild", type=int, default=5)
+    parser.add_argument("--orphan-ratio", type=float, default=0.3)
+    parser.add_argument("--left-guild-ratio", type=float, default=0.05)
+    parser.add_argument("--slice", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# プロファイリングのオーバーヘッドを測るベンチマーク。ネットワーク不要。
+#   python benchmarks/bench_profiling.py --events 20000
+# 無効 / 有効 / 有効+スタックサンプリング中 の3通りで同じボイスステート嵐を流し、ハンドラのスループットを比べる。
+# 最後にわざとイベントループを止めるコールバックを入れ、遅いコールバックとして検出されるか、保存したプロファイルに現れるかを確認する。
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+async def storm(nb, world, events, seed):
+    rng = random.Random(seed)
+    by_guild_channels = {g.id: [c for c in g.voice_channels if not c.category_id] for g in world.guilds.values()}
+    started = time.perf_counter()
+    for i in range(events):
+        member = world.members[rng.randrange(len(world.members))]
+        target = None if (member.voice_channel and rng.random() < 0.3) else rng.choice(by_guild_channels[member.guild.id])
+        before, after = world.move(member, target)
+        await nb.on_voice_state_update(member, before, after)
+        if i % 50 == 0: await asyncio.sleep(0)
+    await harness.wait_for_idle(nb)
+    return events / (time.perf_counter() - started)
+
+
+def block_event_loop(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline: pass
+
+
+async def run(args):
+    import nekochanbot2 as nb
+    nb.PROFILE_DUMP_DIR = tempfile.mkdtemp(prefix="nekochan-profile-")
+    nb.RENAME_BUCKET_WINDOW = nb.timedelta(seconds=0.5)
+    for scheduler in (nb.vc_rename_scheduler, nb.summary_vc_rename_scheduler):
+        scheduler.refill_rate = nb.RENAME_BUCKET_CAPACITY / 0.5
+    nb.REST_GLOBAL_RATE_PER_SECOND = nb.rest_dispatcher.tokens = 100000.0
+    world = harness.build_world(nb, guilds=args.guilds, channels_per_guild=10, members=args.members, tracked_per_guild=2, summary_ratio=0.5, seed=args.seed)
+    world.install()
+    await nb.refresh_all_status_channels()
+    await harness.wait_for_idle(nb)
+
+    await storm(nb, world, args.events, args.seed) # 最初の嵐は全員がVC外から始まるので測定から外す
+    results = {}
+    for round_ in range(args.rounds): # 順番の影響を避けるため順序を回しながら何度か測り、中央値を取る
+        modes = ("off", "on", "on+sampling")
+        for mode in modes[round_ % 3:] + modes[:round_ % 3]:
+            if mode == "off": nb.runtime_profiler.disable()
+            else: nb.runtime_profiler.enable()
+            sampler = None
+            if mode == "on+sampling":
+                sampler = nb.StackSampler(__import__("threading").get_ident(), duration=3600)
+                sampler.start()
+            rate = await storm(nb, world, args.events, args.seed + round_)
+            if sampler: sampler.stop_event.set(); sampler.join()
+            results.setdefault(mode, []).append(rate)
+    results = {mode: statistics.median(rates) for mode, rates in results.items()}
+
+    nb.runtime_profiler.enable()
+    capture = asyncio.create_task(nb.runtime_profiler.capture(1.0))
+    await asyncio.sleep(0.2)
+    asyncio.get_running_loop().call_soon(block_event_loop, 0.3)
+    path, samples = await capture
+    with open(path, encoding="utf-8") as f:
+        blocked_samples = sum(int(line.rsplit(" ", 1)[1]) for line in f if "block_event_loop" in line)
+    handler_stats = {dict(labels)["handler"]: h for (name, labels), h in nb.metrics.histograms.items() if name == "nekochan_handler_seconds"}
+
+    print(f"world: guilds={args.guilds} members={args.members} events/round={args.events} rounds={args.rounds}")
+    for mode, rate in results.items():
+        print(f"  {mode:<12} {rate:10.0f} events/s  overhead {100 * (1 - rate / results['off']):5.1f}%")
+    print(f"  slow callbacks detected {nb.runtime_profiler.slow_callback_count}  last: {list(nb.runtime_profiler.slow_callbacks)[-1][2] if nb.runtime_profiler.slow_callbacks else '-'}")
+    print(f"  profile dump            {samples} samples, {blocked_samples} in block_event_loop -> {path}")
+    for handler, h in sorted(handler_stats.items(), key=lambda item: -item[1].count)[:5]:
+        print(f"  {handler:<40} p50 {h.quantile(0.5) * 1e6:8.0f} us  p99 {h.quantile(0.99) * 1e6:8.0f} us  n={h.count}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=300)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# !!nah の一括削除エンジンのスループットを測るベンチマーク。偽チャンネルにメッセージを積み、削除完了までの時間を報告する。
+#   python benchmarks/bench_purge.py --messages 5000 --channels 3 --old-ratio 0.01 --rest-latency 0.05
+# 報告: messages/sec, bulk_delete/1件削除/履歴取得の回数, 取りこぼし(条件に合うのに残ったメッセージ)
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+async def run(args):
+    import nekochanbot2 as nb
+    nb.PURGE_OLD_DELETE_RATE_PER_SECOND = args.old_rate
+    nb.REST_GLOBAL_RATE_PER_SECOND = args.rest_rate
+    nb.rest_dispatcher.tokens = args.rest_rate
+    rng = random.Random(args.seed)
+    http = harness.FakeHTTP(latency=args.rest_latency)
+    guild = harness.FakeGuild(1 << 22, http)
+    channels = [guild.add_text_channel(f"spam-{i}") for i in range(args.channels)]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    spammer, others = 1, [2, 3, 4]
+    for i in range(args.messages):
+        channel = channels[i % len(channels)]
+        old = rng.random() < args.old_ratio
+        created_at = now - (datetime.timedelta(days=20, seconds=rng.random() * 86400) if old else datetime.timedelta(seconds=rng.random() * 86400))
+        is_spam = rng.random() < args.spam_ratio
+        channel.add_message(created_at, spammer if is_spam else rng.choice(others), "buy now http://spam" if is_spam else "hello")
+
+    job = nb.PurgeJob(channels, args.limit or args.messages, author_id=spammer if args.filter else None,
+                      contains="http" if args.filter else None)
+    expected = sum(1 for c in channels for m in c.messages.values() if job.matches(m))
+    started = time.perf_counter()
+    await job.run()
+    elapsed = time.perf_counter() - started
+    leftover = sum(1 for c in channels for m in c.messages.values() if job.matches(m))
+
+    print(f"messages={args.messages} channels={args.channels} old_ratio={args.old_ratio} filter={'on' if args.filter else 'off'} "
+          f"rest_latency={args.rest_latency}s old_rate={args.old_rate}/s")
+    print(f"  matched                 {expected:10d}")
+    print(f"  deleted                 {job.deleted:10d}  (failed {job.failed})")
+    print(f"  elapsed                 {elapsed:10.2f} s")
+    print(f"  messages/sec            {job.deleted / elapsed:10.1f}")
+    print(f"  REST calls              {dict(http.counts)}")
+    print(f"  left undeleted          {leftover:10d}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--old-ratio", type=float, default=0.005, help="14日より古いメッセージの割合")
+    parser.add_argument("--spam-ratio", type=float, default=0.7)
+    parser.add_argument("--filter", action="store_true", help="荒らしユーザー+http を含むメッセージだけを対象にする")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--rest-latency", type=float, default=0.05)
+    parser.add_argument("--rest-rate", type=float, default=40.0)
+    parser.add_argument("--old-rate", type=float, default=20.0, help="古いメッセージの1件削除の毎秒上限 (本番既定は1.0)")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
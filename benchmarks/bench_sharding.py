@@ -0,0 +1,40 @@
+# 同じ合成ワールドとイベント総数を、シャード毎の別プロセスに分けて流し、合計スループットを比べる。
+# 各プロセスは bench_voice_storm.py --shard-count N --shard-id k で、自分の担当サーバーの分だけを処理する。
+#   python benchmarks/bench_sharding.py --processes 1 2 4 -- --guilds 2000 --members 40000 --events 40000
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+STORM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_voice_storm.py")
+
+
+def run(processes, storm_args):
+    started = time.perf_counter()
+    procs = []
+    for shard_id in range(processes):
+        shard_args = ["--shard-count", str(processes), "--shard-id", str(shard_id)] if processes > 1 else []
+        procs.append(subprocess.Popen([sys.executable, STORM, *storm_args, *shard_args], stdout=subprocess.PIPE, text=True))
+    outputs = [p.communicate()[0] for p in procs]
+    wall = time.perf_counter() - started
+    rates = [float(re.search(r"handled events/sec\s+([\d.]+)", out).group(1)) for out in outputs]
+    return wall, rates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("storm_args", nargs=argparse.REMAINDER, help="-- の後ろは bench_voice_storm.py にそのまま渡す")
+    args = parser.parse_args()
+    storm_args = [a for a in args.storm_args if a != "--"]
+    print(f"cpus={os.cpu_count()} storm_args={' '.join(storm_args) or '(defaults)'}")
+    for processes in args.processes:
+        wall, rates = run(processes, storm_args)
+        print(f"  processes={processes:<3d} aggregate handled events/sec={sum(rates):10.0f}  "
+              f"per-shard={[round(r) for r in rates]}  wall={wall:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
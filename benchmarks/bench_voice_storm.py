@@ -0,0 +1,111 @@
+# 合成ボイスステート嵐を本物のハンドラに流し込み、処理性能を測るベンチマーク。ネットワーク不要。
+#   python benchmarks/bench_voice_storm.py                                   # 小さめの既定値
+#   python benchmarks/bench_voice_storm.py --guilds 10000 --members 100000 --events 60000 --rate 1000
+# 報告: events/sec, イベントあたりのREST呼び出し数, 取りこぼし(最終的に古いままの名前), ハンドラ遅延p50/p99, RSS, 定期更新1周の時間
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+async def run(args):
+    import nekochanbot2 as nb
+    if args.shard_count:
+        nb.SHARD_COUNT, nb.SHARDED_MODE = args.shard_count, True
+        nb.SHARD_IDS = frozenset([args.shard_id])
+    # Discordのリネーム制限(10分2回)のままだと終わらないので窓を縮める
+    nb.RENAME_BUCKET_WINDOW = nb.timedelta(seconds=args.rename_window)
+    for scheduler in (nb.vc_rename_scheduler, nb.summary_vc_rename_scheduler):
+        scheduler.refill_rate = nb.RENAME_BUCKET_CAPACITY / args.rename_window
+    nb.REST_GLOBAL_RATE_PER_SECOND = args.rest_rate
+    nb.rest_dispatcher.tokens = args.rest_rate
+
+    rss_before = harness.rss_mb()
+    build_started = time.perf_counter()
+    http = harness.FakeHTTP(latency=args.rest_latency)
+    world = harness.build_world(nb, guilds=args.guilds, channels_per_guild=args.channels_per_guild, members=args.members,
+                                tracked_per_guild=args.tracked_per_guild, summary_ratio=args.summary_ratio, http=http, seed=args.seed)
+    world.install()
+    events = args.events // args.shard_count if args.shard_count else args.events
+    build_elapsed = time.perf_counter() - build_started
+    rss_world = harness.rss_mb()
+
+    # 最初の定期更新で全チャンネルの表示を揃え、HTTP記録をリセットしてから嵐を流す
+    await nb.refresh_all_status_channels()
+    await harness.wait_for_idle(nb, timeout=args.drain_timeout)
+    http.counts = {k: 0 for k in http.counts}; http.calls.clear()
+
+    rng = random.Random(args.seed)
+    by_guild_channels = {g.id: [c for c in g.voice_channels if not c.category_id] for g in world.guilds.values()}
+    latencies = []
+    interval = 1.0 / args.rate if args.rate else 0.0
+    storm_started = time.perf_counter()
+    for i in range(events):
+        member = world.members[rng.randrange(len(world.members))]
+        channels = by_guild_channels[member.guild.id]
+        target = None if (member.voice_channel and rng.random() < args.leave_ratio) else channels[rng.randrange(len(channels))]
+        before, after = world.move(member, target)
+        t = time.perf_counter()
+        await nb.on_voice_state_update(member, before, after)
+        latencies.append(time.perf_counter() - t)
+        if interval:
+            lag = storm_started + (i + 1) * interval - time.perf_counter()
+            await asyncio.sleep(max(0.0, lag))
+        elif i % 50 == 0:
+            await asyncio.sleep(0)
+    storm_elapsed = time.perf_counter() - storm_started
+    drained = await harness.wait_for_idle(nb, timeout=args.drain_timeout)
+    total_elapsed = time.perf_counter() - storm_started
+    rest_calls = http.total()
+    stale_after_events = len(world.stale_channels())
+
+    cycle_started = time.perf_counter()
+    await nb.refresh_all_status_channels()
+    cycle_elapsed = time.perf_counter() - cycle_started
+    await harness.wait_for_idle(nb, timeout=args.drain_timeout)
+
+    print(f"shard: {nb.shard_label()} (owned guilds={len(world.guilds)})")
+    print(f"world: guilds={args.guilds} channels/guild={args.channels_per_guild} members={args.members} "
+          f"tracked={len(world.tracked)} summaries={len(world.summaries)} (built in {build_elapsed:.2f}s)")
+    print(f"events={events} target_rate={args.rate or 'max'}/s rename_window={args.rename_window}s rest_rate={args.rest_rate}/s")
+    print(f"  handled events/sec      {events / storm_elapsed:12.0f}")
+    print(f"  events/sec incl. drain  {events / total_elapsed:12.0f}  (drained={'yes' if drained else 'NO'})")
+    print(f"  REST calls/event        {rest_calls / events:12.4f}  {dict(http.counts)}")
+    print(f"  dropped updates         {stale_after_events:12d}  (status channels left stale after drain)")
+    print(f"  handler latency p50     {harness.percentile(latencies, 50) * 1e6:12.1f} us")
+    print(f"  handler latency p99     {harness.percentile(latencies, 99) * 1e6:12.1f} us")
+    print(f"  periodic cycle          {cycle_elapsed * 1000:12.1f} ms  {nb.last_status_cycle_stats}")
+    print(f"  RSS                     {harness.rss_mb():12.1f} MB  (start {rss_before:.1f}, world {rss_world:.1f}, peak {harness.peak_rss_mb():.1f})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--channels-per-guild", type=int, default=10)
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--tracked-per-guild", type=int, default=2)
+    parser.add_argument("--summary-ratio", type=float, default=0.5)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=0, help="1秒あたりのイベント数。0なら最大速度")
+    parser.add_argument("--leave-ratio", type=float, default=0.3)
+    parser.add_argument("--rename-window", type=float, default=0.5, help="リネーム用トークンバケットの窓(秒)")
+    parser.add_argument("--rest-rate", type=float, default=100000.0)
+    parser.add_argument("--rest-latency", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--shard-count", type=int, default=0, help="0ならシャーディングなし。指定時は --shard-id のサーバーだけを担当し、イベント数も1/shard_countになる")
+    parser.add_argument("--shard-id", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+    os._exit(0) # 起動したままのバックグラウンドタスクを待たずに終了する
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# 起動から最初のリネームまでの時間を、スナップショットあり/なしで計測するベンチマーク。
+# Discord/Firestoreには接続せず、harness の偽ギルドと遅延付きの偽Firestoreを使う。
+#   python benchmarks/bench_warm_start.py --channels 2000 --firestore-latency 3.0
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "WARNING")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness
+
+
+def build_world(nb, channel_count):
+    world = harness.build_world(nb, guilds=1, channels_per_guild=channel_count, members=channel_count,
+                                tracked_per_guild=channel_count, summary_ratio=0.0, bot_ratio=0.0)
+    for member, (guild, original_vc, status_vc) in zip(world.members, world.tracked):
+        world.move(member, original_vc)
+    entries = {o.id: {"guild_id": g.id, "status_channel_id": s.id, "original_channel_name": o.name} for g, o, s in world.tracked}
+    return world, entries
+
+
+async def run_once(mode, channel_count, latency, snapshot_path):
+    import nekochanbot2 as nb
+    nb.STATE_SNAPSHOT_PATH = snapshot_path if mode == "snapshot" else ""
+    world, entries = build_world(nb, channel_count)
+    fake_db = harness.FakeFirestore(latency)
+    fake_db.collections[nb.FIRESTORE_COLLECTION_NAME] = {str(k): v for k, v in entries.items()}
+    if mode == "snapshot":
+        nb._write_state_snapshot(snapshot_path, entries, {}, {})
+
+    async def fake_init_firestore():
+        await asyncio.sleep(latency)
+        nb.db = fake_db
+        return True
+    nb.init_firestore = fake_init_firestore
+    nb.bot.get_guild = world.guilds.get
+
+    nb.startup_metrics["started_at"] = time.monotonic()
+    await nb.start_tracking_services()
+    while nb.startup_metrics["first_rename_after"] is None:
+        await asyncio.sleep(0.005)
+    return nb.startup_metrics["first_rename_after"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=500)
+    parser.add_argument("--firestore-latency", type=float, default=2.0, help="Firestore呼び出し1回あたりの遅延(秒)")
+    parser.add_argument("--child", choices=["snapshot", "cold"])
+    parser.add_argument("--snapshot-path")
+    args = parser.parse_args()
+
+    if args.child:
+        elapsed = asyncio.run(run_once(args.child, args.channels, args.firestore_latency, args.snapshot_path))
+        print(json.dumps({"mode": args.child, "first_rename_after": elapsed}))
+        os._exit(0) # 動き続けるtasks.loopを待たずに終了する
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("cold", "snapshot"):
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--channels", str(args.channels),
+                 "--firestore-latency", str(args.firestore_latency), "--snapshot-path", os.path.join(tmp, "state.sqlite3")],
+                capture_output=True, text=True, check=True,
+            )
+            results[mode] = json.loads(out.stdout.strip().splitlines()[-1])["first_rename_after"]
+    print(f"channels={args.channels} firestore_latency={args.firestore_latency}s")
+    for mode, elapsed in results.items():
+        print(f"  {mode:<9s} first rename after {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+# オフラインでボットのハンドラを動かすための偽Discord/Firestoreオブジェクトと計測ユーティリティ。
+# 偽チャンネルは discord.VoiceChannel のサブクラスなので、ハンドラ内の isinstance 判定もそのまま通る。
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import discord
+
+
+# --- Fake HTTP layer ---
+# --- 偽HTTP層: edit/create/delete呼び出しを記録する ---
+class FakeHTTP:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = [] # (kind, channel_id, detail)
+        self.counts = {"edit": 0, "create": 0, "delete": 0, "history": 0, "bulk_delete": 0, "message_delete": 0}
+
+    async def record(self, kind, channel_id, detail=None):
+        self.counts[kind] += 1
+        self.calls.append((kind, channel_id, detail))
+        if self.latency: await asyncio.sleep(self.latency)
+
+    def total(self): return sum(self.counts.values())
+
+
+# --- Fake Discord objects ---
+# --- 偽Discordオブジェクト ---
+class FakeMember:
+    def __init__(self, member_id, guild, bot=False):
+        self.id = member_id
+        self.guild = guild
+        self.bot = bot
+        self.voice_channel = None
+
+
+class FakeVoiceState:
+    def __init__(self, channel): self.channel = channel
+
+
+class FakeCategory(discord.CategoryChannel):
+    def __init__(self, category_id, guild, name):
+        self.id = category_id
+        self.guild = guild
+        self.name = name
+        self.position = 0
+
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    def __init__(self, channel_id, guild, name, category=None):
+        self.id = channel_id
+        self.guild = guild
+        self.name = name
+        self.position = 0
+        self.category_id = category.id if category else None
+        self.fake_members = []
+
+    @property
+    def members(self): return list(self.fake_members)
+
+    @property
+    def category(self): return self.guild.get_channel(self.category_id) if self.category_id else None
+
+    async def edit(self, *, name=None, reason=None):
+        await self.guild.http.record("edit", self.id, name)
+        if name is not None: self.name = name
+        return self
+
+    async def delete(self, *, reason=None):
+        await self.guild.http.record("delete", self.id)
+        self.guild.remove_channel(self.id)
+
+
+class FakeAuthor:
+    def __init__(self, author_id): self.id = author_id
+
+
+class FakeMessage:
+    def __init__(self, channel, created_at, author, content, sequence=0):
+        self.id = discord.utils.time_snowflake(created_at) + sequence % 4096 # 同じミリ秒内でも一意になるようにする
+        self.channel = channel
+        self.created_at = created_at
+        self.author = author
+        self.content = content
+
+    async def delete(self):
+        await self.channel.guild.http.record("message_delete", self.channel.id)
+        if self.channel.messages.pop(self.id, None) is None: raise discord.NotFound(FakeResponse(404), "Unknown Message")
+
+
+class FakeResponse:
+    def __init__(self, status): self.status = status; self.reason = "fake"
+
+
+class FakeTextChannel:
+    # history は100件ずつのページ取得を模し、ページ毎にHTTP記録と遅延を入れる
+    def __init__(self, channel_id, guild, name):
+        self.id = channel_id
+        self.guild = guild
+        self.name = name
+        self.messages = {} # message_id -> FakeMessage (idはスノーフレークなので時刻順)
+
+    def add_message(self, created_at, author_id, content):
+        message = FakeMessage(self, created_at, FakeAuthor(author_id), content, len(self.messages))
+        self.messages[message.id] = message
+        return message
+
+    async def history(self, limit=None, before=None, after=None, oldest_first=False):
+        def bound(value, default):
+            if value is None: return default
+            return discord.utils.time_snowflake(value) if isinstance(value, datetime.datetime) else value.id
+        low, high = bound(after, -1), bound(before, 1 << 64)
+        ids = sorted((mid for mid in self.messages if low < mid < high), reverse=not oldest_first)[:limit]
+        for page_start in range(0, len(ids), 100):
+            await self.guild.http.record("history", self.id)
+            for mid in ids[page_start:page_start + 100]:
+                message = self.messages.get(mid)
+                if message: yield message
+
+    async def delete_messages(self, messages, *, reason=None):
+        messages = list(messages)
+        if len(messages) > 100: raise ValueError("bulk_deleteは100件まで")
+        await self.guild.http.record("bulk_delete", self.id, len(messages))
+        for message in messages: self.messages.pop(message.id, None)
+
+
+_channel_ids = itertools.count(10**15)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, http, shard_id=0):
+        self.id = guild_id
+        self.http = http
+        self.shard_id = shard_id
+        self.unavailable = False
+        self.name = f"guild-{guild_id}"
+        self.default_role = object()
+        self.channels_by_id = {}
+
+    @property
+    def voice_channels(self): return [c for c in self.channels_by_id.values() if isinstance(c, FakeVoiceChannel)]
+
+    @property
+    def categories(self): return [c for c in self.channels_by_id.values() if isinstance(c, FakeCategory)]
+
+    def get_channel(self, channel_id): return self.channels_by_id.get(channel_id)
+
+    def remove_channel(self, channel_id): self.channels_by_id.pop(channel_id, None)
+
+    def _new_id(self): return next(_channel_ids)
+
+    def add_category(self, name):
+        category = FakeCategory(self._new_id(), self, name)
+        self.channels_by_id[category.id] = category
+        return category
+
+    def add_text_channel(self, name):
+        channel = FakeTextChannel(self._new_id(), self, name)
+        self.channels_by_id[channel.id] = channel
+        return channel
+
+    def add_voice_channel(self, name, category=None):
+        channel = FakeVoiceChannel(self._new_id(), self, name, category)
+        self.channels_by_id[channel.id] = channel
+        return channel
+
+    async def create_category(self, name, overwrites=None, **kwargs):
+        category = self.add_category(name)
+        await self.http.record("create", category.id, name)
+        return category
+
+    async def create_voice_channel(self, name, category=None, overwrites=None, **kwargs):
+        channel = self.add_voice_channel(name, category)
+        await self.http.record("create", channel.id, name)
+        return channel
+
+
+# --- Fake Firestore ---
+# --- 遅延付きの偽Firestore ---
+class FakeDocSnapshot:
+    def __init__(self, doc_id, data): self.id = doc_id; self._data = data
+    def to_dict(self): return dict(self._data)
+
+
+class FakeQuery:
+    def __init__(self, db, name, limit=None): self.db = db; self.name = name; self._limit = limit
+    def limit(self, n): return FakeQuery(self.db, self.name, n)
+    def document(self, doc_id): return (self.name, str(doc_id))
+    async def get(self):
+        await asyncio.sleep(self.db.latency)
+        docs = list(self.db.collections.get(self.name, {}).items())[:self._limit]
+        return [FakeDocSnapshot(k, v) for k, v in docs]
+    async def stream(self):
+        await asyncio.sleep(self.db.latency)
+        for doc_id, data in list(self.db.collections.get(self.name, {}).items()):
+            yield FakeDocSnapshot(doc_id, data)
+
+    def on_snapshot(self, callback):
+        watch = FakeWatch(self.db, self.name, callback)
+        watch.deliver([("ADDED", doc_id, data) for doc_id, data in self.db.collections.get(self.name, {}).items()])
+        return watch
+
+
+class FakeWatch:
+    # 本物のリスナーと同じく、コールバックは別スレッドから (docs, changes, read_time) で呼ぶ
+    def __init__(self, db, name, callback): self.db = db; self.name = name; self.callback = callback; db.watches.append(self)
+    def unsubscribe(self): self.db.watches.remove(self)
+
+    def deliver(self, ops):
+        changes = [types.SimpleNamespace(type=types.SimpleNamespace(name=kind), document=FakeDocSnapshot(doc_id, data or {})) for kind, doc_id, data in ops]
+        docs = [FakeDocSnapshot(doc_id, data) for doc_id, data in self.db.collections.get(self.name, {}).items()]
+        threading.Thread(target=self.callback, args=(docs, changes, time.time()), daemon=True).start()
+
+
+class FakeBatch:
+    def __init__(self, db): self.db = db; self.ops = []
+    def set(self, ref, data): self.ops.append((ref, data))
+    def delete(self, ref): self.ops.append((ref, None))
+    async def commit(self):
+        await asyncio.sleep(self.db.latency)
+        self.db.commits += 1
+        changed = {}
+        for (name, doc_id), data in self.ops:
+            docs = self.db.collections.setdefault(name, {})
+            kind = "REMOVED" if data is None else ("MODIFIED" if doc_id in docs else "ADDED")
+            if data is None: docs.pop(doc_id, None)
+            else: docs[doc_id] = dict(data)
+            changed.setdefault(name, []).append((kind, doc_id, data))
+        for watch in list(self.db.watches):
+            if watch.name in changed: watch.deliver(changed[watch.name])
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0): self.latency = latency; self.collections = {}; self.commits = 0; self.watches = []
+    def collection(self, name): return FakeQuery(self, name)
+    def batch(self): return FakeBatch(self)
+
+
+# --- World builder ---
+# --- 合成ワールドの構築 ---
+class World:
+    def __init__(self, nb, http):
+        self.nb = nb
+        self.http = http
+        self.guilds = {}
+        self.members = []
+        self.tracked = [] # (guild, original_vc, status_vc)
+        self.summaries = [] # (guild, summary_vc)
+
+    def install(self):
+        # ボットのキャッシュ参照を偽ワールドに向ける。シャーディング時は担当シャードのサーバーだけを残す
+        self.guilds = {gid: g for gid, g in self.guilds.items() if self.nb.owns_guild(gid)}
+        self.members = [m for m in self.members if m.guild.id in self.guilds]
+        self.tracked = [t for t in self.tracked if t[0].id in self.guilds]
+        self.summaries = [t for t in self.summaries if t[0].id in self.guilds]
+        self.nb.bot.get_guild = self.guilds.get
+        self.nb.vc_tracking.clear()
+        self.nb.summary_vc_tracking.clear()
+        for guild, original_vc, status_vc in self.tracked:
+            self.nb.vc_tracking[original_vc.id] = {"guild_id": guild.id, "status_channel_id": status_vc.id, "original_channel_name": original_vc.name}
+        for guild, summary_vc in self.summaries:
+            self.nb.summary_vc_tracking[guild.id] = summary_vc.id
+        self.nb.group_vc_tracking.clear()
+        self.nb.group_aggregator.reload_definitions()
+        self.nb.channel_index.drop_all_guilds()
+        self.nb.channel_index.rebuild_status_links(self.nb.vc_tracking)
+
+    def move(self, member, channel):
+        # Discordのキャッシュ更新を模してからハンドラに渡す before/after を返す
+        before = member.voice_channel
+        if before is not None: before.fake_members.remove(member)
+        if channel is not None: channel.fake_members.append(member)
+        member.voice_channel = channel
+        return FakeVoiceState(before), FakeVoiceState(channel)
+
+    def expected_status_name(self, original_vc, status_vc):
+        base = status_vc.name.split("：")[0].strip()
+        return f"{base}：{sum(1 for m in original_vc.fake_members if not m.bot)} users"
+
+    def expected_summary_name(self, guild, summary_vc):
+        base = summary_vc.name.split("：")[0].strip()
+        total = sum(sum(1 for m in vc.fake_members if not m.bot) for vc in guild.voice_channels
+                    if not (vc.category and self.nb.STATUS_CATEGORY_NAME.lower() in vc.category.name.lower()))
+        return f"{base}：{total} users"
+
+    def stale_channels(self):
+        stale = [s for g, o, s in self.tracked if s.id in g.channels_by_id and s.name != self.expected_status_name(o, s)]
+        stale += [s for g, s in self.summaries if s.id in g.channels_by_id and s.name != self.expected_summary_name(g, s)]
+        return stale
+
+
+def build_world(nb, guilds=100, channels_per_guild=10, members=1000, tracked_per_guild=1, summary_ratio=0.5,
+                bot_ratio=0.02, http=None, seed=1):
+    rng = random.Random(seed)
+    http = http or FakeHTTP()
+    world = World(nb, http)
+    for g in range(guilds):
+        guild_id = (g + 1) << 22 # スノーフレークと同じく上位ビットからシャードが決まるようにする
+        guild = FakeGuild(guild_id, http, nb.shard_id_for_guild(guild_id) if nb.SHARDED_MODE else 0)
+        world.guilds[guild.id] = guild
+        status_category = guild.add_category(nb.STATUS_CATEGORY_NAME)
+        originals = [guild.add_voice_channel(f"VC {i}") for i in range(channels_per_guild)]
+        for original_vc in originals[:tracked_per_guild]:
+            status_vc = guild.add_voice_channel(f"{original_vc.name}：0 users", status_category)
+            world.tracked.append((guild, original_vc, status_vc))
+        if rng.random() < summary_ratio:
+            world.summaries.append((guild, guild.add_voice_channel("Study/Work：0 users", status_category)))
+    guild_list = list(world.guilds.values())
+    for m in range(members):
+        guild = guild_list[m % len(guild_list)]
+        world.members.append(FakeMember(10**12 + m, guild, bot=rng.random() < bot_ratio))
+    return world
+
+
+# --- Measurement helpers ---
+# --- 計測ユーティリティ ---
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def wait_for_idle(nb, timeout=60.0):
+    # リネームスケジューラとRESTディスパッチャが空になるまで待つ
+    # ハンドラが作ったタスクがまだ走っていないこともあるので、2回続けて空なら完了とみなす
+    deadline = time.monotonic() + timeout
+    idle_checks = 0
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        busy = any(sch.pending or any(not w.done() for w in sch.workers.values()) for sch in (nb.vc_rename_scheduler, nb.summary_vc_rename_scheduler, nb.group_vc_rename_scheduler))
+        busy = busy or nb.rest_dispatcher.in_flight or any(nb.rest_dispatcher.queues.values())
+        idle_checks = 0 if busy else idle_checks + 1
+        if idle_checks >= 2: return True
+    return False
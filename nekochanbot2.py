@@ -2,15 +2,30 @@
 import sys
 import os
 import traceback # トレースバックを出力するためにインポート
+import atexit
+import json
+import queue
+import threading
+import time
 
 # --- Custom Print Logging Configuration ---
 # --- カスタムprintロギング設定 ---
+# レベル判定は整形より前に行い、整形と書き込みはバックグラウンドのスレッドがまとめて行う。
+# イベントループ側はレコードをキューに積むだけなので、stdoutが遅いパイプでもループは止まらない。
 DEBUG_PRINT_ENABLED = os.getenv("DEBUG_PRINT_ENABLED", "false").lower() == "true"
 LOG_LEVEL_PRINT_ENV = os.getenv("LOG_LEVEL_PRINT", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # "text" または "json"
+LOG_ASYNC_WRITER = os.getenv("LOG_ASYNC_WRITER", "true").lower() == "true" # falseで従来どおり呼び出し元で同期書き込み
+LOG_QUEUE_MAX_RECORDS = 50000
+LOG_BATCH_MAX_RECORDS = 512
 _log_level_map_print = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
 _CURRENT_LOG_LEVEL_PRINT_NUM = _log_level_map_print.get(LOG_LEVEL_PRINT_ENV, 10)
+_DEBUG_LOG_ENABLED = DEBUG_PRINT_ENABLED and _CURRENT_LOG_LEVEL_PRINT_NUM <= 10
 _datetime_module = None
 _timezone_module = None
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_RECORDS)
+_log_writer_thread = None
+_log_dropped_records = 0
 
 def _ensure_datetime_imported():
     global _datetime_module, _timezone_module
@@ -19,50 +34,115 @@ def _ensure_datetime_imported():
         _datetime_module = dt_actual
         _timezone_module = tz_actual
 
-def _get_timestamp_for_print():
+def _format_timestamp_for_print(epoch_seconds):
     _ensure_datetime_imported()
     if _datetime_module is None or _timezone_module is None: return "TIMESTAMP_ERROR"
-    return _datetime_module.now(_timezone_module.utc).strftime('%Y-%m-%d %H:%M:%S,%f')[:-3] + "Z"
+    return _datetime_module.fromtimestamp(epoch_seconds, _timezone_module.utc).strftime('%Y-%m-%d %H:%M:%S,%f')[:-3] + "Z"
+
+def _get_timestamp_for_print():
+    return _format_timestamp_for_print(time.time())
+
+def log_enabled(level_str):
+    if level_str == "DEBUG": return _DEBUG_LOG_ENABLED
+    return _log_level_map_print.get(level_str, 0) >= _CURRENT_LOG_LEVEL_PRINT_NUM
 
-def print_log_custom(level_str, message, *args, exc_info_data=None):
-    level_num = _log_level_map_print.get(level_str.upper(), 0)
-    if level_num >= _CURRENT_LOG_LEVEL_PRINT_NUM:
-        task_name_part = ""
+def _format_log_record(record):
+    created, level_str, task_name, message, args, exc_text, fields = record
+    try:
+        full_message = message % args if args else message
+    except Exception as e_format:
+        full_message = f"{message} | PRINT_ERROR - Failed to format log args {args!r}: {e_format}"
+    if LOG_FORMAT == "json":
+        payload = {"ts": _format_timestamp_for_print(created), "level": level_str, "task": task_name, "msg": full_message}
+        if exc_text: payload["exc"] = exc_text
+        payload.update(fields)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+    task_name_part = f"Task-{task_name}|" if task_name else ""
+    fields_part = " [" + ", ".join(f"{k}={v}" for k, v in fields.items()) + "]" if fields else ""
+    exc_part = f"\n{exc_text}" if exc_text else ""
+    return f"{_format_timestamp_for_print(created)} {level_str:<8s} {task_name_part}- {full_message}{fields_part}{exc_part}"
+
+def _write_log_records(records):
+    out_lines, err_lines = [], []
+    for record in records:
+        try: line = _format_log_record(record)
+        except Exception as e_format: line = f"{_get_timestamp_for_print()} PRINT_ERROR - Failed to format log: {e_format} | Original Record: {record!r}"
+        (err_lines if record[1] in ("ERROR", "CRITICAL") else out_lines).append(line)
+    for stream, lines in ((sys.stdout, out_lines), (sys.stderr, err_lines)):
+        if not lines: continue
         try:
-            _asyncio_module_for_log = sys.modules.get('asyncio')
-            if _asyncio_module_for_log:
-                current_task = _asyncio_module_for_log.current_task()
-                if current_task: task_name_part = f"Task-{current_task.get_name()}|"
-        except RuntimeError: pass
-        except AttributeError: pass
-        formatted_message = f"{_get_timestamp_for_print()} {level_str:<8s} {task_name_part}- {message}"
-        output_stream = sys.stderr if level_str in ["ERROR", "CRITICAL"] else sys.stdout
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except Exception: pass
+
+def _log_writer_loop():
+    global _log_dropped_records
+    while True:
+        record = _log_queue.get()
+        batch = [] if record is None else [record]
+        stop = record is None
+        while not stop and len(batch) < LOG_BATCH_MAX_RECORDS:
+            try: record = _log_queue.get_nowait()
+            except queue.Empty: break
+            if record is None: stop = True
+            else: batch.append(record)
+        if _log_dropped_records:
+            dropped, _log_dropped_records = _log_dropped_records, 0
+            batch.append((time.time(), "WARNING", "", f"ログキューが満杯のため{dropped}件のログを破棄しました。", (), None, {}))
+        _write_log_records(batch)
+        if stop: return
+
+def _ensure_log_writer():
+    global _log_writer_thread
+    if _log_writer_thread is None:
+        _log_writer_thread = threading.Thread(target=_log_writer_loop, name="LogWriterThread", daemon=True)
+        _log_writer_thread.start()
+        atexit.register(shutdown_log_writer)
+
+def shutdown_log_writer(timeout=5.0):
+    global _log_writer_thread
+    if _log_writer_thread is None: return
+    try: _log_queue.put(None, timeout=timeout)
+    except queue.Full: pass
+    _log_writer_thread.join(timeout)
+    _log_writer_thread = None
+
+def print_log_custom(level_str, message, *args, exc_info_data=None, **fields):
+    global _log_dropped_records
+    level_num = _log_level_map_print.get(level_str, 0)
+    if level_num < _CURRENT_LOG_LEVEL_PRINT_NUM: return
+    task_name = ""
+    _asyncio_module_for_log = sys.modules.get('asyncio')
+    if _asyncio_module_for_log:
         try:
-            full_message = formatted_message % args if args else formatted_message
-            print(full_message, file=output_stream, flush=True)
-            if exc_info_data:
-                if isinstance(exc_info_data, Exception):
-                    print(f"{_get_timestamp_for_print()} ERROR    - Exception: {type(exc_info_data).__name__}: {exc_info_data}", file=sys.stderr, flush=True)
-                    exc_type, exc_value, tb = sys.exc_info()
-                    if exc_type is not None:
-                        traceback_str = "".join(traceback.format_exception(exc_type, exc_value, tb))
-                        print(f"{_get_timestamp_for_print()} ERROR    - Traceback:\n{traceback_str}", file=sys.stderr, flush=True)
-                elif isinstance(exc_info_data, str):
-                    print(f"{_get_timestamp_for_print()} ERROR    - Traceback:\n{exc_info_data}", file=sys.stderr, flush=True)
-        except Exception as e_print:
-            print(f"{_get_timestamp_for_print()} PRINT_ERROR - Failed to format/print log: {e_print} | Original Level: {level_str} | Original Message: {message}", file=sys.stderr, flush=True)
-
-def print_debug(message, *args):
-    if DEBUG_PRINT_ENABLED: print_log_custom("DEBUG", message, *args)
-def print_info(message, *args): print_log_custom("INFO", message, *args)
-def print_warning(message, *args): print_log_custom("WARNING", message, *args)
-def print_error(message, *args, exc_info=False):
+            current_task = _asyncio_module_for_log.current_task()
+            if current_task: task_name = current_task.get_name()
+        except RuntimeError: pass
+    exc_text = None
+    if isinstance(exc_info_data, BaseException):
+        exc_text = f"Exception: {type(exc_info_data).__name__}: {exc_info_data}"
+        exc_type, exc_value, tb = sys.exc_info()
+        if exc_type is not None: exc_text += "\nTraceback:\n" + "".join(traceback.format_exception(exc_type, exc_value, tb))
+    elif isinstance(exc_info_data, str):
+        exc_text = exc_info_data.rstrip("\n")
+    record = (time.time(), level_str, task_name, message, args, exc_text, fields)
+    if not LOG_ASYNC_WRITER:
+        _write_log_records([record]); return
+    _ensure_log_writer()
+    try: _log_queue.put_nowait(record)
+    except queue.Full: _log_dropped_records += 1
+
+def print_debug(message, *args, **fields):
+    if _DEBUG_LOG_ENABLED: print_log_custom("DEBUG", message, *args, **fields)
+def print_info(message, *args, **fields): print_log_custom("INFO", message, *args, **fields)
+def print_warning(message, *args, **fields): print_log_custom("WARNING", message, *args, **fields)
+def print_error(message, *args, exc_info=False, **fields):
     if exc_info:
         exc_type, exc_value, tb = sys.exc_info()
         if exc_type is not None:
             tb_str = "".join(traceback.format_exception(exc_type, exc_value, tb))
-            print_log_custom("ERROR", message + "\n" + tb_str, *args); return
-    print_log_custom("ERROR", message, *args)
+            print_log_custom("ERROR", message, *args, exc_info_data=tb_str, **fields); return
+    print_log_custom("ERROR", message, *args, **fields)
 
 from datetime import datetime, timedelta, timezone
 _ensure_datetime_imported()
@@ -76,40 +156,413 @@ load_dotenv()
 
 import discord
 from discord.ext import commands, tasks
+from discord import app_commands
 import re
 import asyncio
-from flask import Flask
-from threading import Thread
+import sqlite3
+import collections
+import bisect
+import logging
+import math
+import array
+import zlib
+import functools
+import signal
+import socket
+import uuid
+from aiohttp import web
 
 print_info(f"dotenvロード完了。RENDER env var: {os.getenv('RENDER')}")
 
-# --- Flask App for Keep Alive ---
-# --- Flaskアプリによる常時起動設定 ---
-app = Flask('')
-@app.route('/')
-def home(): print_debug("Flask / endpoint called"); return "I'm alive"
-def run_flask():
-    port = int(os.environ.get('PORT', 8080)); print_info(f"Flaskサーバー起動: host=0.0.0.0, port={port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
-def keep_alive():
-    Thread(target=run_flask, name="FlaskKeepAliveThread", daemon=True).start()
-    print_info("Keep-aliveスレッド開始。")
+# --- Metrics ---
+# --- メトリクス ---
+# Prometheusのテキスト形式で /metrics から出すカウンタとヒストグラム。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+HANDLER_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0) # ハンドラはマイクロ秒単位のことが多い
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # バケット上限での近似値
+        target, cumulative = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target: return bound
+        return math.inf
+
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+        self.help = {}
+        self.buckets = {} # name -> ヒストグラムのバケット
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.help[name] = (kind, help_text)
+        if buckets: self.buckets[name] = buckets
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+        return histogram
+
+    def observe(self, name, value, **labels): self.histogram(name, **labels).observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+    def render(self, gauges=()):
+        lines, described = [], set()
+        def header(name, default_kind):
+            if name in described: return
+            described.add(name)
+            kind, help_text = self.help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter"); lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, labels, value in gauges:
+            header(name, "gauge"); lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("nekochan_rename_latency_seconds", "histogram", "Time to apply a channel rename through Discord REST")
+metrics.describe("nekochan_renames_total", "counter", "Rename attempts by result")
+metrics.describe("nekochan_discord_429_total", "counter", "Discord 429 rate-limit responses seen")
+metrics.describe("nekochan_firestore_call_seconds", "histogram", "Firestore call latency by operation")
+metrics.describe("nekochan_event_loop_lag_seconds", "histogram", "Event loop scheduling lag")
+metrics.describe("nekochan_gateway_events_total", "counter", "Gateway events handled, by shard")
+metrics.describe("nekochan_purge_deleted_total", "counter", "Messages deleted by !!nah, by delete mode")
+metrics.describe("nekochan_orphans_removed_total", "counter", "Stale tracking entries removed, by kind and source")
+metrics.describe("nekochan_lease_transitions_total", "counter", "Active/standby role changes, by new role")
+metrics.describe("nekochan_lease_errors_total", "counter", "Failed lease acquire/renew attempts")
+metrics.describe("nekochan_slow_callbacks_total", "counter", "Event loop callbacks slower than PROFILE_SLOW_CALLBACK_SECONDS while profiling")
+metrics.describe("nekochan_handler_seconds", "histogram", "Handler run time by handler while profiling", buckets=HANDLER_BUCKETS)
+metrics.describe("nekochan_mirror_changes_total", "counter", "Tracking changes applied from Firestore snapshot listeners while on standby")
+
+class _DiscordRateLimitLogCounter(logging.Handler):
+    # discord.py は429を受けると自前で待って再送し、discord.http ロガーに警告を出すだけなので、それを数える
+    # このハンドラがあると logging.lastResort に回らなくなるので、警告自体もこちらのログに流す
+    def emit(self, record):
+        if "429" in str(record.msg): metrics.inc("nekochan_discord_429_total", source="discord.py")
+        try: message = record.getMessage()
+        except Exception: message = str(record.msg)
+        (print_error if record.levelno >= logging.ERROR else print_warning)("%s: %s", record.name, message)
+
+logging.getLogger("discord.http").addHandler(_DiscordRateLimitLogCounter(logging.WARNING))
+
+# --- Event Loop Lag Monitor ---
+# --- イベントループ遅延の計測 ---
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 1.0
+event_loop_lag = {"last": 0.0, "max": 0.0}
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        interval = PROFILE_LAG_INTERVAL_SECONDS if runtime_profiler.enabled else EVENT_LOOP_LAG_INTERVAL_SECONDS
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        event_loop_lag["last"] = lag
+        event_loop_lag["max"] = max(event_loop_lag["max"], lag)
+        metrics.observe("nekochan_event_loop_lag_seconds", lag)
+
+# --- Runtime Profiling ---
+# --- 実行時プロファイリング ---
+# PROFILING_ENABLED=true か、オーナー専用の `!!nah_prof on` で有効になる。無効中のコストはフラグの確認だけ。
+# 有効中はイベントループの全コールバックの実行時間を測ってPROFILE_SLOW_CALLBACK_SECONDSを超えたものを記録し、
+# @profiled を付けたハンドラの所要時間をヒストグラムに取り、遅延の計測間隔を細かくする。
+# `!!nah_prof dump 秒数` は別スレッドからイベントループのスレッドのスタックをサンプリングし、折りたたみ形式(flamegraph.pl / speedscope用)で保存する。
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SLOW_CALLBACK_SECONDS = float(os.getenv("PROFILE_SLOW_CALLBACK_SECONDS", "0.05"))
+PROFILE_LAG_INTERVAL_SECONDS = 0.1
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.01
+PROFILE_DUMP_DIR = os.getenv("PROFILE_DUMP_DIR", ".")
+PROFILE_DUMP_MAX_SECONDS = 600
+PROFILE_SLOW_CALLBACKS_KEPT = 20
+
+def describe_callback(handle):
+    callback = handle._callback
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return f"task {owner.get_name()} ({getattr(coro, '__qualname__', coro)})"
+    return getattr(callback, "__qualname__", repr(callback))
+
+class StackSampler(threading.Thread):
+    # 対象スレッドのスタックを一定間隔で数える。GILを持っている間に辿るので、対象を止めずに済む
+    def __init__(self, thread_id, duration, interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.duration = duration
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        while not self.stop_event.wait(self.interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: return
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            self.stacks[tuple(stack)] += 1 # 文字列化は書き出し時にまとめて行う
+            self.samples += 1
+
+def write_folded_stacks(path, stacks):
+    with open(path, "w", encoding="utf-8") as f:
+        for codes, count in stacks.most_common():
+            f.write(";".join(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})" for code in reversed(codes)) + f" {count}\n")
+
+class RuntimeProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.enabled_at = None
+        self.original_handle_run = None
+        self.slow_callbacks = collections.deque(maxlen=PROFILE_SLOW_CALLBACKS_KEPT) # (時刻, 秒, 説明)
+        self.slow_callback_count = 0
+        self.sampler = None
+
+    def enable(self):
+        if self.enabled: return
+        self.enabled, self.enabled_at = True, time.time()
+        original = self.original_handle_run = asyncio.Handle._run # TimerHandleもこれを使う
+        def timed_run(handle):
+            started = time.perf_counter()
+            try: return original(handle)
+            finally:
+                elapsed = time.perf_counter() - started
+                if elapsed >= PROFILE_SLOW_CALLBACK_SECONDS: self._note_slow_callback(handle, elapsed)
+        asyncio.Handle._run = timed_run
+        print_info(f"プロファイリング有効化 (遅いコールバックの閾値: {PROFILE_SLOW_CALLBACK_SECONDS * 1000:.0f}ms)")
+
+    def disable(self):
+        if not self.enabled: return
+        asyncio.Handle._run = self.original_handle_run
+        self.enabled = False
+        print_info("プロファイリング無効化")
+
+    def _note_slow_callback(self, handle, elapsed):
+        description = describe_callback(handle)
+        self.slow_callback_count += 1
+        self.slow_callbacks.append((time.time(), elapsed, description))
+        metrics.inc("nekochan_slow_callbacks_total")
+        print_warning(f"遅いコールバック {elapsed * 1000:.0f}ms: {description}")
+
+    async def capture(self, seconds):
+        # 呼び出し元(イベントループのスレッド)をサンプリングし、保存先とサンプル数を返す
+        self.sampler = StackSampler(threading.get_ident(), seconds)
+        try:
+            self.sampler.start()
+            await asyncio.to_thread(self.sampler.join)
+            path = os.path.join(PROFILE_DUMP_DIR, f"nekochan-profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+            await asyncio.to_thread(write_folded_stacks, path, self.sampler.stacks)
+            print_info(f"プロファイルを保存: {path} (サンプル {self.sampler.samples}件)")
+            return path, self.sampler.samples
+        finally:
+            self.sampler = None
+
+    def status_text(self):
+        # 遅れの原因がイベントループ・Discordのレート制限・Firestoreのどれかを見分けるための要約
+        since = f"<t:{int(self.enabled_at)}:R>から" if self.enabled_at else ""
+        lines = [f"🔧 **プロファイリング: {'有効' if self.enabled else '無効'}** {since if self.enabled else ''}"]
+        lines.append(f"イベントループ遅延: 直近 {event_loop_lag['last'] * 1000:.1f}ms / 最大 {event_loop_lag['max'] * 1000:.1f}ms")
+        lines.append(f"遅いコールバック(>{PROFILE_SLOW_CALLBACK_SECONDS * 1000:.0f}ms): {self.slow_callback_count}件")
+        for at, elapsed, description in list(self.slow_callbacks)[-5:]:
+            lines.append(f"　<t:{int(at)}:T> {elapsed * 1000:.0f}ms {description[:80]}")
+        handlers = sorted(((dict(labels)["handler"], h) for (name, labels), h in metrics.histograms.items() if name == "nekochan_handler_seconds"), key=lambda item: -item[1].sum)
+        if handlers: lines.append("ハンドラ所要時間 (p50 / p99 / 回数 / 合計):")
+        for handler, h in handlers[:8]:
+            lines.append(f"　{handler}: {h.quantile(0.5) * 1000:g}ms / {h.quantile(0.99) * 1000:g}ms / {h.count} / {h.sum:.2f}s")
+        rate_limited = sum(v for (name, _), v in metrics.counters.items() if name == "nekochan_discord_429_total")
+        lanes = ", ".join(f"{lane} {st['depth']}件/最大待ち{st['max_wait']}s" for lane, st in rest_dispatcher.get_lane_stats().items())
+        lines.append(f"Discord 429: {rate_limited}回 | RESTレーン: {lanes}")
+        firestore_calls = [h for (name, labels), h in metrics.histograms.items() if name == "nekochan_firestore_call_seconds" and dict(labels).get("op") == "batch_commit"]
+        commit_p99 = f"{firestore_calls[0].quantile(0.99) * 1000:g}ms" if firestore_calls else "-"
+        lines.append(f"Firestore: 未送信 {len(firestore_writer.pending)}件, 連続失敗 {firestore_writer.consecutive_failures}回, バッチコミットp99 {commit_p99}")
+        if self.sampler: lines.append("スタックのサンプリング中ニャ…")
+        return "\n".join(lines)
+
+runtime_profiler = RuntimeProfiler()
+
+def profiled(func):
+    # 有効中だけ所要時間を nekochan_handler_seconds に記録する。ヒストグラムは最初の1回で引いて使い回す
+    histogram = None
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        nonlocal histogram
+        if not runtime_profiler.enabled: return await func(*args, **kwargs)
+        started = time.perf_counter()
+        try: return await func(*args, **kwargs)
+        finally:
+            if histogram is None: histogram = metrics.histogram("nekochan_handler_seconds", handler=func.__qualname__)
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+# --- Keep Alive / Health HTTP Server ---
+# --- 常時起動・ヘルスチェック用HTTPサーバー ---
+# Botと同じイベントループ上でaiohttpを動かす。/healthz はプロセス生存、/readyz はゲートウェイ接続・Firestoreロード・遅延を確認する。
+READY_MAX_LATENCY_SECONDS = float(os.getenv("READY_MAX_LATENCY_SECONDS", "5"))
+firestore_load_state = "pending" # pending / loaded / disabled / failed
+# is_ready()は切断中もTrueのままなので、接続/切断/再開のイベントでシャード毎の接続状態を持つ (非シャード構成はNone)
+gateway_connected_shards = set()
+
+def set_gateway_connected(shard_id, connected):
+    if connected: gateway_connected_shards.add(shard_id)
+    else: gateway_connected_shards.discard(shard_id)
+
+def gateway_connected():
+    expected = set(bot.shards) if SHARDED_MODE else {None}
+    return bot.is_ready() and not bot.is_closed() and bool(expected) and expected <= gateway_connected_shards
+
+async def handle_root(request): return web.Response(text="I'm alive")
+async def handle_healthz(request): return web.Response(text="ok")
+
+async def handle_readyz(request):
+    latency = bot.latency
+    checks = {
+        "gateway_connected": gateway_connected(),
+        "firestore_loaded": firestore_load_state in ("loaded", "disabled"),
+        "latency_ok": math.isfinite(latency) and latency < READY_MAX_LATENCY_SECONDS,
+    }
+    body = {"ready": all(checks.values()), "checks": checks, "latency": latency if math.isfinite(latency) else None, "firestore": firestore_load_state, "role": leader_lease.role()}
+    return web.json_response(body, status=200 if body["ready"] else 503)
+
+def collect_gauges():
+    latency = bot.latency
+    gauges = [
+        ("nekochan_tracked_vcs", {"kind": "status"}, len(vc_tracking)),
+        ("nekochan_tracked_vcs", {"kind": "summary"}, len(summary_vc_tracking)),
+        ("nekochan_event_loop_lag_last_seconds", {}, event_loop_lag["last"]),
+        ("nekochan_event_loop_lag_max_seconds", {}, event_loop_lag["max"]),
+        ("nekochan_gateway_latency_seconds", {}, latency if math.isfinite(latency) else -1),
+        ("nekochan_firestore_pending_writes", {}, len(firestore_writer.pending)),
+        ("nekochan_lease_active", {"instance": INSTANCE_ID}, int(leader_lease.active)),
+    ]
+    for lane, lane_stats in rest_dispatcher.get_lane_stats().items():
+        gauges.append(("nekochan_rest_lane_depth", {"lane": lane}, lane_stats["depth"]))
+        gauges.append(("nekochan_rest_lane_avg_wait_seconds", {"lane": lane}, lane_stats["avg_wait"]))
+        gauges.append(("nekochan_rest_lane_max_wait_seconds", {"lane": lane}, lane_stats["max_wait"]))
+    for key, value in last_status_cycle_stats.items():
+        gauges.append(("nekochan_status_cycle", {"stat": key}, value))
+    return gauges
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(collect_gauges()), content_type="text/plain", charset="utf-8")
+
+async def start_keep_alive_server():
+    app = web.Application()
+    app.router.add_get("/", handle_root)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = int(os.environ.get('PORT', 8080))
+    await web.TCPSite(runner, host='0.0.0.0', port=port).start()
+    print_info(f"HTTPサーバー起動: host=0.0.0.0, port={port}")
+    return runner
 
 # --- Bot Intents Configuration ---
 # --- BotのIntents設定 ---
-intents = discord.Intents.default(); intents.guilds = True; intents.voice_states = True; intents.message_content = True
+# LOW_MEMORY_MODE=true では人数集計に必要な guilds / voice_states とコマンド受信用のメッセージだけを購読し、
+# メンバーキャッシュをVC参加中のメンバーに限定、起動時のチャンク取得とメッセージキャッシュを無効にする。
+# message_content も外すため、プレフィックスコマンドはBotへのメンション付き (例: @nekochan nah 5) かDMで使う。
+LOW_MEMORY_MODE = os.getenv("LOW_MEMORY_MODE", "false").lower() == "true"
+
+def build_intents(low_memory):
+    if not low_memory:
+        intents = discord.Intents.default(); intents.guilds = True; intents.voice_states = True; intents.message_content = True
+        return intents
+    intents = discord.Intents.none()
+    intents.guilds = True; intents.voice_states = True; intents.guild_messages = True; intents.dm_messages = True
+    return intents
+
+def build_cache_options(low_memory):
+    if not low_memory: return {}
+    member_cache_flags = discord.MemberCacheFlags.none(); member_cache_flags.voice = True
+    return {"member_cache_flags": member_cache_flags, "chunk_guilds_at_startup": False, "max_messages": None}
+
+intents = build_intents(LOW_MEMORY_MODE)
+
+# --- Sharding Configuration ---
+# --- シャーディング設定 ---
+# SHARD_COUNT 未設定なら従来どおり単一シャードの commands.Bot。
+# SHARD_COUNT だけ設定すると1プロセスで全シャードを動かし、SHARD_IDS ("0-3" や "0,2,5") を付けるとその範囲だけを担当する。
+# 各プロセスは担当シャードのサーバーに属するFirestoreドキュメントだけを保持する。
+def parse_shard_ids(value):
+    if not value.strip(): return None
+    shard_ids = set()
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-", 1)
+            shard_ids.update(range(int(start), int(end) + 1))
+        elif part:
+            shard_ids.add(int(part))
+    return frozenset(shard_ids)
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = parse_shard_ids(os.getenv("SHARD_IDS", ""))
+SHARDED_MODE = SHARD_COUNT is not None
+if SHARD_IDS and not SHARDED_MODE:
+    print_warning("SHARD_IDSはSHARD_COUNTと一緒に設定する必要があります。シャーディング無効で起動します。"); SHARD_IDS = None
+if SHARDED_MODE and SHARD_IDS and max(SHARD_IDS) >= SHARD_COUNT:
+    raise SystemExit(f"SHARD_IDS {sorted(SHARD_IDS)} がSHARD_COUNT {SHARD_COUNT} の範囲外です。")
+
+def shard_id_for_guild(guild_id):
+    return (guild_id >> 22) % SHARD_COUNT
+
+def owns_guild(guild_id):
+    return not SHARDED_MODE or SHARD_IDS is None or shard_id_for_guild(guild_id) in SHARD_IDS
+
+def shard_label():
+    if not SHARDED_MODE: return "single"
+    if SHARD_IDS is None: return f"all-of-{SHARD_COUNT}"
+    return f"{','.join(str(i) for i in sorted(SHARD_IDS))}-of-{SHARD_COUNT}"
 
 # --- Firestore Client and Constants ---
 # --- Firestoreクライアントと定数 ---
 db = None
 FIRESTORE_COLLECTION_NAME = "discord_tracked_original_vcs_prod_v4"
 SUMMARY_FIRESTORE_COLLECTION_NAME = "discord_summary_vcs_prod_v1"
+GROUP_FIRESTORE_COLLECTION_NAME = "discord_group_vcs_prod_v1"
 STATUS_CATEGORY_NAME = "STATUS"
 
 # --- VC Tracking Dictionaries and State ---
 # --- VC追跡用の辞書と状態 ---
 vc_tracking = {}
 summary_vc_tracking = {}
+group_vc_tracking = {} # group_vc_id -> {"guild_id", "kind", "target", "label"}
 vc_processing_flags = {}
 summary_vc_processing_flags = {}
 command_cooldowns = {} # NEW: コマンドの二重実行防止用
@@ -122,162 +575,1590 @@ ZERO_USER_TIMEOUT_DURATION = timedelta(minutes=5)
 vc_zero_stats = {}
 vc_discord_api_cooldown_until = {}
 summary_vc_api_cooldown_until = {}
+group_vc_api_cooldown_until = {}
 
 # --- Help Text ---
 # --- ヘルプテキスト ---
 HELP_TEXT_CONTENT = (
     "📘 **コマンド一覧だニャ🐈**\n\n"
-    "🔹 `!!nah [数]`\n"
-    "→ 指定した数のメッセージをこのチャンネルから削除するニャ。\n"
-    "   例: `!!nah 5`\n\n"
-    "🔹 `!!nah_vc [VCのチャンネルIDまたは名前]`\n"
+    "🔹 `!!nah [数] [#チャンネル...] [user:@ユーザー] [contains:文字列] [after:時間] [before:時間]`\n"
+    "→ 指定した数のメッセージを削除するニャ。チャンネル省略時はこのチャンネル、時間は `2h` `3d` や `2024-01-31` で指定するニャ。\n"
+    "   14日より古いメッセージは1件ずつ削除するので時間がかかるニャ。`!!nah_stop` で中止できるニャ。\n"
+    "   例: `!!nah 5` または `!!nah 500 #spam user:@荒らし contains:http after:2h`\n\n"
+    "🔹 `!!nah_vc [VCのチャンネルIDまたは名前]` または `/nah_vc`\n"
     "→ 指定したボイスチャンネルの人数表示用チャンネルを「STATUS」カテゴリに作成/削除するニャ。(トグル式)\n"
     "   ONにすると、STATUSカテゴリに `[元VC名]：〇 users` という名前のVCが作られ、5分毎に人数が更新されるニャ。\n"
     "   OFFにすると、その人数表示用チャンネルを削除し、追跡を停止するニャ。\n"
-    "   例: `!!nah_vc General Voice` または `!!nah_vc 123456789012345678`\n\n"
-    "🔹 `!!nah_sum`\n"
+    "   例: `!!nah_vc General Voice` または `!!nah_vc 123456789012345678` (`/nah_vc` では名前の候補が出るニャ)\n\n"
+    "🔹 `!!nah_sum` または `/nah_sum`\n"
     "→ このサーバーにあるすべてのVC接続人数を集計する鍵付きVCを作成/削除するニャ🐈\n\n"
+    "🔹 `!!nah_group [category カテゴリ | pattern 正規表現 | channels #VC... | all | list | remove 集計VC]`\n"
+    "→ カテゴリ毎・名前のパターン毎・指定したVCの合計人数を集計するVCを作成/削除するニャ。1サーバーに複数作れるニャ🐈\n"
+    "   例: `!!nah_group category ゲーム` または `!!nah_group pattern ^作業`\n\n"
+    "🔹 `!!nah_stats [VCのチャンネルIDまたは名前]`\n"
+    "→ 追跡中のVCとサーバー全体の人数の記録(直近1時間〜30日の最大/平均)を表示するニャ📊\n\n"
     "🔹 `!!nah_help` または `/nah_help`\n"
     "→ このヘルプメッセージを表示するニャ🐈\n"
 )
+if LOW_MEMORY_MODE:
+    HELP_TEXT_CONTENT += "\n⚠️ 省メモリモード中は `!!` の代わりにBotへのメンションを付けて使ってニャ。例: `@Bot nah 5`\n"
+    HELP_TEXT_CONTENT += "⚠️ 省メモリモード中はメッセージ本文が読めないので、`!!nah` の `contains:` は使えないニャ。\n"
 
 # --- Custom Bot Class for Slash Commands ---
 # --- スラッシュコマンド用のカスタムBotクラス ---
-class MyBot(commands.Bot):
+_BotBase = commands.AutoShardedBot if SHARDED_MODE else commands.Bot
+
+class ActiveOnlyCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction): return is_active_instance()
+
+class MyBot(_BotBase):
+    async def close(self):
+        if is_active_instance(): occupancy_history.persist_dirty()
+        tracking_mirror.stop()
+        await firestore_writer.close()
+        await leader_lease.release() # 書き込みを流し切ってから手放す
+        if state_snapshot_dirty or firestore_writer.pending: await save_state_snapshot() # 送れなかった書き込みは次の起動で送り直す
+        await super().close()
+
+    async def process_commands(self, message):
+        if not is_active_instance(): return # HAモードのスタンバイは応答しない
+        await super().process_commands(message)
+
     async def setup_hook(self):
+        if PROFILING_ENABLED: runtime_profiler.enable()
+        asyncio.create_task(monitor_event_loop_lag(), name="event-loop-lag-monitor")
         @self.tree.command(name="nah_help", description="コマンド一覧を表示するニャ。")
-        async def nah_help_slash(interaction: discord.Interaction): await interaction.response.send_message(HELP_TEXT_CONTENT, ephemeral=True)
+        async def nah_help_slash(interaction: discord.Interaction): await rest_dispatcher.submit(LANE_INTERACTIVE, lambda: interaction.response.send_message(HELP_TEXT_CONTENT, ephemeral=True))
+
+        @self.tree.command(name="nah_vc", description="指定VCの人数表示用チャンネルを作成/削除するニャ。")
+        @app_commands.describe(channel="対象のボイスチャンネル (名前を入力すると候補が出るニャ)")
+        @app_commands.guild_only()
+        @app_commands.default_permissions(manage_channels=True)
+        @app_commands.checks.has_permissions(manage_channels=True)
+        @app_commands.checks.bot_has_permissions(manage_channels=True)
+        async def nah_vc_slash(interaction: discord.Interaction, channel: str):
+            await defer_interaction(interaction)
+            feedback = InteractionFeedback(interaction)
+            try: await toggle_vc_tracking(interaction.guild, channel, feedback)
+            finally: await feedback.finish()
+
+        @nah_vc_slash.autocomplete("channel")
+        async def nah_vc_autocomplete(interaction: discord.Interaction, current: str):
+            if not interaction.guild: return []
+            return [app_commands.Choice(name=voice_channel_choice_label(vc), value=str(vc.id)) for vc in channel_index.suggest_voice_channels(interaction.guild, current)]
+
+        @self.tree.command(name="nah_sum", description="サーバー全体のVC接続人数を集計する鍵付きVCを作成/削除するニャ。")
+        @app_commands.guild_only()
+        @app_commands.default_permissions(manage_channels=True)
+        @app_commands.checks.has_permissions(manage_channels=True)
+        @app_commands.checks.bot_has_permissions(manage_channels=True)
+        async def nah_sum_slash(interaction: discord.Interaction):
+            await defer_interaction(interaction)
+            feedback = InteractionFeedback(interaction)
+            try: await toggle_summary_vc(interaction.guild, feedback)
+            finally: await feedback.finish()
+
+        @self.tree.error
+        async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+            if isinstance(error, (app_commands.MissingPermissions, app_commands.BotMissingPermissions)):
+                print_error(f"スラッシュコマンド /{interaction.command.name if interaction.command else '?'} で権限エラー: {error}")
+                message = "権限が足りないニャ😿"
+            else:
+                print_error(f"スラッシュコマンド未処理エラー: {error}", exc_info=True)
+                message = "コマンド実行中に予期せぬエラー発生ニャ。"
+            try:
+                if interaction.response.is_done(): await InteractionFeedback(interaction).send(message)
+                else: await rest_dispatcher.submit(LANE_INTERACTIVE, lambda: interaction.response.send_message(message, ephemeral=True))
+            except discord.HTTPException as e: print_warning(f"スラッシュコマンドのエラー応答に失敗: {e}")
         try: await self.tree.sync(); print_info("スラッシュコマンド同期完了。")
         except Exception as e: print_error(f"スラッシュコマンド同期エラー: {e}", exc_info=True)
 
-bot = MyBot(command_prefix='!!', intents=intents)
+_shard_options = {"shard_count": SHARD_COUNT, "shard_ids": sorted(SHARD_IDS) if SHARD_IDS else None} if SHARDED_MODE else {}
+bot = MyBot(command_prefix=commands.when_mentioned_or('!!') if LOW_MEMORY_MODE else '!!', intents=intents, tree_cls=ActiveOnlyCommandTree, **build_cache_options(LOW_MEMORY_MODE), **_shard_options)
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 
+def firestore_configured():
+    return bool(os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or os.getenv("FIRESTORE_EMULATOR_HOST"))
+
 async def init_firestore():
     global db, firestore
+    if db is not None: return True
     try:
-        if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+        # FIRESTORE_EMULATOR_HOST が設定されていればローカルのFirestoreエミュレータに接続する
+        if firestore_configured():
             from google.cloud import firestore as google_firestore
             firestore = google_firestore
             db = firestore.AsyncClient()
             await asyncio.wait_for(db.collection(FIRESTORE_COLLECTION_NAME).limit(1).get(), timeout=DB_CALL_TIMEOUT)
             print_info("Firestoreクライアント初期化成功。")
             return True
-        else: print_warning("GOOGLE_APPLICATION_CREDENTIALS未設定。Firestore無効。"); db = None; return False
+        else: print_warning("GOOGLE_APPLICATION_CREDENTIALS / FIRESTORE_EMULATOR_HOST未設定。Firestore無効。"); db = None; return False
     except Exception as e: print_error(f"Firestore初期化エラー: {e}", exc_info=True); db = None; return False
 
+# --- Firestore Write-Behind Queue ---
+# --- Firestore書き込みの遅延バッチ化 ---
+# 書き込み/削除はドキュメント毎にまとめ(最後の操作が優先)、件数か時間でバッチコミットする。
+# 失敗時はバックオフして再送し、終了時に残りをフラッシュする。クライアントは関数で渡すので偽物に差し替えられる。
+# connectを渡すと未接続の間も操作を溜めておき、フラッシュの度に接続をやり直す (起動時にFirestoreが落ちていた場合など)。
+FIRESTORE_FLUSH_INTERVAL = 2.0
+FIRESTORE_BATCH_MAX_OPS = 400 # Firestoreのバッチ上限は500件
+FIRESTORE_RETRY_BASE_DELAY = 1.0
+FIRESTORE_RETRY_MAX_DELAY = 60.0
+FIRESTORE_SHUTDOWN_FLUSH_ATTEMPTS = 3
+
+class FirestoreWriteBehind:
+    def __init__(self, client_getter, connect=None):
+        self.client_getter = client_getter
+        self.connect = connect
+        self.pending = {} # (collection, doc_id) -> dict(set) または None(delete)
+        self.consecutive_failures = 0
+        self.flusher = None
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    def set(self, collection, doc_id, data): self._enqueue((collection, str(doc_id)), data)
+    def delete(self, collection, doc_id): self._enqueue((collection, str(doc_id)), None)
+    def has_pending(self, collection, doc_id): return (collection, str(doc_id)) in self.pending
+
+    def _enqueue(self, key, data):
+        self.pending[key] = data
+        if len(self.pending) >= FIRESTORE_BATCH_MAX_OPS: self.wakeup.set()
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._run(), name="firestore-write-behind")
+
+    def _retry_delay(self):
+        return min(FIRESTORE_RETRY_MAX_DELAY, FIRESTORE_RETRY_BASE_DELAY * 2 ** (self.consecutive_failures - 1))
+
+    async def _run(self):
+        while self.pending:
+            try: await asyncio.wait_for(self.wakeup.wait(), timeout=FIRESTORE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError: pass
+            self.wakeup.clear()
+            if not await self.flush():
+                delay = self._retry_delay()
+                print_warning(f"Firestoreバッチ書き込み失敗 (連続{self.consecutive_failures}回)。{delay:.0f}秒後に再試行。残り{len(self.pending)}件。")
+                await asyncio.sleep(delay)
+
+    @profiled
+    async def flush(self):
+        async with self.flush_lock:
+            client = self.client_getter()
+            if client is None and self.connect is None:
+                self.pending.clear(); return True
+            if client is None:
+                if not await self.connect():
+                    self.consecutive_failures += 1; return False
+                client = self.client_getter()
+            while self.pending:
+                ops = {key: self.pending.pop(key) for key in list(self.pending)[:FIRESTORE_BATCH_MAX_OPS]}
+                try:
+                    batch = client.batch()
+                    for (collection, doc_id), data in ops.items():
+                        doc_ref = client.collection(collection).document(doc_id)
+                        if data is None: batch.delete(doc_ref)
+                        else: batch.set(doc_ref, data)
+                    started = time.monotonic()
+                    await asyncio.wait_for(batch.commit(), timeout=DB_CALL_TIMEOUT)
+                    metrics.observe("nekochan_firestore_call_seconds", time.monotonic() - started, op="batch_commit")
+                except asyncio.CancelledError:
+                    # 終了処理などでコミット中にキャンセルされても、取り出した分を失わないよう戻す (再送しても同じ内容になるだけ)
+                    for key, data in ops.items(): self.pending.setdefault(key, data)
+                    raise
+                except Exception as e:
+                    # 失敗分を戻す。その間に積まれた新しい操作の方を優先する
+                    for key, data in ops.items(): self.pending.setdefault(key, data)
+                    self.consecutive_failures += 1
+                    print_error(f"Firestoreバッチ書き込みエラー ({len(ops)}件): {e}")
+                    return False
+                self.consecutive_failures = 0
+                print_debug("Firestoreバッチ書き込み完了: %d件", len(ops))
+            return True
+
+    async def close(self):
+        if self.flusher and not self.flusher.done():
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True) # 戻し終わるのを待ってから最後のフラッシュをする
+        for attempt in range(FIRESTORE_SHUTDOWN_FLUSH_ATTEMPTS):
+            if await self.flush(): return
+            await asyncio.sleep(self._retry_delay())
+        print_error(f"終了時のFirestoreフラッシュに失敗。{len(self.pending)}件の変更が未保存。")
+
+firestore_writer = FirestoreWriteBehind(lambda: db, connect=init_firestore)
+
 # --- Persistence Functions ---
+# ロード関数はグローバル状態を直接書き換えず、読み込んだ辞書を返す(失敗時はNone)。
+# parse_*_doc はドキュメント1件を (キー, 担当判定用のguild_id, 値) に変換する。スナップショットリスナーと共用。
+def parse_tracked_vc_doc(doc_id, doc_data):
+    value = {"guild_id": int(doc_data["guild_id"]), "status_channel_id": int(doc_data["status_channel_id"]), "original_channel_name": doc_data["original_channel_name"]}
+    return int(doc_id), value["guild_id"], value
+
+def parse_summary_vc_doc(doc_id, doc_data):
+    return int(doc_id), int(doc_id), int(doc_data["summary_vc_id"])
+
+@profiled
 async def load_tracked_channels_from_db():
-    if not db: return
-    global vc_tracking; vc_tracking = {}
+    if not db: return None
+    loaded = {}
     try:
         stream = db.collection(FIRESTORE_COLLECTION_NAME).stream()
         async for doc_snapshot in stream:
-            doc_data = doc_snapshot.to_dict()
             try:
-                vc_tracking[int(doc_snapshot.id)] = {
-                    "guild_id": int(doc_data["guild_id"]),
-                    "status_channel_id": int(doc_data["status_channel_id"]),
-                    "original_channel_name": doc_data["original_channel_name"]
-                }
+                key, guild_id, value = parse_tracked_vc_doc(doc_snapshot.id, doc_snapshot.to_dict())
+                if not owns_guild(guild_id): continue
+                loaded[key] = value
             except (ValueError, TypeError, KeyError):
                 print_warning(f"DBドキュメント {doc_snapshot.id} データ解析エラー。スキップ。")
-        print_info(f"{len(vc_tracking)}件の追跡VC情報をDBからロード完了。")
-    except Exception as e: print_error(f"Firestoreデータロード中エラー: {e}", exc_info=True)
+        print_info(f"{len(loaded)}件の追跡VC情報をDBからロード完了。")
+        return loaded
+    except Exception as e: print_error(f"Firestoreデータロード中エラー: {e}", exc_info=True); return None
 
 async def save_tracked_original_to_db(original_channel_id, guild_id, status_channel_id, original_channel_name):
-    if not db: return
-    try:
-        doc_ref = db.collection(FIRESTORE_COLLECTION_NAME).document(str(original_channel_id))
-        await doc_ref.set({
-            "guild_id": guild_id,
-            "status_channel_id": status_channel_id,
-            "original_channel_name": original_channel_name
-        })
-    except Exception as e: print_error(f"Firestore書き込みエラー (Original VC ID: {original_channel_id}): {e}", exc_info=True)
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return # 未接続でも溜めておき、繋がったら送る
+    firestore_writer.set(FIRESTORE_COLLECTION_NAME, original_channel_id, {
+        "guild_id": guild_id,
+        "status_channel_id": status_channel_id,
+        "original_channel_name": original_channel_name
+    })
 
 async def remove_tracked_original_from_db(original_channel_id):
-    if not db: return
-    try:
-        await db.collection(FIRESTORE_COLLECTION_NAME).document(str(original_channel_id)).delete()
-    except Exception as e: print_error(f"Firestore削除エラー (Original VC ID: {original_channel_id}): {e}", exc_info=True)
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return
+    firestore_writer.delete(FIRESTORE_COLLECTION_NAME, original_channel_id)
 
+@profiled
 async def load_summary_vcs_from_db():
-    if not db: return
-    global summary_vc_tracking; summary_vc_tracking = {}
+    if not db: return None
+    loaded = {}
     try:
         stream = db.collection(SUMMARY_FIRESTORE_COLLECTION_NAME).stream()
         async for doc_snapshot in stream:
-            doc_data = doc_snapshot.to_dict()
             try:
-                summary_vc_tracking[int(doc_snapshot.id)] = int(doc_data["summary_vc_id"])
+                key, guild_id, value = parse_summary_vc_doc(doc_snapshot.id, doc_snapshot.to_dict())
+                if not owns_guild(guild_id): continue
+                loaded[key] = value
             except (ValueError, TypeError, KeyError):
                 print_warning(f"サマリーVC DBドキュメント {doc_snapshot.id} データ解析エラー。スキップ。")
-        print_info(f"{len(summary_vc_tracking)}件のサマリーVC情報をDBからロード完了。")
-    except Exception as e: print_error(f"サマリーVCのFirestoreデータロード中エラー: {e}", exc_info=True)
+        print_info(f"{len(loaded)}件のサマリーVC情報をDBからロード完了。")
+        return loaded
+    except Exception as e: print_error(f"サマリーVCのFirestoreデータロード中エラー: {e}", exc_info=True); return None
 
 async def save_summary_vc_to_db(guild_id, summary_vc_id):
-    if not db: return
-    try:
-        await db.collection(SUMMARY_FIRESTORE_COLLECTION_NAME).document(str(guild_id)).set({"summary_vc_id": summary_vc_id})
-    except Exception as e: print_error(f"サマリーVCのFirestore書き込みエラー (Guild ID: {guild_id}): {e}", exc_info=True)
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return
+    firestore_writer.set(SUMMARY_FIRESTORE_COLLECTION_NAME, guild_id, {"summary_vc_id": summary_vc_id})
 
 async def remove_summary_vc_from_db(guild_id):
-    if not db: return
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return
+    firestore_writer.delete(SUMMARY_FIRESTORE_COLLECTION_NAME, guild_id)
+
+def parse_group_definition(doc_data):
+    kind, target = doc_data["kind"], doc_data.get("target")
+    if kind == "category": target = int(target)
+    elif kind == "channels": target = [int(cid) for cid in target]
+    elif kind == "pattern": target = validate_group_pattern(str(target))
+    elif kind == "all": target = None
+    else: raise ValueError(f"unknown group kind: {kind}")
+    return {"guild_id": int(doc_data["guild_id"]), "kind": kind, "target": target, "label": str(doc_data["label"])}
+
+def parse_group_vc_doc(doc_id, doc_data):
+    definition = parse_group_definition(doc_data)
+    return int(doc_id), definition["guild_id"], definition
+
+@profiled
+async def load_group_vcs_from_db():
+    if not db: return None
+    loaded = {}
+    try:
+        stream = db.collection(GROUP_FIRESTORE_COLLECTION_NAME).stream()
+        async for doc_snapshot in stream:
+            try:
+                key, guild_id, value = parse_group_vc_doc(doc_snapshot.id, doc_snapshot.to_dict())
+                if not owns_guild(guild_id): continue
+                loaded[key] = value
+            except (ValueError, TypeError, KeyError):
+                print_warning(f"集計グループ DBドキュメント {doc_snapshot.id} データ解析エラー。スキップ。")
+        print_info(f"{len(loaded)}件の集計グループ情報をDBからロード完了。")
+        return loaded
+    except Exception as e: print_error(f"集計グループのFirestoreデータロード中エラー: {e}", exc_info=True); return None
+
+async def save_group_vc_to_db(group_vc_id, definition):
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return
+    firestore_writer.set(GROUP_FIRESTORE_COLLECTION_NAME, group_vc_id, dict(definition))
+
+async def remove_group_vc_from_db(group_vc_id):
+    mark_state_snapshot_dirty()
+    if not firestore_configured(): return
+    firestore_writer.delete(GROUP_FIRESTORE_COLLECTION_NAME, group_vc_id)
+
+# --- Local State Snapshot ---
+# --- ローカル状態スナップショット ---
+# vc_tracking / summary_vc_tracking / group_vc_tracking をSQLiteに保存しておき、起動直後はそこから追跡を始める。
+# Firestoreとはバックグラウンドで突き合わせ、差分だけを反映する。読み込めるまでバックオフしながら再試行する。
+# Firestoreに届いていない追跡情報の書き込みもスナップショットに残し、次の起動で送り直す (突き合わせで消されないように)。
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "nekochanbot_state.sqlite3" if not SHARDED_MODE else f"nekochanbot_state.{shard_label()}.sqlite3") # 空文字で無効
+STATE_SNAPSHOT_VERSION = 3 # 2: 集計グループを追加, 3: Firestore未送信の書き込みを追加
+STATE_SNAPSHOT_SAVE_INTERVAL_SECONDS = 30
+TRACKING_FIRESTORE_COLLECTIONS = (FIRESTORE_COLLECTION_NAME, SUMMARY_FIRESTORE_COLLECTION_NAME, GROUP_FIRESTORE_COLLECTION_NAME)
+FIRESTORE_RECONCILE_RETRY_MAX_DELAY = 300.0
+firestore_reconcile_task = None
+state_snapshot_dirty = False
+state_snapshot_has_pending = False # 未送信の書き込みを含むスナップショットは、送り終わるまで定期的に書き直す
+startup_metrics = {"started_at": time.monotonic(), "first_rename_after": None, "snapshot_entries": None}
+
+def mark_state_snapshot_dirty():
+    global state_snapshot_dirty
+    state_snapshot_dirty = True
+
+def note_first_rename():
+    if startup_metrics["first_rename_after"] is not None: return
+    elapsed = time.monotonic() - startup_metrics["started_at"]
+    startup_metrics["first_rename_after"] = elapsed
+    print_info(f"起動から最初のリネームまで {elapsed:.2f}秒 (スナップショット: {startup_metrics['snapshot_entries'] if startup_metrics['snapshot_entries'] is not None else 'なし'})")
+
+def _read_state_snapshot(path):
+    if not os.path.exists(path): return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if not row or int(row[0]) not in (2, STATE_SNAPSHOT_VERSION): return None
+        vc_entries = {
+            original_id: {"guild_id": guild_id, "status_channel_id": status_channel_id, "original_channel_name": name}
+            for original_id, guild_id, status_channel_id, name in conn.execute("SELECT original_id, guild_id, status_channel_id, original_channel_name FROM vc_tracking")
+        }
+        summary_entries = dict(conn.execute("SELECT guild_id, summary_vc_id FROM summary_vc_tracking"))
+        group_entries = {
+            group_vc_id: parse_group_definition({"guild_id": guild_id, "kind": kind, "target": json.loads(target), "label": label})
+            for group_vc_id, guild_id, kind, target, label in conn.execute("SELECT group_vc_id, guild_id, kind, target, label FROM group_vc_tracking")
+        }
+        pending_writes = {
+            (collection, doc_id): None if data is None else json.loads(data)
+            for collection, doc_id, data in (conn.execute("SELECT collection, doc_id, data FROM firestore_pending") if int(row[0]) >= 3 else ())
+        }
+        return vc_entries, summary_entries, group_entries, pending_writes
+    finally:
+        conn.close()
+
+def _write_state_snapshot(path, vc_entries, summary_entries, group_entries, pending_writes=None):
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path): os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            conn.execute("CREATE TABLE vc_tracking (original_id INTEGER PRIMARY KEY, guild_id INTEGER, status_channel_id INTEGER, original_channel_name TEXT)")
+            conn.execute("CREATE TABLE summary_vc_tracking (guild_id INTEGER PRIMARY KEY, summary_vc_id INTEGER)")
+            conn.execute("CREATE TABLE group_vc_tracking (group_vc_id INTEGER PRIMARY KEY, guild_id INTEGER, kind TEXT, target TEXT, label TEXT)")
+            conn.execute("CREATE TABLE firestore_pending (collection TEXT, doc_id TEXT, data TEXT, PRIMARY KEY (collection, doc_id)) WITHOUT ROWID")
+            conn.execute("INSERT INTO meta VALUES ('version', ?)", (str(STATE_SNAPSHOT_VERSION),))
+            conn.executemany("INSERT INTO vc_tracking VALUES (?, ?, ?, ?)", [
+                (original_id, info["guild_id"], info["status_channel_id"], info["original_channel_name"]) for original_id, info in vc_entries.items()
+            ])
+            conn.executemany("INSERT INTO summary_vc_tracking VALUES (?, ?)", list(summary_entries.items()))
+            conn.executemany("INSERT INTO group_vc_tracking VALUES (?, ?, ?, ?, ?)", [
+                (group_vc_id, d["guild_id"], d["kind"], json.dumps(d["target"]), d["label"]) for group_vc_id, d in group_entries.items()
+            ])
+            conn.executemany("INSERT INTO firestore_pending VALUES (?, ?, ?)", [
+                (collection, doc_id, None if data is None else json.dumps(data)) for (collection, doc_id), data in (pending_writes or {}).items()
+            ])
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+async def load_state_snapshot():
+    if not STATE_SNAPSHOT_PATH: return False
+    try:
+        snapshot = await asyncio.to_thread(_read_state_snapshot, STATE_SNAPSHOT_PATH)
+    except Exception as e:
+        print_error(f"スナップショット読み込みエラー: {e}", exc_info=True); return False
+    if snapshot is None: return False
+    vc_entries, summary_entries, group_entries, pending_writes = snapshot
+    vc_tracking.update(vc_entries)
+    summary_vc_tracking.update(summary_entries)
+    group_vc_tracking.update(group_entries)
+    channel_index.rebuild_status_links(vc_tracking)
+    group_aggregator.reload_definitions()
+    startup_metrics["snapshot_entries"] = len(vc_entries) + len(summary_entries) + len(group_entries)
+    if pending_writes and HA_MODE: print_warning(f"HAモードのため、前回Firestoreに届かなかった書き込み {len(pending_writes)}件は送り直しません。")
+    elif pending_writes:
+        for (collection, doc_id), data in pending_writes.items():
+            if data is None: firestore_writer.delete(collection, doc_id)
+            else: firestore_writer.set(collection, doc_id, data)
+        print_warning(f"前回Firestoreに届かなかった書き込み {len(pending_writes)}件を送り直します。")
+    print_info(f"スナップショットから追跡VC {len(vc_entries)}件、サマリーVC {len(summary_entries)}件、集計グループ {len(group_entries)}件をロード。")
+    return True
+
+async def save_state_snapshot():
+    global state_snapshot_dirty, state_snapshot_has_pending
+    if not STATE_SNAPSHOT_PATH: return
+    state_snapshot_dirty = False
+    pending_writes = {key: data for key, data in firestore_writer.pending.items() if key[0] in TRACKING_FIRESTORE_COLLECTIONS}
+    state_snapshot_has_pending = bool(pending_writes)
     try:
-        await db.collection(SUMMARY_FIRESTORE_COLLECTION_NAME).document(str(guild_id)).delete()
-    except Exception as e: print_error(f"サマリーVCのFirestore削除エラー (Guild ID: {guild_id}): {e}", exc_info=True)
+        await asyncio.to_thread(_write_state_snapshot, STATE_SNAPSHOT_PATH, {k: dict(v) for k, v in vc_tracking.items()}, dict(summary_vc_tracking), {k: dict(v) for k, v in group_vc_tracking.items()}, pending_writes)
+    except Exception as e:
+        state_snapshot_dirty = True
+        print_error(f"スナップショット書き込みエラー: {e}", exc_info=True)
+
+def _apply_tracking_diff(target, fresh, collection_name, scheduler):
+    added = changed = removed = 0
+    for key, value in fresh.items():
+        if firestore_writer.has_pending(collection_name, key): continue # 未送信のローカル変更を優先
+        current = target.get(key)
+        if current == value: continue
+        if current is None: added += 1
+        else: changed += 1
+        target[key] = value
+    for key in [k for k in target if k not in fresh]:
+        if firestore_writer.has_pending(collection_name, key): continue
+        target.pop(key, None)
+        scheduler.cancel(key)
+        removed += 1
+    return added, changed, removed
+
+@profiled
+async def reconcile_tracking_with_firestore():
+    global firestore_load_state
+    if not await init_firestore():
+        firestore_load_state = "failed" if firestore_configured() else "disabled"
+        return not firestore_configured()
+    started = time.monotonic()
+    fresh_vc = await load_tracked_channels_from_db()
+    fresh_summary = await load_summary_vcs_from_db()
+    fresh_groups = await load_group_vcs_from_db()
+    metrics.observe("nekochan_firestore_call_seconds", time.monotonic() - started, op="load")
+    if fresh_vc is None or fresh_summary is None or fresh_groups is None:
+        firestore_load_state = "failed"
+        print_warning("Firestoreからのロードに失敗したため、スナップショットの状態で続行します。"); return False
+    firestore_load_state = "loaded"
+    vc_diff = _apply_tracking_diff(vc_tracking, fresh_vc, FIRESTORE_COLLECTION_NAME, vc_rename_scheduler)
+    summary_diff = _apply_tracking_diff(summary_vc_tracking, fresh_summary, SUMMARY_FIRESTORE_COLLECTION_NAME, summary_vc_rename_scheduler)
+    group_diff = _apply_tracking_diff(group_vc_tracking, fresh_groups, GROUP_FIRESTORE_COLLECTION_NAME, group_vc_rename_scheduler)
+    print_info(f"Firestoreと突き合わせ完了。追跡VC 追加/変更/削除: {vc_diff}, サマリーVC 追加/変更/削除: {summary_diff}, 集計グループ 追加/変更/削除: {group_diff}")
+    asyncio.create_task(load_occupancy_history_from_db(), name="history-load")
+    if any(vc_diff): channel_index.rebuild_status_links(vc_tracking)
+    if any(group_diff): group_aggregator.reload_definitions()
+    if any(vc_diff) or any(summary_diff) or any(group_diff):
+        mark_state_snapshot_dirty()
+        await refresh_all_status_channels()
+    return True
+
+async def _reconcile_until_loaded():
+    failures = 0
+    while not await reconcile_tracking_with_firestore():
+        failures += 1
+        delay = min(FIRESTORE_RECONCILE_RETRY_MAX_DELAY, FIRESTORE_RETRY_BASE_DELAY * 2 ** failures)
+        print_warning(f"Firestoreからのロードを{delay:.0f}秒後に再試行します (連続{failures}回失敗)。")
+        await asyncio.sleep(delay)
+
+def schedule_firestore_reconcile():
+    # 読み込みに成功するまで再試行する。既に走っていればそれに任せる
+    global firestore_reconcile_task
+    if firestore_reconcile_task is None or firestore_reconcile_task.done():
+        firestore_reconcile_task = asyncio.create_task(_reconcile_until_loaded(), name="firestore-reconcile")
+
+# --- Active/Standby Failover ---
+# --- アクティブ/スタンバイ構成 ---
+# HA_MODE=trueで同じシャード構成のインスタンスを2台以上起動し、Firestoreのリースを持つ1台だけがリネーム・コマンド応答・書き込みを行う。
+# スタンバイもゲートウェイに接続して人数インデックスを保ち、追跡情報はスナップショットリスナーで追いかけるので、リースを取ればすぐ引き継げる。
+# リースの期限は壁時計で判定する。保持側は更新を始めた時刻から LEASE_TTL_SECONDS - LEASE_SAFETY_MARGIN_SECONDS で自分から降りるので、
+# インスタンス間の時計のずれがマージン未満なら2台が同時にアクティブになることはない。
+HA_MODE = os.getenv("HA_MODE", "false").lower() == "true"
+LEASE_FIRESTORE_COLLECTION_NAME = "discord_bot_leases_prod_v1"
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "15"))
+LEASE_SAFETY_MARGIN_SECONDS = 3.0
+LEASE_RENEW_INTERVAL_SECONDS = LEASE_TTL_SECONDS / 3
+LEASE_POLL_INTERVAL_SECONDS = float(os.getenv("LEASE_POLL_INTERVAL_SECONDS", "2"))
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+def next_lease_record(record, holder, ttl, now):
+    # 取得/更新できるなら新しいレコードを、他が有効なリースを持っていればNoneを返す。epochは保持者が替わる度に増える
+    if record and record.get("holder") != holder and record.get("expires_at", 0) > now: return None
+    epoch = int(record.get("epoch", 0)) if record else 0
+    if not record or record.get("holder") != holder: epoch += 1
+    return {"holder": holder, "expires_at": now + ttl, "epoch": epoch}
+
+class MemoryLeaseStore:
+    # プロセス内のリース置き場。1つを複数のLeaderLeaseで共有すれば切り替えを試せる
+    def __init__(self): self.records = {}
+
+    async def acquire(self, name, holder, ttl, now):
+        new_record = next_lease_record(self.records.get(name), holder, ttl, now)
+        if new_record: self.records[name] = new_record
+        return dict(self.records[name])
+
+    async def release(self, name, holder):
+        record = self.records.get(name)
+        if record and record["holder"] == holder: record["expires_at"] = 0
+
+class FirestoreLeaseStore:
+    # 読み取りと書き込みをトランザクションで行うので、同時に取りに来ても保持者は1台に決まる
+    def __init__(self, client_getter): self.client_getter = client_getter
+
+    async def _transact(self, name, update):
+        if self.client_getter() is None and not await init_firestore(): raise RuntimeError("Firestore未接続")
+        client = self.client_getter()
+        doc_ref = client.collection(LEASE_FIRESTORE_COLLECTION_NAME).document(name)
+
+        @firestore.async_transactional
+        async def run(transaction):
+            snapshot = await doc_ref.get(transaction=transaction)
+            record = snapshot.to_dict() if snapshot.exists else None
+            new_record = update(record)
+            if new_record: transaction.set(doc_ref, new_record)
+            return new_record or record
+        return await run(client.transaction())
+
+    async def acquire(self, name, holder, ttl, now):
+        return await self._transact(name, lambda record: next_lease_record(record, holder, ttl, now))
+
+    async def release(self, name, holder):
+        await self._transact(name, lambda record: {**record, "expires_at": 0} if record and record.get("holder") == holder else None)
+
+class LeaderLease:
+    def __init__(self, name, holder, enabled, on_change=None):
+        self.name = name
+        self.holder = holder
+        self.enabled = enabled # Falseなら常にアクティブ(従来の単独構成)
+        self.on_change = on_change
+        self.store = None
+        self.held = False
+        self.valid_until = 0.0 # monotonic。更新できないままこの時刻を過ぎたらアクティブではない
+        self.current_holder = None
+        self.epoch = 0
+        self.task = None
+
+    @property
+    def active(self): return not self.enabled or (self.held and time.monotonic() < self.valid_until)
+
+    def role(self): return "single" if not self.enabled else ("active" if self.active else "standby")
+
+    def start(self, store):
+        self.store = store
+        if self.task is None or self.task.done(): self.task = asyncio.create_task(self._run(), name="leader-lease")
+
+    def _set_held(self, held, reason):
+        self.held = held
+        metrics.inc("nekochan_lease_transitions_total", role="active" if held else "standby")
+        message = f"{'アクティブになりました' if held else 'スタンバイになりました'}: {reason} (インスタンス: {self.holder}, リース保持者: {self.current_holder}, epoch: {self.epoch})"
+        if held: print_info(message)
+        else: print_warning(message)
+        if self.on_change: self.on_change(held)
+
+    async def step(self):
+        started = time.monotonic()
+        try:
+            record = await asyncio.wait_for(self.store.acquire(self.name, self.holder, LEASE_TTL_SECONDS, time.time()), timeout=LEASE_RENEW_INTERVAL_SECONDS)
+        except Exception as e:
+            metrics.inc("nekochan_lease_errors_total")
+            print_warning(f"リースの取得/更新に失敗: {e}")
+            if self.held and time.monotonic() >= self.valid_until: self._set_held(False, "期限内にリースを更新できなかった")
+            return
+        metrics.observe("nekochan_firestore_call_seconds", time.monotonic() - started, op="lease")
+        self.current_holder, self.epoch = record["holder"], record["epoch"]
+        held = record["holder"] == self.holder
+        if held: self.valid_until = started + LEASE_TTL_SECONDS - LEASE_SAFETY_MARGIN_SECONDS
+        if held != self.held: self._set_held(held, "リースを取得" if held else "他のインスタンスがリースを取得")
+
+    async def _run(self):
+        while True:
+            await self.step()
+            delay = LEASE_RENEW_INTERVAL_SECONDS if self.held else LEASE_POLL_INTERVAL_SECONDS
+            if self.held: delay = max(0.0, min(delay, self.valid_until - time.monotonic())) # 期限切れ前に必ずもう一度更新を試す
+            await asyncio.sleep(delay)
+
+    async def release(self):
+        # 終了時にリースを手放し、スタンバイが期限切れを待たずに引き継げるようにする
+        if self.task and not self.task.done(): self.task.cancel()
+        if not self.held: return
+        self.held = False
+        try:
+            await asyncio.wait_for(self.store.release(self.name, self.holder), timeout=LEASE_RENEW_INTERVAL_SECONDS)
+            print_info("リースを解放しました。")
+        except Exception as e: print_warning(f"リースの解放に失敗 (期限切れで引き継がれます): {e}")
+
+class TrackingMirror:
+    # スタンバイ中、Firestoreのスナップショットリスナーで追跡情報を追いかける。
+    # コールバックはリスナーのスレッドから来るので、変更をまとめてイベントループに渡してから反映する。
+    def __init__(self):
+        self.loop = None
+        self.client = None
+        self.watches = []
+        self.targets = {}
+
+    def start(self, client):
+        self.loop = asyncio.get_running_loop()
+        self.client = client
+        self.targets = {
+            FIRESTORE_COLLECTION_NAME: (vc_tracking, vc_rename_scheduler, parse_tracked_vc_doc),
+            SUMMARY_FIRESTORE_COLLECTION_NAME: (summary_vc_tracking, summary_vc_rename_scheduler, parse_summary_vc_doc),
+            GROUP_FIRESTORE_COLLECTION_NAME: (group_vc_tracking, group_vc_rename_scheduler, parse_group_vc_doc),
+        }
+        for collection in self.targets:
+            self.watches.append(client.collection(collection).on_snapshot(functools.partial(self._on_snapshot, collection)))
+
+    def stop(self):
+        for watch in self.watches: watch.unsubscribe()
+        self.watches.clear()
+
+    def _on_snapshot(self, collection, docs, changes, read_time):
+        batch = [(change.document.id, None if change.type.name == "REMOVED" else change.document.to_dict()) for change in changes]
+        if batch: self.loop.call_soon_threadsafe(self.apply, collection, batch)
+
+    def apply(self, collection, batch):
+        if leader_lease.active: return # アクティブ側はローカルの状態が正。降格時にFirestoreと突き合わせ直す
+        target, scheduler, parse = self.targets[collection]
+        changed = 0
+        for doc_id, doc_data in batch:
+            try:
+                if doc_data is None:
+                    key = int(doc_id)
+                    if target.pop(key, None) is None: continue
+                    scheduler.cancel(key)
+                else:
+                    key, guild_id, value = parse(doc_id, doc_data)
+                    if not owns_guild(guild_id) or target.get(key) == value: continue
+                    target[key] = value
+                changed += 1
+            except (ValueError, TypeError, KeyError):
+                print_warning(f"スナップショットの解析エラー ({collection}/{doc_id})。スキップ。")
+        if not changed: return
+        metrics.inc("nekochan_mirror_changes_total", changed, collection=collection)
+        if target is vc_tracking: channel_index.rebuild_status_links(vc_tracking)
+        if target is group_vc_tracking: group_aggregator.reload_definitions()
+        mark_state_snapshot_dirty()
+        print_debug("スナップショットリスナーから%d件反映 (%s)", changed, collection)
+
+def is_active_instance(): return leader_lease.active
+
+def handle_lease_change(active):
+    if active:
+        # スタンバイ中に溜まった表示のずれをまとめて直す。リスナーが動いていなければ先にFirestoreから読み直す
+        if tracking_mirror.watches: asyncio.create_task(refresh_all_status_channels(), name="takeover-refresh")
+        else: schedule_firestore_reconcile()
+    else:
+        for scheduler in (vc_rename_scheduler, summary_vc_rename_scheduler, group_vc_rename_scheduler): scheduler.cancel_all()
+        schedule_firestore_reconcile() # アクティブ中はリスナーの変更を無視していた
+
+async def start_high_availability():
+    if not HA_MODE: return
+    if not firestore_configured():
+        leader_lease.enabled = False
+        print_warning("HA_MODEにはFirestoreが必要です。単独インスタンスとして動作します。"); return
+    print_info(f"HAモード: インスタンス {INSTANCE_ID} がスタンバイとして起動。リース: {leader_lease.name}")
+    leader_lease.start(FirestoreLeaseStore(lambda: db))
+    if not await init_firestore(): return
+    try:
+        tracking_mirror.start(await asyncio.to_thread(firestore.Client)) # on_snapshotは同期クライアントにしかない
+    except Exception as e: print_error(f"スナップショットリスナーの開始に失敗: {e}", exc_info=True)
+
+leader_lease = LeaderLease(f"nekochanbot-{shard_label()}", INSTANCE_ID, enabled=HA_MODE, on_change=handle_lease_change)
+tracking_mirror = TrackingMirror()
+
+# --- Outbound REST Dispatcher ---
+# --- Discord REST呼び出しの優先度付きディスパッチャ ---
+# コマンド応答 > チャンネル作成/削除 > リネーム > 一括削除の順で、全体の同時実行数と毎秒の呼び出し数を共有する。
+# リネームと一括削除は合わせて同時実行枠を1つ以上残し、どちらもタイムアウト付きで送るので、背景処理が詰まってもコマンド応答は待たされない。
+LANE_INTERACTIVE = 0
+LANE_CHANNEL_ADMIN = 1
+LANE_RENAME = 2
+LANE_PURGE = 3
+REST_LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_CHANNEL_ADMIN: "channel_admin", LANE_RENAME: "rename", LANE_PURGE: "purge"}
+REST_BACKGROUND_LANES = (LANE_RENAME, LANE_PURGE)
+REST_MAX_CONCURRENCY = int(os.getenv("REST_MAX_CONCURRENCY", "4"))
+REST_GLOBAL_RATE_PER_SECOND = float(os.getenv("REST_GLOBAL_RATE_PER_SECOND", "40")) # Discordのグローバル上限は50/秒
+REST_BACKGROUND_MAX_IN_FLIGHT = max(1, REST_MAX_CONCURRENCY - 1) # 背景レーンの合計
+
+class RestDispatcher:
+    def __init__(self):
+        self.queues = {lane: collections.deque() for lane in REST_LANE_NAMES}
+        self.lane_in_flight = {lane: 0 for lane in REST_LANE_NAMES}
+        self.lane_stats = {lane: {"submitted": 0, "started": 0, "wait_total": 0.0, "wait_max": 0.0} for lane in REST_LANE_NAMES}
+        self.in_flight = 0
+        self.background_in_flight = 0
+        self.tokens = REST_GLOBAL_RATE_PER_SECOND
+        self.last_refill = time.monotonic()
+        self.wakeup = asyncio.Event()
+        self.runner = None
+
+    async def submit(self, lane, call_factory, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        self.queues[lane].append((time.monotonic(), call_factory, timeout, future))
+        self.lane_stats[lane]["submitted"] += 1
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.create_task(self._run(), name="rest-dispatcher")
+        self.wakeup.set()
+        return await future
+
+    def get_lane_stats(self):
+        stats = {}
+        for lane, name in REST_LANE_NAMES.items():
+            lane_stats = self.lane_stats[lane]
+            oldest = self.queues[lane][0][0] if self.queues[lane] else None
+            stats[name] = {
+                "depth": len(self.queues[lane]),
+                "in_flight": self.lane_in_flight[lane],
+                "oldest_wait": round(time.monotonic() - oldest, 3) if oldest else 0.0,
+                "avg_wait": round(lane_stats["wait_total"] / lane_stats["started"], 3) if lane_stats["started"] else 0.0,
+                "max_wait": round(lane_stats["wait_max"], 3),
+                "submitted": lane_stats["submitted"],
+            }
+        return stats
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(REST_GLOBAL_RATE_PER_SECOND, self.tokens + (now - self.last_refill) * REST_GLOBAL_RATE_PER_SECOND)
+        self.last_refill = now
+
+    def _next_job(self):
+        for lane, lane_queue in self.queues.items():
+            while lane_queue and lane_queue[0][3].done(): lane_queue.popleft() # 呼び出し元がキャンセル済み
+            if not lane_queue: continue
+            if lane in REST_BACKGROUND_LANES and self.background_in_flight >= REST_BACKGROUND_MAX_IN_FLIGHT: continue
+            return lane, lane_queue.popleft()
+        return None
+
+    async def _run(self):
+        while True:
+            self._refill()
+            job = self._next_job() if self.in_flight < REST_MAX_CONCURRENCY and self.tokens >= 1 else None
+            if job is None:
+                self.wakeup.clear()
+                token_wait = (1 - self.tokens) / REST_GLOBAL_RATE_PER_SECOND if self.tokens < 1 and any(self.queues.values()) else None
+                try: await asyncio.wait_for(self.wakeup.wait(), timeout=token_wait)
+                except asyncio.TimeoutError: pass
+                continue
+            lane, (enqueued_at, call_factory, timeout, future) = job
+            waited = time.monotonic() - enqueued_at
+            lane_stats = self.lane_stats[lane]
+            lane_stats["started"] += 1
+            lane_stats["wait_total"] += waited
+            lane_stats["wait_max"] = max(lane_stats["wait_max"], waited)
+            self.tokens -= 1
+            self.in_flight += 1
+            self.lane_in_flight[lane] += 1
+            if lane in REST_BACKGROUND_LANES: self.background_in_flight += 1
+            task = asyncio.create_task(self._execute(lane, call_factory, timeout, future))
+            future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+
+    async def _execute(self, lane, call_factory, timeout, future):
+        try:
+            result = await asyncio.wait_for(call_factory(), timeout=timeout) if timeout else await call_factory()
+            if not future.done(): future.set_result(result)
+        except asyncio.CancelledError:
+            if not future.done(): future.cancel()
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self.lane_in_flight[lane] -= 1
+            if lane in REST_BACKGROUND_LANES: self.background_in_flight -= 1
+            self.wakeup.set()
+
+rest_dispatcher = RestDispatcher()
+
+async def send_interactive(target, *args, **kwargs):
+    return await rest_dispatcher.submit(LANE_INTERACTIVE, lambda: target.send(*args, **kwargs))
+
+async def run_channel_admin(call_factory):
+    return await rest_dispatcher.submit(LANE_CHANNEL_ADMIN, call_factory)
+
+# スラッシュコマンドは3秒以内に応答が必要なので、チャンネル作成などの前に必ずdeferしてからフォローアップで返す
+async def defer_interaction(interaction):
+    await rest_dispatcher.submit(LANE_INTERACTIVE, lambda: interaction.response.defer(ephemeral=True, thinking=True))
+
+class InteractionFeedback:
+    # ctx.send と同じ呼び方でinteraction.followupへ送る。followup.sendにはdelete_afterが無いので送信後に削除を予約する
+    # 何も送らずに終わった場合(二重実行の抑止など)は「考え中」の表示が残らないように消す
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.sent = False
+
+    async def send(self, content=None, *, delete_after=None, **kwargs):
+        message = await self.interaction.followup.send(content, ephemeral=True, wait=True, **kwargs)
+        self.sent = True
+        if delete_after is not None: await message.delete(delay=delete_after)
+        return message
+
+    async def finish(self):
+        if not self.sent: await rest_dispatcher.submit(LANE_INTERACTIVE, self.interaction.delete_original_response)
+
+def voice_channel_choice_label(vc):
+    label = f"{vc.name} ({vc.category.name})" if vc.category else vc.name
+    return label[:100] # Choiceの表示名は100文字まで
+
+# --- Channel Index ---
+# --- チャンネル索引 ---
+# サーバー毎にSTATUSカテゴリIDと、正規化したVC名→チャンネルIDを持ち、チャンネル作成/更新/削除イベントで差分更新する。
+# 未登録のサーバーは初回参照時にキャッシュから構築し、再接続時はイベントの取りこぼしに備えて破棄する。
+# 人数表示用VC→元VCの逆引きはvc_trackingの変更に合わせて更新する。
+# オートコンプリート用に、名前のソート済みリスト(前方一致)と3文字単位の転置索引(部分一致・あいまい一致)も持つ。
+AUTOCOMPLETE_MAX_CHOICES = 25 # Discordの上限
+AUTOCOMPLETE_MIN_TRIGRAM_OVERLAP = 0.5
+
+def normalize_channel_name(name): return name.strip().lower()
+
+def name_trigrams(name): return {name[i:i + 3] for i in range(len(name) - 2)}
+
+def is_status_category_name(name): return STATUS_CATEGORY_NAME.lower() in name.lower()
+
+def _first_by_position(channels):
+    channels = [c for c in channels if c]
+    return min(channels, key=lambda c: (c.position, c.id)) if channels else None
+
+class ChannelIndex:
+    def __init__(self):
+        self.status_categories = {} # guild_id -> STATUSカテゴリIDの集合
+        self.voice_names = {} # guild_id -> {正規化名: channel_idの集合}
+        self.channel_names = {} # channel_id -> 登録中の正規化名 (改名時に古いキーを外すため)
+        self.sorted_names = {} # guild_id -> 正規化名のソート済みリスト
+        self.trigrams = {} # guild_id -> {3文字: 正規化名の集合}
+        self.status_to_original = {} # status_channel_id -> original_channel_id
+
+    def rebuild_guild(self, guild):
+        self.drop_guild(guild.id)
+        self.status_categories[guild.id] = {c.id for c in guild.categories if is_status_category_name(c.name)}
+        self.voice_names[guild.id] = {}
+        self.sorted_names[guild.id] = []
+        self.trigrams[guild.id] = {}
+        for vc in guild.voice_channels: self._add_voice(guild.id, vc)
+
+    def ensure_guild(self, guild):
+        if guild.id not in self.status_categories: self.rebuild_guild(guild)
+
+    def drop_guild(self, guild_id):
+        self.status_categories.pop(guild_id, None)
+        self.sorted_names.pop(guild_id, None)
+        self.trigrams.pop(guild_id, None)
+        for ids in self.voice_names.pop(guild_id, {}).values():
+            for cid in ids: self.channel_names.pop(cid, None)
+
+    def drop_all_guilds(self):
+        for guild_id in list(self.status_categories): self.drop_guild(guild_id)
+
+    def _add_voice(self, guild_id, vc):
+        name = normalize_channel_name(vc.name)
+        names = self.voice_names[guild_id]
+        if name not in names:
+            names[name] = set()
+            bisect.insort(self.sorted_names[guild_id], name)
+            for gram in name_trigrams(name): self.trigrams[guild_id].setdefault(gram, set()).add(name)
+        names[name].add(vc.id)
+        self.channel_names[vc.id] = name
+
+    def _remove_voice(self, guild_id, channel_id):
+        name = self.channel_names.pop(channel_id, None)
+        ids = self.voice_names[guild_id].get(name)
+        if ids is None: return
+        ids.discard(channel_id)
+        if ids: return
+        del self.voice_names[guild_id][name]
+        sorted_names = self.sorted_names[guild_id]
+        del sorted_names[bisect.bisect_left(sorted_names, name)]
+        grams = self.trigrams[guild_id]
+        for gram in name_trigrams(name):
+            grams[gram].discard(name)
+            if not grams[gram]: del grams[gram]
+
+    def apply_channel_upsert(self, channel):
+        # STATUSカテゴリの集合が変わったらTrueを返す
+        guild_id = channel.guild.id
+        if guild_id not in self.status_categories: return False # 未登録サーバーは参照時にキャッシュから構築する
+        if isinstance(channel, discord.CategoryChannel):
+            ids = self.status_categories[guild_id]
+            was_status = channel.id in ids
+            if is_status_category_name(channel.name): ids.add(channel.id)
+            else: ids.discard(channel.id)
+            return was_status != (channel.id in ids)
+        if isinstance(channel, discord.VoiceChannel):
+            self._remove_voice(guild_id, channel.id)
+            self._add_voice(guild_id, channel)
+        return False
+
+    def apply_channel_delete(self, channel):
+        guild_id = channel.guild.id
+        if guild_id not in self.status_categories: return False
+        if channel.id in self.status_categories[guild_id]:
+            self.status_categories[guild_id].discard(channel.id); return True
+        self._remove_voice(guild_id, channel.id)
+        return False
+
+    def status_category_ids(self, guild):
+        self.ensure_guild(guild)
+        return self.status_categories[guild.id]
+
+    def find_status_category(self, guild):
+        return _first_by_position(map(guild.get_channel, self.status_category_ids(guild)))
+
+    def find_voice_channel(self, guild, query):
+        # 完全一致(大文字小文字無視)を優先し、無ければ部分一致。複数あれば並び順で先頭のものを返す
+        self.ensure_guild(guild)
+        names = self.voice_names[guild.id]
+        query = normalize_channel_name(query)
+        ids = names.get(query) or [cid for name, cids in names.items() if query in name for cid in cids]
+        return _first_by_position(map(guild.get_channel, ids))
+
+    def _rank_names(self, guild_id, query, limit):
+        # 完全一致 > 前方一致 > 部分一致 > 3文字単位の重なりが多い順
+        sorted_names = self.sorted_names[guild_id]
+        if not query: return sorted_names[:limit]
+        ranked = [query] if query in self.voice_names[guild_id] else []
+        for name in sorted_names[bisect.bisect_left(sorted_names, query):]:
+            if len(ranked) >= limit or not name.startswith(query): break
+            if name != query: ranked.append(name)
+        if len(ranked) >= limit: return ranked
+        seen = set(ranked)
+        grams = self.trigrams[guild_id]
+        query_grams = name_trigrams(query)
+        if not query_grams: # 3文字未満は索引が使えないので名前を走査する (件数の上限で打ち切る)
+            for name in sorted_names:
+                if len(ranked) >= limit: break
+                if query in name and name not in seen: ranked.append(name)
+            return ranked
+        overlap = collections.Counter(name for gram in query_grams for name in grams.get(gram, ()) if name not in seen)
+        substring = sorted(name for name, hits in overlap.items() if hits == len(query_grams) and query in name)
+        ranked.extend(substring[:limit - len(ranked)])
+        seen.update(substring)
+        min_hits = math.ceil(len(query_grams) * AUTOCOMPLETE_MIN_TRIGRAM_OVERLAP)
+        fuzzy = sorted((-hits, name) for name, hits in overlap.items() if hits >= min_hits and name not in seen)
+        ranked.extend(name for _, name in fuzzy[:limit - len(ranked)])
+        return ranked
+
+    def suggest_voice_channels(self, guild, query, limit=AUTOCOMPLETE_MAX_CHOICES):
+        # STATUSカテゴリ内(人数表示用VC)は候補から外す
+        self.ensure_guild(guild)
+        status_ids = self.status_categories[guild.id]
+        suggestions = []
+        for name in self._rank_names(guild.id, normalize_channel_name(query), limit * 2):
+            channels = sorted((c for c in map(guild.get_channel, self.voice_names[guild.id][name]) if c and c.category_id not in status_ids), key=lambda c: (c.position, c.id))
+            suggestions.extend(channels)
+            if len(suggestions) >= limit: break
+        return suggestions[:limit]
+
+    def link_status(self, status_channel_id, original_channel_id): self.status_to_original[status_channel_id] = original_channel_id
+
+    def unlink_status(self, status_channel_id): self.status_to_original.pop(status_channel_id, None)
+
+    def rebuild_status_links(self, tracking):
+        self.status_to_original = {info["status_channel_id"]: ocid for ocid, info in tracking.items()}
+
+    def original_for_status(self, status_channel_id): return self.status_to_original.get(status_channel_id)
+
+channel_index = ChannelIndex()
+
+def is_in_status_category(channel):
+    return channel.category_id in channel_index.status_category_ids(channel.guild)
 
 # --- Core Logic Functions ---
 async def get_or_create_status_category(guild: discord.Guild):
-    for category in guild.categories:
-        if STATUS_CATEGORY_NAME.lower() in category.name.lower():
-            return category
+    category = channel_index.find_status_category(guild)
+    if category: return category
     try:
         overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=False)}
-        return await guild.create_category(STATUS_CATEGORY_NAME, overwrites=overwrites)
+        category = await run_channel_admin(lambda: guild.create_category(STATUS_CATEGORY_NAME, overwrites=overwrites))
+        channel_index.apply_channel_upsert(category) # 作成イベントの到着前に続けて呼ばれても二重作成しない
+        return category
     except Exception as e:
         print_error(f"カテゴリ「{STATUS_CATEGORY_NAME}」作成中エラー: {e}", exc_info=True)
         return None
 
+# --- Rename Scheduler ---
+# --- チャンネル名変更スケジューラ ---
+# Discordのチャンネル名変更はチャンネル毎に約10分で2回まで。チャンネル毎に最新の希望名だけを保持し、
+# トークンバケットで許される分だけ送信する。待機中に届いた更新は上書きされ、最後の値が必ず反映される。
+RENAME_BUCKET_CAPACITY = 2
+RENAME_BUCKET_WINDOW = timedelta(minutes=10)
+RENAME_TIMEOUT_COOLDOWN = timedelta(minutes=5)
+
+class RenameScheduler:
+    def __init__(self, label, cooldown_until):
+        self.label = label
+        self.cooldown_until = cooldown_until # key -> datetime。この時刻まではAPIを呼ばない
+        self.pending = {} # key -> (channel, new_name, reason)
+        self.buckets = {} # key -> (tokens, last_refill)
+        self.workers = {} # key -> asyncio.Task
+        self.sending = {} # key -> 送信中の名前(まだchannel.nameに反映されていない)
+        self.applied = {} # key -> 送信済みの名前。edit()はキャッシュを更新しないので、CHANNEL_UPDATEが届くまではこちらが正
+        self.refill_rate = RENAME_BUCKET_CAPACITY / RENAME_BUCKET_WINDOW.total_seconds()
+
+    def _last_known_name(self, key, channel):
+        if key in self.sending: return self.sending[key]
+        applied = self.applied.get(key)
+        if applied is None: return channel.name
+        if channel.name == applied: self.applied.pop(key) # キャッシュが追いついた
+        return applied
+
+    def _expected_name(self, key, channel):
+        if key in self.pending: return self.pending[key][1]
+        return self._last_known_name(key, channel)
+
+    def is_dirty(self, key, channel, new_name):
+        return self._expected_name(key, channel) != new_name
+
+    def request(self, key, channel, new_name, reason):
+        if not is_active_instance(): return # スタンバイはリネームしない
+        if self._expected_name(key, channel) == new_name and key not in self.pending: return
+        self.pending[key] = (channel, new_name, reason)
+        self._ensure_worker(key)
+
+    async def apply_now(self, key, channel, new_name, reason):
+        # 定期更新用。すぐ送れるならその場で送り、待ちが必要ならワーカーに任せて "deferred" を返す
+        worker = self.workers.get(key)
+        if (worker and not worker.done()) or self._seconds_until_allowed(key, datetime.now(timezone.utc)) > 0:
+            self.request(key, channel, new_name, reason)
+            return "deferred"
+        if self._expected_name(key, channel) == new_name: return "skipped"
+        return await self._send(key, channel, new_name, reason)
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+        self.buckets.pop(key, None)
+        self.cooldown_until.pop(key, None)
+        self.sending.pop(key, None)
+        self.applied.pop(key, None)
+        worker = self.workers.pop(key, None)
+        if worker and not worker.done(): worker.cancel()
+
+    def cancel_all(self):
+        for key in set(self.pending) | set(self.workers): self.cancel(key)
+
+    def _ensure_worker(self, key):
+        worker = self.workers.get(key)
+        if worker is None or worker.done():
+            self.workers[key] = asyncio.create_task(self._run(key), name=f"rename-{self.label}-{key}")
+
+    def _requeue(self, key, channel, new_name, reason):
+        self.pending.setdefault(key, (channel, new_name, reason))
+        self._ensure_worker(key)
+
+    def _seconds_until_allowed(self, key, now):
+        wait = 0.0
+        cooldown = self.cooldown_until.get(key)
+        if cooldown:
+            if cooldown > now: wait = (cooldown - now).total_seconds()
+            else: self.cooldown_until.pop(key, None)
+        tokens, last = self.buckets.get(key, (float(RENAME_BUCKET_CAPACITY), now))
+        tokens = min(float(RENAME_BUCKET_CAPACITY), tokens + (now - last).total_seconds() * self.refill_rate)
+        self.buckets[key] = (tokens, now)
+        if tokens < 1:
+            token_wait = (1 - tokens) / self.refill_rate
+            if token_wait > wait:
+                wait = token_wait
+                self.cooldown_until[key] = now + timedelta(seconds=wait)
+        return wait
+
+    async def _send(self, key, channel, new_name, reason):
+        if not is_active_instance():
+            self.pending.pop(key, None); return "skipped"
+        result = await self._send_once(key, channel, new_name, reason)
+        metrics.inc("nekochan_renames_total", kind=self.label, result=result)
+        return result
+
+    async def _send_once(self, key, channel, new_name, reason):
+        tokens, last = self.buckets[key]
+        self.buckets[key] = (tokens - 1, last)
+        started = time.monotonic()
+        self.sending[key] = new_name
+        try:
+            await rest_dispatcher.submit(LANE_RENAME, lambda: channel.edit(name=new_name, reason=reason), timeout=API_CALL_TIMEOUT)
+            metrics.observe("nekochan_rename_latency_seconds", time.monotonic() - started, kind=self.label)
+            self.applied[key] = new_name
+            note_first_rename()
+            return "renamed"
+        except asyncio.TimeoutError:
+            # discord.py内部のレート制限待ちで詰まった可能性が高い。しばらく休んで最新値を再送する
+            print_warning(f"リネームタイムアウト ({self.label} {key})。{RENAME_TIMEOUT_COOLDOWN}後に再試行。", guild_id=channel.guild.id, channel_id=channel.id)
+            self.cooldown_until[key] = datetime.now(timezone.utc) + RENAME_TIMEOUT_COOLDOWN
+            self._requeue(key, channel, new_name, reason)
+            return "deferred"
+        except discord.NotFound:
+            self.pending.pop(key, None)
+            return "failed"
+        except discord.HTTPException as e:
+            if e.status != 429:
+                print_error(f"リネームAPIエラー ({self.label} {key}): {e}", guild_id=channel.guild.id, channel_id=channel.id)
+                return "failed"
+            metrics.inc("nekochan_discord_429_total", source="rename")
+            retry_after = getattr(e, "retry_after", None) or RENAME_TIMEOUT_COOLDOWN.total_seconds()
+            print_warning(f"リネームがレート制限 ({self.label} {key})。{retry_after:.0f}秒後に再試行。", guild_id=channel.guild.id, channel_id=channel.id)
+            self.cooldown_until[key] = datetime.now(timezone.utc) + timedelta(seconds=retry_after)
+            self._requeue(key, channel, new_name, reason)
+            return "deferred"
+        finally:
+            self.sending.pop(key, None)
+
+    async def _run(self, key):
+        try:
+            while key in self.pending:
+                now = datetime.now(timezone.utc)
+                wait = self._seconds_until_allowed(key, now)
+                if wait > 0:
+                    print_debug("リネーム待機 (%s %s): %.1f秒", self.label, key, wait)
+                    await asyncio.sleep(wait)
+                    continue
+                channel, new_name, reason = self.pending.pop(key)
+                if self._last_known_name(key, channel) == new_name: continue
+                await self._send(key, channel, new_name, reason)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print_error(f"リネーム処理エラー ({self.label} {key}): {e}", exc_info=True)
+        finally:
+            if self.workers.get(key) is asyncio.current_task(): self.workers.pop(key, None)
+
+vc_rename_scheduler = RenameScheduler("vc", vc_discord_api_cooldown_until)
+summary_vc_rename_scheduler = RenameScheduler("summary", summary_vc_api_cooldown_until)
+group_vc_rename_scheduler = RenameScheduler("group", group_vc_api_cooldown_until)
+
+# --- Voice Occupancy Index ---
+# --- VC接続人数インデックス ---
+# チャンネル毎・サーバー毎の非Bot接続人数をon_voice_state_updateの差分で更新する。
+# 未登録のサーバーは初回参照時にキャッシュから数え直し、定期的にキャッシュと突き合わせる。
+OCCUPANCY_RECONCILE_INTERVAL_MINUTES = 10
+
+class OccupancyIndex:
+    def __init__(self):
+        self.channel_counts = {} # channel_id -> 非Botメンバー数
+        self.guild_totals = {} # guild_id -> STATUSカテゴリ外VCの合計人数
+        self.guild_channels = {} # guild_id -> 人数を持つchannel_idの集合
+
+    def rebuild_guild(self, guild):
+        previous = {cid: self.channel_counts.get(cid, 0) for cid in self.guild_channels.get(guild.id, ())}
+        previous_total = self.guild_totals.get(guild.id)
+        for cid in self.guild_channels.pop(guild.id, ()): self.channel_counts.pop(cid, None)
+        channels, total = set(), 0
+        for vc in guild.voice_channels:
+            count = len([m for m in vc.members if not m.bot])
+            if not count: continue
+            self.channel_counts[vc.id] = count
+            channels.add(vc.id)
+            if not is_in_status_category(vc): total += count
+        self.guild_channels[guild.id] = channels
+        self.guild_totals[guild.id] = total
+        current = {cid: self.channel_counts[cid] for cid in channels}
+        changed = {cid for cid in previous.keys() | current.keys() if previous.get(cid, 0) != current.get(cid, 0)}
+        return changed, previous_total is not None and previous_total != total
+
+    def ensure_guild(self, guild):
+        if guild.id not in self.guild_totals: self.rebuild_guild(guild)
+
+    def drop_guild(self, guild_id):
+        for cid in self.guild_channels.pop(guild_id, ()): self.channel_counts.pop(cid, None)
+        self.guild_totals.pop(guild_id, None)
+
+    def _adjust(self, guild_id, channel, delta):
+        count = self.channel_counts.get(channel.id, 0) + delta
+        if count > 0:
+            self.channel_counts[channel.id] = count
+            self.guild_channels[guild_id].add(channel.id)
+        else:
+            self.channel_counts.pop(channel.id, None)
+            self.guild_channels[guild_id].discard(channel.id)
+        if not is_in_status_category(channel):
+            self.guild_totals[guild_id] = max(0, self.guild_totals[guild_id] + delta)
+
+    def apply_voice_state_delta(self, guild, before_channel, after_channel):
+        if guild.id not in self.guild_totals: return # 未登録サーバーは参照時にキャッシュから構築する
+        # rebuild_guildと同じくguild.voice_channelsだけを数える (ステージチャンネルは対象外)
+        if not isinstance(before_channel, discord.VoiceChannel): before_channel = None
+        if not isinstance(after_channel, discord.VoiceChannel): after_channel = None
+        if before_channel and after_channel and before_channel.id == after_channel.id: return
+        if before_channel: self._adjust(guild.id, before_channel, -1)
+        if after_channel: self._adjust(guild.id, after_channel, 1)
+
+    def channel_count(self, channel):
+        self.ensure_guild(channel.guild)
+        return self.channel_counts.get(channel.id, 0)
+
+    def guild_total(self, guild):
+        self.ensure_guild(guild)
+        return self.guild_totals[guild.id]
+
+occupancy_index = OccupancyIndex()
+
+# --- Occupancy History ---
+# --- VC人数の履歴 ---
+# 追跡中VCとサマリーVCのあるサーバーの人数を、解像度の違う固定長リングバッファ(5分×24時間, 1時間×14日, 1日×400日)へ
+# 同時に積算する(書き込み時のダウンサンプリング)。各バケットは最大人数(uint16)と人数×秒(uint32)だけを持つので、
+# 系列あたりのメモリは期間によらず一定。変更のあった系列だけを定期的にzlib圧縮してFirestoreへ書き出す。
+HISTORY_FIRESTORE_COLLECTION_NAME = "discord_occupancy_history_prod_v1"
+HISTORY_LEVELS = ((300, 288), (3600, 336), (86400, 400)) # (バケット秒数, バケット数)
+HISTORY_FORMAT_VERSION = 1
+HISTORY_PERSIST_INTERVAL_MINUTES = 10
+HISTORY_MAX_VALUE = 0xFFFF
+HISTORY_MAX_AREA = 0xFFFFFFFF
+
+class OccupancySeries:
+    __slots__ = ("heads", "peaks", "areas", "value", "created_at", "updated_at", "dirty")
+
+    def __init__(self, now):
+        self.heads = [now // size for size, _ in HISTORY_LEVELS] # 解像度毎の最新の絶対バケット番号
+        self.peaks = [array.array("H", bytes(2 * slots)) for _, slots in HISTORY_LEVELS]
+        self.areas = [array.array("I", bytes(4 * slots)) for _, slots in HISTORY_LEVELS]
+        self.value = 0
+        self.created_at = now
+        self.updated_at = now
+        self.dirty = False
+
+    def _advance(self, level, bucket):
+        head = self.heads[level]
+        if bucket <= head: return
+        slots = HISTORY_LEVELS[level][1]
+        peaks, areas = self.peaks[level], self.areas[level]
+        for b in range(head + 1, min(bucket, head + slots) + 1): # 飛ばしたバケットを空にする (一周以上空いたら全部)
+            peaks[b % slots] = 0; areas[b % slots] = 0
+        self.heads[level] = bucket
+
+    def _accumulate(self, start, end):
+        # [start, end) の間 self.value 人だったことを各解像度に積算する
+        value = self.value
+        for level, (size, slots) in enumerate(HISTORY_LEVELS):
+            if value:
+                peaks, areas = self.peaks[level], self.areas[level]
+                t = max(start, (end // size - slots + 1) * size) # リングに残らない古い区間は飛ばす
+                while t < end:
+                    bucket = t // size
+                    self._advance(level, bucket)
+                    bucket_end = min(end, (bucket + 1) * size)
+                    slot = bucket % slots
+                    areas[slot] = min(HISTORY_MAX_AREA, areas[slot] + value * (bucket_end - t))
+                    if value > peaks[slot]: peaks[slot] = value
+                    t = bucket_end
+            self._advance(level, end // size)
+
+    def flush(self, now):
+        if now <= self.updated_at: return
+        self._accumulate(self.updated_at, now)
+        self.updated_at = now
+        if self.value: self.dirty = True
+
+    def record(self, now, value):
+        self.flush(now)
+        self.value = min(value, HISTORY_MAX_VALUE)
+        for level, (size, slots) in enumerate(HISTORY_LEVELS):
+            slot = self.heads[level] % slots
+            if self.value > self.peaks[level][slot]: self.peaks[level][slot] = self.value
+        self.dirty = True
+
+    def summarize(self, now, window):
+        # 直近window秒の最大人数と平均人数。windowを覆える一番細かい解像度を使う
+        # リングは途中の現在バケットを含むので、ちょうど同じ長さの解像度だと一番古いバケットが欠ける。その時は一つ粗い解像度にする
+        self.flush(now)
+        level = next((i for i, (size, slots) in enumerate(HISTORY_LEVELS) if size * slots > window), len(HISTORY_LEVELS) - 1)
+        size, slots = HISTORY_LEVELS[level]
+        start = max(now - window, self.created_at, (self.heads[level] - slots + 1) * size)
+        peaks, areas = self.peaks[level], self.areas[level]
+        peak = area = 0
+        for bucket in range(start // size, self.heads[level] + 1):
+            peak = max(peak, peaks[bucket % slots])
+            area += areas[bucket % slots]
+        return peak, area / max(1, now - max((start // size) * size, self.created_at))
+
+    def nbytes(self): return sum(a.itemsize * len(a) for a in self.peaks + self.areas)
+
+    def encode(self):
+        blob = b"".join(_to_little_endian(a).tobytes() for a in self.peaks + self.areas)
+        return {"version": HISTORY_FORMAT_VERSION, "levels": [list(level) for level in HISTORY_LEVELS], "heads": list(self.heads),
+                "value": self.value, "created_at": self.created_at, "updated_at": self.updated_at, "data": zlib.compress(blob)}
+
+    @classmethod
+    def decode(cls, data):
+        if data.get("version") != HISTORY_FORMAT_VERSION or [tuple(level) for level in data["levels"]] != list(HISTORY_LEVELS): return None
+        series = cls(int(data["created_at"]))
+        blob, offset = zlib.decompress(data["data"]), 0
+        for arrays in (series.peaks, series.areas):
+            for i, a in enumerate(arrays):
+                loaded = array.array(a.typecode, blob[offset:offset + a.itemsize * len(a)])
+                arrays[i] = _to_little_endian(loaded) # ビッグエンディアン環境では元に戻す
+                offset += a.itemsize * len(a)
+        series.heads = [int(h) for h in data["heads"]]
+        series.value, series.updated_at = int(data["value"]), int(data["updated_at"])
+        return series
+
+def _to_little_endian(a):
+    if sys.byteorder == "little": return a
+    swapped = array.array(a.typecode, a); swapped.byteswap()
+    return swapped
+
+def history_doc_id(key): return f"{key[0]}_{key[1]}"
+
+class OccupancyHistory:
+    def __init__(self):
+        self.series = {} # ("vc", channel_id) または ("guild", guild_id) -> OccupancySeries
+        self.guild_of = {} # key -> guild_id
+
+    def record(self, key, guild_id, value, now=None):
+        now = int(time.time()) if now is None else now
+        series = self.series.get(key)
+        if series is None:
+            if not value: return # 0人のままの系列は作らない
+            series = self.series[key] = OccupancySeries(now)
+            self.guild_of[key] = guild_id
+        if series.value == value: return
+        if not value: vc_zero_stats[key] = now # 空になった時刻 (統計表示用)
+        else: vc_zero_stats.pop(key, None)
+        series.record(now, value)
+
+    def summarize(self, key, window, now=None):
+        series = self.series.get(key)
+        return series.summarize(int(time.time()) if now is None else now, window) if series else None
+
+    def drop(self, key):
+        self.guild_of.pop(key, None)
+        vc_zero_stats.pop(key, None)
+        if self.series.pop(key, None) is not None and db: firestore_writer.delete(HISTORY_FIRESTORE_COLLECTION_NAME, history_doc_id(key))
+
+    def install(self, key, guild_id, series):
+        # 起動時のロード。ロード前に記録が始まっている系列はそちらを優先する
+        if key in self.series: return False
+        self.series[key] = series
+        self.guild_of[key] = guild_id
+        return True
+
+    def persist_dirty(self, now=None):
+        now = int(time.time()) if now is None else now
+        written = 0
+        for key, series in self.series.items():
+            series.flush(now)
+            if not series.dirty: continue
+            series.dirty = False
+            if not db: continue
+            firestore_writer.set(HISTORY_FIRESTORE_COLLECTION_NAME, history_doc_id(key), {"kind": key[0], "id": key[1], "guild_id": self.guild_of[key], **series.encode()})
+            written += 1
+        return written
+
+    def nbytes(self): return sum(series.nbytes() for series in self.series.values())
+
+occupancy_history = OccupancyHistory()
+
+def record_occupancy_history(guild, channel_ids):
+    # 追跡中VCと、サマリーVCのあるサーバー全体の人数だけを記録する
+    occupancy_index.ensure_guild(guild)
+    for cid in channel_ids:
+        if cid in vc_tracking: occupancy_history.record(("vc", cid), guild.id, occupancy_index.channel_counts.get(cid, 0))
+    if guild.id in summary_vc_tracking: occupancy_history.record(("guild", guild.id), guild.id, occupancy_index.guild_total(guild))
+
+@profiled
+async def load_occupancy_history_from_db():
+    if not db: return
+    loaded = skipped = 0
+    try:
+        async for doc_snapshot in db.collection(HISTORY_FIRESTORE_COLLECTION_NAME).stream():
+            doc_data = doc_snapshot.to_dict()
+            try:
+                if not owns_guild(int(doc_data["guild_id"])): continue
+                series = OccupancySeries.decode(doc_data)
+                if series is None: skipped += 1; continue
+                loaded += occupancy_history.install((doc_data["kind"], int(doc_data["id"])), int(doc_data["guild_id"]), series)
+            except (ValueError, TypeError, KeyError, zlib.error):
+                print_warning(f"履歴ドキュメント {doc_snapshot.id} データ解析エラー。スキップ。")
+        print_info(f"{loaded}件の人数履歴をDBからロード完了。(形式違いでスキップ: {skipped}件)")
+    except Exception as e: print_error(f"人数履歴のロード中エラー: {e}", exc_info=True)
+
+STATUS_VC_RENAME_REASON = "個別VC人数更新"
+SUMMARY_VC_RENAME_REASON = "サーバー全体のVC参加人数更新"
+
+def compute_status_channel_name(original_vc, status_vc):
+    base_name = status_vc.name.split("：")[0].strip() if "：" in status_vc.name else vc_tracking.get(original_vc.id, {}).get("original_channel_name", original_vc.name)
+    return f"{base_name}：{occupancy_index.channel_count(original_vc)} users"
+
+def compute_summary_vc_name(guild, summary_vc):
+    base_name = summary_vc.name.split("：")[0].strip() if "：" in summary_vc.name else "Study/Work"
+    return f"{base_name}：{occupancy_index.guild_total(guild)} users"
+
+async def resolve_summary_vc(guild):
+    summary_vc_id = summary_vc_tracking.get(guild.id)
+    if not summary_vc_id: return None
+    summary_vc = guild.get_channel(summary_vc_id)
+    if not isinstance(summary_vc, discord.VoiceChannel):
+        await forget_summary_vc(guild.id)
+        return None
+    return summary_vc
+
+@profiled
 async def update_dynamic_status_channel_name(original_vc, status_vc):
     if not original_vc or not status_vc: return
     ovc_id = original_vc.id
-    if vc_processing_flags.get(ovc_id): return
-    vc_processing_flags[ovc_id] = True
     try:
-        base_name = status_vc.name.split("：")[0].strip() if "：" in status_vc.name else vc_tracking.get(ovc_id, {}).get("original_channel_name", original_vc.name)
-        count = len([m for m in original_vc.members if not m.bot])
-        new_name = f"{base_name}：{count} users"
-        if new_name != status_vc.name:
-            await status_vc.edit(name=new_name, reason="個別VC人数更新")
+        vc_rename_scheduler.request(ovc_id, status_vc, compute_status_channel_name(original_vc, status_vc), STATUS_VC_RENAME_REASON)
     except Exception as e:
-        print_error(f"個別VC名更新エラー (VC ID: {ovc_id}): {e}", exc_info=True)
-    finally:
-        vc_processing_flags.pop(ovc_id, None)
+        print_error(f"個別VC名更新エラー (VC ID: {ovc_id}): {e}", exc_info=True, guild_id=original_vc.guild.id, channel_id=ovc_id)
 
+@profiled
 async def update_summary_vc_name(guild):
+    if not is_active_instance(): return
     guild_id = guild.id
-    if summary_vc_processing_flags.get(guild_id): return
-    summary_vc_processing_flags[guild_id] = True
     try:
-        summary_vc_id = summary_vc_tracking.get(guild_id)
-        if not summary_vc_id: return
-        summary_vc = guild.get_channel(summary_vc_id)
-        if not isinstance(summary_vc, discord.VoiceChannel):
-            summary_vc_tracking.pop(guild_id, None)
-            await remove_summary_vc_from_db(guild_id)
-            return
-
-        base_name = summary_vc.name.split("：")[0].strip() if "：" in summary_vc.name else "Study/Work"
-        total_user_count = sum(len([m for m in vc.members if not m.bot]) for vc in guild.voice_channels if not (vc.category and STATUS_CATEGORY_NAME.lower() in vc.category.name.lower()))
-        new_name = f"{base_name}：{total_user_count} users"
-        if new_name != summary_vc.name:
-            await summary_vc.edit(name=new_name, reason="サーバー全体のVC参加人数更新")
+        summary_vc = await resolve_summary_vc(guild)
+        if not summary_vc: return
+        summary_vc_rename_scheduler.request(guild_id, summary_vc, compute_summary_vc_name(guild, summary_vc), SUMMARY_VC_RENAME_REASON)
     except Exception as e:
-        print_error(f"サマリーVC名更新エラー (Guild ID: {guild_id}): {e}", exc_info=True)
-    finally:
-        summary_vc_processing_flags.pop(guild_id, None)
+        print_error(f"サマリーVC名更新エラー (Guild ID: {guild_id}): {e}", exc_info=True, guild_id=guild_id)
+
+# --- Aggregate Groups ---
+# --- 集計グループ ---
+# nah_sumの一般化。カテゴリ・名前のパターン(正規表現)・チャンネル指定・全体のいずれかでVCをまとめ、グループ毎の合計人数を表示用VCに出す。
+# サーバー毎にチャンネル→所属グループの索引を持ち、入退室1回の差分で影響のある全グループの合計をまとめて更新する。
+# 索引はグループの追加/削除、チャンネルの作成/更新/削除、再接続時にサーバー単位で作り直す。STATUSカテゴリ内のVCは数えない。
+GROUP_KINDS = ("category", "pattern", "channels", "all")
+GROUP_MAX_PER_GUILD = int(os.getenv("GROUP_MAX_PER_GUILD", "10"))
+GROUP_VC_RENAME_REASON = "グループのVC参加人数更新"
+# パターンはチャンネルの作成/移動/改名や再接続の度にイベントループ上で全VC名に当てるので、長さと形を絞って破滅的バックトラックでループが止まるのを防ぐ。
+# 量指定子と選択(|)の組み合わせ数を掛け合わせた「コスト」で見積もる。上限なしの繰り返し (* + {n,}) はチャンネル名の最大長ぶんと数えるので、実質1つまでになる。
+# 後方参照と、グループ全体への ? 以外の繰り返し ((a+)+, (a|aa)*, (a?){30} など) は受け付けない。
+GROUP_PATTERN_MAX_LENGTH = int(os.getenv("GROUP_PATTERN_MAX_LENGTH", "100"))
+GROUP_PATTERN_MAX_COST = int(os.getenv("GROUP_PATTERN_MAX_COST", "1000"))
+CHANNEL_NAME_MAX_LENGTH = 100 # Discordのチャンネル名の上限
+_GROUP_PATTERN_QUANTIFIER = re.compile(r"(?:([*+?])|\{(\d*)(,?)(\d*)\})[?+]?")
+
+def _pattern_quantifier_at(pattern, i):
+    # i の位置の量指定子を読んで (次の位置, 回数の幅) を返す。量指定子が無ければ幅は None。
+    m = _GROUP_PATTERN_QUANTIFIER.match(pattern, i)
+    if m is None or (m.group(1) is None and not m.group(2) and not m.group(3)): return i, None
+    if m.group(1): low, high = {"?": (0, 1), "*": (0, None), "+": (1, None)}[m.group(1)]
+    else: low = int(m.group(2) or 0); high = (int(m.group(4)) if m.group(4) else None) if m.group(3) else low
+    return m.end(), CHANNEL_NAME_MAX_LENGTH + 1 if high is None else min(max(high - low, 0), CHANNEL_NAME_MAX_LENGTH) + 1
+
+def validate_group_pattern(pattern):
+    if len(pattern) > GROUP_PATTERN_MAX_LENGTH: raise ValueError(f"パターンが長すぎるニャ ({GROUP_PATTERN_MAX_LENGTH}文字まで)")
+    try: re.compile(pattern, re.IGNORECASE)
+    except re.error as e: raise ValueError(str(e)) from e
+    cost, branches, i = 1, [1], 0
+    while i < len(pattern):
+        c = pattern[i]; i += 1
+        if c == "(":
+            if pattern.startswith(("?P=", "?("), i): raise ValueError("後方参照は使えないニャ")
+            branches.append(1); continue
+        if c == "|": branches[-1] += 1; continue
+        if c == ")":
+            cost *= branches.pop()
+            quantifier_start = i
+            i, span = _pattern_quantifier_at(pattern, i)
+            if span is not None and pattern[quantifier_start] != "?": raise ValueError("グループ ( ) の後ろには ? しか付けられないニャ")
+        else:
+            if c == "\\":
+                if pattern[i] in "123456789": raise ValueError("後方参照は使えないニャ")
+                i += 1
+            elif c == "[":
+                if pattern[i] == "^": i += 1
+                if pattern[i] == "]": i += 1
+                while pattern[i] != "]": i += 2 if pattern[i] == "\\" else 1
+                i += 1
+            i, span = _pattern_quantifier_at(pattern, i)
+        if span is not None: cost *= span
+        if cost * math.prod(branches) > GROUP_PATTERN_MAX_COST: raise ValueError("パターンが複雑すぎるニャ (* や + は1つまで、? や | も控えめにしてニャ)")
+    return pattern
+
+class GroupAggregator:
+    def __init__(self):
+        self.guild_groups = {} # guild_id -> group_vc_idの集合 (group_vc_trackingから作る)
+        self.channel_groups = {} # channel_id -> 所属するgroup_vc_idのfrozenset
+        self.group_totals = {} # group_vc_id -> 非Botメンバー数
+        self.indexed_channels = {} # guild_id -> 索引済みchannel_idの集合
+        self.patterns = {} # 正規表現文字列 -> コンパイル済みパターン
+
+    def reload_definitions(self):
+        self.drop_all_guilds()
+        self.guild_groups = {}
+        for group_vc_id, definition in group_vc_tracking.items():
+            self.guild_groups.setdefault(definition["guild_id"], set()).add(group_vc_id)
+
+    def has_pattern_groups(self, guild_id):
+        return any(group_vc_tracking[gid]["kind"] == "pattern" for gid in self.guild_groups.get(guild_id, ()) if gid in group_vc_tracking)
+
+    def _pattern(self, pattern):
+        compiled = self.patterns.get(pattern)
+        if compiled is None: compiled = self.patterns[pattern] = re.compile(pattern, re.IGNORECASE)
+        return compiled
+
+    def matches(self, definition, channel):
+        kind, target = definition["kind"], definition["target"]
+        if kind == "all": return True
+        if kind == "category": return channel.category_id == target
+        if kind == "channels": return channel.id in target
+        if kind == "pattern": return self._pattern(target).search(channel.name) is not None
+        return False
+
+    def rebuild_guild(self, guild):
+        # 所属を作り直し、合計人数が変わった(または初めて数えた)グループを返す
+        group_ids = self.guild_groups.get(guild.id, ())
+        previous = {gid: self.group_totals.get(gid) for gid in group_ids}
+        self.drop_guild(guild.id)
+        if not group_ids: return set()
+        definitions = [(gid, group_vc_tracking[gid]) for gid in group_ids if gid in group_vc_tracking]
+        totals, indexed = dict.fromkeys(group_ids, 0), set()
+        for vc in guild.voice_channels:
+            if is_in_status_category(vc): continue
+            groups = frozenset(gid for gid, definition in definitions if self.matches(definition, vc))
+            if not groups: continue
+            self.channel_groups[vc.id] = groups
+            indexed.add(vc.id)
+            count = occupancy_index.channel_count(vc)
+            for gid in groups: totals[gid] += count
+        self.indexed_channels[guild.id] = indexed
+        self.group_totals.update(totals)
+        return {gid for gid in group_ids if previous[gid] != totals[gid]}
+
+    def drop_guild(self, guild_id):
+        for cid in self.indexed_channels.pop(guild_id, ()): self.channel_groups.pop(cid, None)
+        for gid in self.guild_groups.get(guild_id, ()): self.group_totals.pop(gid, None)
+
+    def drop_all_guilds(self):
+        for guild_id in list(self.indexed_channels): self.drop_guild(guild_id)
+
+    def apply_voice_state_delta(self, guild, before_channel, after_channel):
+        # 影響のあったグループを返す。未索引のサーバーはここで作る (人数インデックスは更新済み)
+        if guild.id not in self.guild_groups: return ()
+        if guild.id not in self.indexed_channels: return self.rebuild_guild(guild)
+        if before_channel and after_channel and before_channel.id == after_channel.id: return ()
+        left = self.channel_groups.get(before_channel.id, frozenset()) if before_channel else frozenset()
+        joined = self.channel_groups.get(after_channel.id, frozenset()) if after_channel else frozenset()
+        for gid in left - joined: self.group_totals[gid] = max(0, self.group_totals[gid] - 1)
+        for gid in joined - left: self.group_totals[gid] += 1
+        return left ^ joined
+
+    def group_total(self, guild, group_vc_id):
+        if guild.id not in self.indexed_channels: self.rebuild_guild(guild)
+        return self.group_totals.get(group_vc_id, 0)
+
+group_aggregator = GroupAggregator()
+
+def compute_group_vc_name(guild, group_vc_id, group_vc):
+    base_name = group_vc.name.split("：")[0].strip() if "：" in group_vc.name else group_vc_tracking[group_vc_id]["label"]
+    return f"{base_name}：{group_aggregator.group_total(guild, group_vc_id)} users"
+
+async def resolve_group_vc(guild, group_vc_id):
+    if group_vc_id not in group_vc_tracking: return None
+    group_vc = guild.get_channel(group_vc_id)
+    if not isinstance(group_vc, discord.VoiceChannel):
+        await remove_group(group_vc_id)
+        return None
+    return group_vc
+
+@profiled
+async def update_group_vc_names(guild, group_vc_ids):
+    if not is_active_instance(): return
+    for group_vc_id in group_vc_ids:
+        try:
+            group_vc = await resolve_group_vc(guild, group_vc_id)
+            if not group_vc: continue
+            group_vc_rename_scheduler.request(group_vc_id, group_vc, compute_group_vc_name(guild, group_vc_id, group_vc), GROUP_VC_RENAME_REASON)
+        except Exception as e:
+            print_error(f"グループVC名更新エラー (Group VC ID: {group_vc_id}): {e}", exc_info=True, guild_id=guild.id, channel_id=group_vc_id)
+
+def refresh_guild_groups(guild):
+    # チャンネル構成が変わった時に所属を作り直し、合計が変わったグループだけリネームする
+    if guild.id not in group_aggregator.guild_groups: return
+    changed = group_aggregator.rebuild_guild(guild)
+    if changed: asyncio.create_task(update_group_vc_names(guild, changed))
+
+async def remove_group(group_vc_id):
+    group_vc_rename_scheduler.cancel(group_vc_id)
+    if group_vc_tracking.pop(group_vc_id, None) is None: return
+    group_aggregator.reload_definitions()
+    await remove_group_vc_from_db(group_vc_id)
 
 async def register_new_vc_for_tracking(original_vc, send_feedback_to_ctx=None):
     if vc_processing_flags.get(original_vc.id): return
@@ -286,62 +2167,286 @@ async def register_new_vc_for_tracking(original_vc, send_feedback_to_ctx=None):
         guild = original_vc.guild
         status_category = await get_or_create_status_category(guild)
         if not status_category:
-            if send_feedback_to_ctx: await send_feedback_to_ctx.send("STATUSカテゴリの作成に失敗しましたニャ😿")
+            if send_feedback_to_ctx: await send_interactive(send_feedback_to_ctx, "STATUSカテゴリの作成に失敗しましたニャ😿")
             return
         
-        count = len([m for m in original_vc.members if not m.bot])
+        count = occupancy_index.channel_count(original_vc)
         status_channel_name = f"{original_vc.name[:65]}：{count} users"
         overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=False)}
         
-        new_status_vc = await guild.create_voice_channel(name=status_channel_name, category=status_category, overwrites=overwrites)
+        new_status_vc = await run_channel_admin(lambda: guild.create_voice_channel(name=status_channel_name, category=status_category, overwrites=overwrites))
         vc_tracking[original_vc.id] = {"guild_id": guild.id, "status_channel_id": new_status_vc.id, "original_channel_name": original_vc.name}
+        channel_index.link_status(new_status_vc.id, original_vc.id)
         await save_tracked_original_to_db(original_vc.id, guild.id, new_status_vc.id, original_vc.name)
-        if send_feedback_to_ctx: await send_feedback_to_ctx.send(f"VC「{original_vc.name}」の追跡を開始したニャ。")
+        if send_feedback_to_ctx: await send_interactive(send_feedback_to_ctx, f"VC「{original_vc.name}」の追跡を開始したニャ。")
 
     except Exception as e:
-        print_error(f"新規VC追跡エラー (VC ID: {original_vc.id}): {e}", exc_info=True)
-        if send_feedback_to_ctx: await send_feedback_to_ctx.send("追跡開始中にエラーが発生しましたニャ😿")
+        print_error(f"新規VC追跡エラー (VC ID: {original_vc.id}): {e}", exc_info=True, guild_id=original_vc.guild.id, channel_id=original_vc.id)
+        if send_feedback_to_ctx: await send_interactive(send_feedback_to_ctx, "追跡開始中にエラーが発生しましたニャ😿")
     finally:
         vc_processing_flags.pop(original_vc.id, None)
 
+async def forget_vc_tracking(original_channel_id):
+    # 追跡状態だけを消す (Discord側のチャンネルには触らない)。消した追跡情報を返す
+    track_info = vc_tracking.pop(original_channel_id, None)
+    vc_rename_scheduler.cancel(original_channel_id)
+    if not track_info: return None
+    channel_index.unlink_status(track_info["status_channel_id"])
+    occupancy_history.drop(("vc", original_channel_id))
+    await remove_tracked_original_from_db(original_channel_id)
+    return track_info
+
+async def forget_summary_vc(guild_id):
+    summary_vc_rename_scheduler.cancel(guild_id)
+    if summary_vc_tracking.pop(guild_id, None) is None: return False
+    occupancy_history.drop(("guild", guild_id))
+    await remove_summary_vc_from_db(guild_id)
+    return True
+
 async def unregister_vc_tracking(original_channel_id, guild, send_feedback_to_ctx=None):
     if vc_processing_flags.get(original_channel_id): return
     vc_processing_flags[original_channel_id] = True
     try:
-        track_info = vc_tracking.pop(original_channel_id, None)
+        track_info = await forget_vc_tracking(original_channel_id)
         if track_info:
-            status_vc_id = track_info["status_channel_id"]
-            status_vc = guild.get_channel(status_vc_id)
+            status_vc = guild.get_channel(track_info["status_channel_id"])
             if status_vc:
-                await status_vc.delete(reason="追跡停止")
-            await remove_tracked_original_from_db(original_channel_id)
+                await run_channel_admin(lambda: status_vc.delete(reason="追跡停止"))
         if send_feedback_to_ctx:
             vc_name = track_info.get("original_channel_name", f"ID: {original_channel_id}") if track_info else f"ID: {original_channel_id}"
-            await send_feedback_to_ctx.send(f"VC「{vc_name}」の追跡を停止したニャ。")
+            await send_interactive(send_feedback_to_ctx, f"VC「{vc_name}」の追跡を停止したニャ。")
     except Exception as e:
-        print_error(f"VC追跡解除エラー (VC ID: {original_channel_id}): {e}", exc_info=True)
-        if send_feedback_to_ctx: await send_feedback_to_ctx.send("追跡停止中にエラーが発生しましたニャ�")
+        print_error(f"VC追跡解除エラー (VC ID: {original_channel_id}): {e}", exc_info=True, guild_id=guild.id, channel_id=original_channel_id)
+        if send_feedback_to_ctx: await send_interactive(send_feedback_to_ctx, "追跡停止中にエラーが発生しましたニャ�")
     finally:
         vc_processing_flags.pop(original_channel_id, None)
 
+# --- Orphan Sweeper ---
+# --- 孤立した追跡情報の掃除 ---
+# チャンネル削除・サーバー離脱イベントで即座に追跡情報を消し、取りこぼし(オフライン中の削除など)は
+# 追跡情報全体をカーソルで少しずつ巡回して見つける。1回の巡回で見るのはORPHAN_SWEEP_SLICE件まで。
+# キャッシュが一時的に欠けている可能性があるので、巡回で見つけたものはORPHAN_GRACE_SECONDS以上空けて2回続けて見つからない時だけ消す。
+# Firestoreからの削除は書き込みキュー経由でバッチにまとめて送られる。
+ORPHAN_SWEEP_INTERVAL_SECONDS = 15
+ORPHAN_SWEEP_SLICE = int(os.getenv("ORPHAN_SWEEP_SLICE", "200"))
+ORPHAN_GRACE_SECONDS = 300
+
+def find_orphan_reason(kind, key):
+    # 孤立していれば理由を返す。サーバーが一時的に利用不可の間は判断しない
+    if kind == "vc":
+        track_info = vc_tracking.get(key)
+        if not track_info: return None
+        guild_id = track_info["guild_id"]
+    elif kind == "summary":
+        if key not in summary_vc_tracking: return None
+        guild_id = key
+    elif kind == "group":
+        definition = group_vc_tracking.get(key)
+        if not definition: return None
+        guild_id = definition["guild_id"]
+    else: # history
+        if key not in occupancy_history.series: return None
+        series_kind, series_id = key
+        tracked = series_id in vc_tracking if series_kind == "vc" else series_id in summary_vc_tracking
+        return None if tracked else "追跡されていない系列"
+    if not owns_guild(guild_id): return None # 他シャードの担当。Firestoreのドキュメントはそちらが管理する
+    guild = bot.get_guild(guild_id)
+    if guild is None: return "サーバーが見つからない"
+    if guild.unavailable: return None
+    if kind == "vc":
+        if not guild.get_channel(key): return "元VCが見つからない"
+        if not guild.get_channel(track_info["status_channel_id"]): return "人数表示用VCが見つからない"
+    elif kind == "summary":
+        if not guild.get_channel(summary_vc_tracking[key]): return "サマリーVCが見つからない"
+    elif not guild.get_channel(key): return "集計VCが見つからない"
+    return None
+
+async def remove_orphan(kind, key, source):
+    if kind == "vc":
+        guild = bot.get_guild(vc_tracking[key]["guild_id"])
+        if guild and not guild.unavailable: await unregister_vc_tracking(key, guild) # 残っている人数表示用VCも消す
+        else: await forget_vc_tracking(key)
+    elif kind == "summary": await forget_summary_vc(key)
+    elif kind == "group": await remove_group(key)
+    else: occupancy_history.drop(key)
+    metrics.inc("nekochan_orphans_removed_total", kind=kind, source=source)
+
+class OrphanSweeper:
+    def __init__(self):
+        self.cursor = [] # 今回の巡回で残っている (種類, キー)。末尾から取り出す
+        self.suspects = {} # (種類, キー) -> 最初に孤立と判定した時刻
+        self.pass_started = None
+        self.pass_stats = {}
+        self.last_pass = {}
+
+    def _start_pass(self):
+        entries = [("vc", k) for k in vc_tracking] + [("summary", k) for k in summary_vc_tracking]
+        entries += [("group", k) for k in group_vc_tracking] + [("history", k) for k in occupancy_history.series]
+        self.cursor = entries[::-1]
+        self.pass_started = time.monotonic()
+        self.pass_stats = {"checked": 0, "suspected": 0, "removed": 0}
+        live = set(entries)
+        self.suspects = {entry: since for entry, since in self.suspects.items() if entry in live}
+
+    def _finish_pass(self):
+        self.last_pass = {**self.pass_stats, "duration_s": round(time.monotonic() - self.pass_started, 1)}
+        if self.pass_stats["removed"] or self.pass_stats["suspected"]:
+            print_info(f"孤立した追跡情報の巡回完了: 確認 {self.pass_stats['checked']}件, 保留 {self.pass_stats['suspected']}件, 削除 {self.pass_stats['removed']}件 ({self.last_pass['duration_s']}秒)")
+        self.pass_started = None
+
+    async def step(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.pass_started is None: self._start_pass()
+        for _ in range(min(ORPHAN_SWEEP_SLICE, len(self.cursor))):
+            entry = self.cursor.pop()
+            self.pass_stats["checked"] += 1
+            reason = find_orphan_reason(*entry)
+            if reason is None:
+                self.suspects.pop(entry, None); continue
+            first_seen = self.suspects.setdefault(entry, now)
+            if now - first_seen < ORPHAN_GRACE_SECONDS:
+                self.pass_stats["suspected"] += 1; continue
+            self.suspects.pop(entry, None)
+            try:
+                await remove_orphan(*entry, source="sweep")
+                self.pass_stats["removed"] += 1
+                print_info(f"孤立した追跡情報を削除 ({entry[0]} {entry[1]}): {reason}")
+            except Exception as e:
+                print_error(f"孤立した追跡情報の削除エラー ({entry[0]} {entry[1]}): {e}", exc_info=True)
+        if not self.cursor: self._finish_pass()
+
+orphan_sweeper = OrphanSweeper()
+
+async def forget_deleted_channel(channel):
+    # チャンネル削除イベントで、そのチャンネルに紐づく追跡情報をすぐに消す。スタンバイにはリスナー経由で届く
+    if not is_active_instance(): return
+    guild = channel.guild
+    removed = []
+    if channel.id in vc_tracking:
+        await unregister_vc_tracking(channel.id, guild); removed.append("vc") # 元VCが消えたら人数表示用VCも消す
+    original_id = channel_index.original_for_status(channel.id)
+    if original_id in vc_tracking and vc_tracking[original_id]["status_channel_id"] == channel.id:
+        await forget_vc_tracking(original_id); removed.append("vc")
+    if summary_vc_tracking.get(guild.id) == channel.id:
+        await forget_summary_vc(guild.id); removed.append("summary")
+    if channel.id in group_vc_tracking:
+        await remove_group(channel.id); removed.append("group")
+    for kind in removed: metrics.inc("nekochan_orphans_removed_total", kind=kind, source="event")
+    if removed: print_info(f"削除されたチャンネル「{channel.name}」の追跡情報を削除: {removed}", guild_id=guild.id, channel_id=channel.id)
+
+async def forget_guild(guild_id):
+    # サーバーから外れたら、そのサーバーの追跡情報をまとめて消す (Discord側には触れない)
+    if not is_active_instance(): return
+    vc_ids = [cid for cid, info in vc_tracking.items() if info["guild_id"] == guild_id]
+    group_ids = [gid for gid, definition in group_vc_tracking.items() if definition["guild_id"] == guild_id]
+    for cid in vc_ids: await forget_vc_tracking(cid)
+    had_summary = await forget_summary_vc(guild_id)
+    for gid in group_ids: await remove_group(gid)
+    removed = len(vc_ids) + len(group_ids) + had_summary
+    if removed:
+        metrics.inc("nekochan_orphans_removed_total", removed, kind="guild", source="event")
+        print_info(f"サーバーから外れたため追跡情報を削除: 追跡VC {len(vc_ids)}件, サマリーVC {int(had_summary)}件, 集計グループ {len(group_ids)}件", guild_id=guild_id)
+
 # --- Bot Events ---
+# on_readyはゲートウェイ再接続の度に呼ばれる。初期化は一度だけ行い、2回目以降はキャッシュとの再検証だけにする。
+startup_completed = False
+
 @bot.event
 async def on_ready():
-    print_info(f'ログイン成功: {bot.user.name}')
+    global startup_completed
+    print_info(f'ログイン成功: {bot.user.name} (シャード: {shard_label()}, 省メモリモード: {LOW_MEMORY_MODE})')
     await bot.change_presence(activity=discord.CustomActivity(name="VCの人数を見守り中ニャ～"))
-    if await init_firestore():
-        await load_tracked_channels_from_db()
-        await load_summary_vcs_from_db()
-    periodic_status_update.start()
-    periodic_keep_alive_ping.start()
+    if startup_completed:
+        await reconcile_after_reconnect(); return
+    startup_completed = True
+    await start_tracking_services()
+    start_loop_once(periodic_keep_alive_ping)
+
+@bot.event
+async def on_resumed():
+    if not SHARDED_MODE: set_gateway_connected(None, True)
+    print_info("ゲートウェイセッション再開。")
+    if startup_completed: await reconcile_after_reconnect()
+
+@bot.event
+async def on_connect():
+    if not SHARDED_MODE: set_gateway_connected(None, True)
+
+@bot.event
+async def on_disconnect():
+    if not SHARDED_MODE: set_gateway_connected(None, False)
 
 @bot.event
+async def on_shard_connect(shard_id): set_gateway_connected(shard_id, True)
+
+@bot.event
+async def on_shard_resumed(shard_id): set_gateway_connected(shard_id, True)
+
+@bot.event
+async def on_shard_disconnect(shard_id): set_gateway_connected(shard_id, False)
+
+def start_loop_once(loop):
+    if not loop.is_running(): loop.start()
+
+async def start_tracking_services():
+    await load_state_snapshot()
+    start_loop_once(periodic_status_update)
+    start_loop_once(periodic_state_snapshot)
+    start_loop_once(periodic_occupancy_reconcile)
+    start_loop_once(periodic_history_persist)
+    start_loop_once(periodic_orphan_sweep)
+    schedule_firestore_reconcile()
+    asyncio.create_task(start_high_availability(), name="high-availability")
+
+def schedule_status_updates(guild, channel_ids, include_summary):
+    record_occupancy_history(guild, channel_ids)
+    for cid in channel_ids:
+        track_info = vc_tracking.get(cid)
+        if not track_info: continue
+        original_vc = guild.get_channel(cid)
+        status_vc = guild.get_channel(track_info.get("status_channel_id"))
+        if original_vc and status_vc:
+            asyncio.create_task(update_dynamic_status_channel_name(original_vc, status_vc))
+    if include_summary and guild.id in summary_vc_tracking:
+        asyncio.create_task(update_summary_vc_name(guild))
+    refresh_guild_groups(guild)
+
+async def reconcile_after_reconnect():
+    # 切断中に人数が変わったチャンネルだけリネームを発行する。未インデックスのサーバーは前回値が無いので全件確認する
+    channel_index.drop_all_guilds() # 切断中のチャンネル作成/更新/削除は届いていないので次の参照時に作り直す
+    group_aggregator.drop_all_guilds()
+    tracked_by_guild = {}
+    for cid, track_info in vc_tracking.items():
+        tracked_by_guild.setdefault(track_info["guild_id"], []).append(cid)
+    guild_ids = set(tracked_by_guild) | set(summary_vc_tracking) | set(group_aggregator.guild_groups) | set(occupancy_index.guild_totals)
+    missing_guilds = missing_channels = updated_channels = 0
+    for guild_id in guild_ids:
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            occupancy_index.drop_guild(guild_id)
+            if guild_id in tracked_by_guild or guild_id in summary_vc_tracking or guild_id in group_aggregator.guild_groups: missing_guilds += 1
+            continue
+        was_indexed = guild_id in occupancy_index.guild_totals
+        changed_channels, total_changed = occupancy_index.rebuild_guild(guild)
+        tracked_here = tracked_by_guild.get(guild_id, [])
+        for cid in tracked_here:
+            if not guild.get_channel(cid) or not guild.get_channel(vc_tracking[cid]["status_channel_id"]): missing_channels += 1
+        targets = tracked_here if not was_indexed else [cid for cid in tracked_here if cid in changed_channels]
+        updated_channels += len(targets)
+        schedule_status_updates(guild, targets, include_summary=total_changed or not was_indexed)
+    print_info(f"再接続後の再検証完了。対象サーバー: {len(guild_ids)}, 更新対象VC: {updated_channels}, 見つからないサーバー: {missing_guilds}, 見つからないVC: {missing_channels}")
+
+@bot.event
+@profiled
 async def on_voice_state_update(member, before, after):
     if member.bot: return
     guild = member.guild
+    metrics.inc("nekochan_gateway_events_total", event="voice_state_update", shard=guild.shard_id)
+    occupancy_index.apply_voice_state_delta(guild, before.channel, after.channel)
     channels_to_update = set()
     if before.channel: channels_to_update.add(before.channel.id)
     if after.channel: channels_to_update.add(after.channel.id)
+    record_occupancy_history(guild, channels_to_update)
 
     for cid in channels_to_update:
         if cid in vc_tracking:
@@ -354,67 +2459,377 @@ async def on_voice_state_update(member, before, after):
     if guild.id in summary_vc_tracking:
         asyncio.create_task(update_summary_vc_name(guild))
 
+    changed_groups = group_aggregator.apply_voice_state_delta(guild, before.channel, after.channel)
+    if changed_groups: asyncio.create_task(update_group_vc_names(guild, changed_groups))
+
+def refresh_guild_occupancy(guild):
+    # STATUSカテゴリの範囲が変わると合計人数の対象VCも変わるので、インデックス済みのサーバーだけ数え直す
+    if guild.id not in occupancy_index.guild_totals: return
+    changed_channels, total_changed = occupancy_index.rebuild_guild(guild)
+    schedule_status_updates(guild, changed_channels, include_summary=total_changed)
+
+def affects_groups(channel):
+    return isinstance(channel, (discord.VoiceChannel, discord.CategoryChannel)) and channel.guild.id in group_aggregator.guild_groups
+
+@bot.event
+async def on_guild_channel_create(channel):
+    channel_index.apply_channel_upsert(channel)
+    if affects_groups(channel): refresh_guild_groups(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    status_changed = channel_index.apply_channel_upsert(after)
+    moved = isinstance(after, discord.VoiceChannel) and before.category_id != after.category_id
+    if status_changed or moved: refresh_guild_occupancy(after.guild)
+    renamed = before.name != after.name and not is_in_status_category(after) and group_aggregator.has_pattern_groups(after.guild.id) # 表示用VCのリネームでは作り直さない
+    if affects_groups(after) and (status_changed or moved or renamed): refresh_guild_groups(after.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    await forget_deleted_channel(channel)
+    status_changed = channel_index.apply_channel_delete(channel)
+    if status_changed or occupancy_index.channel_counts.get(channel.id): refresh_guild_occupancy(channel.guild)
+    if affects_groups(channel): refresh_guild_groups(channel.guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    await forget_guild(guild.id)
+    channel_index.drop_guild(guild.id)
+    occupancy_index.drop_guild(guild.id)
+    group_aggregator.drop_guild(guild.id)
+
 # --- Bot Tasks ---
 @tasks.loop(minutes=3)
 async def periodic_status_update():
+    await refresh_all_status_channels()
+
+# 表示名が現在の名前と違う(dirty)チャンネルだけを、固定数のワーカーと上限付きキューで処理する。
+PERIODIC_UPDATE_WORKERS = int(os.getenv("PERIODIC_UPDATE_WORKERS", "8"))
+PERIODIC_UPDATE_QUEUE_SIZE = 256
+last_status_cycle_stats = {}
+
+async def _status_update_worker(job_queue, stats):
+    while True:
+        scheduler, key, channel, new_name, reason = await job_queue.get()
+        try:
+            stats[await scheduler.apply_now(key, channel, new_name, reason)] += 1
+        except Exception as e:
+            stats["failed"] += 1
+            print_error(f"定期リネームエラー ({scheduler.label} {key}): {e}", exc_info=True)
+        finally:
+            job_queue.task_done()
+
+async def _iter_dirty_status_jobs(stats):
     for original_cid, track_info in list(vc_tracking.items()):
+        stats["scanned"] += 1
         guild = bot.get_guild(track_info["guild_id"])
-        if guild:
-            original_vc = guild.get_channel(original_cid)
-            status_vc = guild.get_channel(track_info.get("status_channel_id"))
-            if original_vc and status_vc:
-                asyncio.create_task(update_dynamic_status_channel_name(original_vc, status_vc))
-    
+        original_vc = guild.get_channel(original_cid) if guild else None
+        status_vc = guild.get_channel(track_info.get("status_channel_id")) if guild else None
+        if not original_vc or not status_vc:
+            stats["skipped"] += 1; continue
+        new_name = compute_status_channel_name(original_vc, status_vc)
+        if not vc_rename_scheduler.is_dirty(original_cid, status_vc, new_name):
+            stats["skipped"] += 1; continue
+        stats["dirty"] += 1
+        yield vc_rename_scheduler, original_cid, status_vc, new_name, STATUS_VC_RENAME_REASON
+
     for guild_id in list(summary_vc_tracking.keys()):
+        stats["scanned"] += 1
         guild = bot.get_guild(guild_id)
-        if guild:
-            asyncio.create_task(update_summary_vc_name(guild))
+        summary_vc = await resolve_summary_vc(guild) if guild else None
+        if not summary_vc:
+            stats["skipped"] += 1; continue
+        new_name = compute_summary_vc_name(guild, summary_vc)
+        if not summary_vc_rename_scheduler.is_dirty(guild_id, summary_vc, new_name):
+            stats["skipped"] += 1; continue
+        stats["dirty"] += 1
+        yield summary_vc_rename_scheduler, guild_id, summary_vc, new_name, SUMMARY_VC_RENAME_REASON
+
+    for group_vc_id, definition in list(group_vc_tracking.items()):
+        stats["scanned"] += 1
+        guild = bot.get_guild(definition["guild_id"])
+        group_vc = await resolve_group_vc(guild, group_vc_id) if guild else None
+        if not group_vc:
+            stats["skipped"] += 1; continue
+        new_name = compute_group_vc_name(guild, group_vc_id, group_vc)
+        if not group_vc_rename_scheduler.is_dirty(group_vc_id, group_vc, new_name):
+            stats["skipped"] += 1; continue
+        stats["dirty"] += 1
+        yield group_vc_rename_scheduler, group_vc_id, group_vc, new_name, GROUP_VC_RENAME_REASON
+
+@profiled
+async def refresh_all_status_channels():
+    global last_status_cycle_stats
+    if not is_active_instance(): return
+    started = time.monotonic()
+    stats = {"scanned": 0, "dirty": 0, "renamed": 0, "deferred": 0, "skipped": 0, "failed": 0}
+    job_queue = asyncio.Queue(maxsize=PERIODIC_UPDATE_QUEUE_SIZE)
+    workers = [asyncio.create_task(_status_update_worker(job_queue, stats), name=f"status-update-worker-{i}") for i in range(PERIODIC_UPDATE_WORKERS)]
+    try:
+        async for job in _iter_dirty_status_jobs(stats):
+            await job_queue.put(job) # キューが満杯ならワーカーが追いつくまで待つ
+        await job_queue.join()
+    finally:
+        for worker in workers: worker.cancel()
+    stats["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    last_status_cycle_stats = stats
+    print_info(f"定期更新サイクル: scanned={stats['scanned']} dirty={stats['dirty']} renamed={stats['renamed']} deferred={stats['deferred']} skipped={stats['skipped']} failed={stats['failed']} ({stats['duration_ms']}ms)")
+
+@tasks.loop(minutes=OCCUPANCY_RECONCILE_INTERVAL_MINUTES)
+async def periodic_occupancy_reconcile():
+    for guild_id in list(occupancy_index.guild_totals.keys()):
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            occupancy_index.drop_guild(guild_id); continue
+        changed_channels, total_changed = occupancy_index.rebuild_guild(guild)
+        if not changed_channels and not total_changed: continue
+        print_warning(f"人数インデックスのずれを補正 (Guild ID: {guild_id}, VC数: {len(changed_channels)})", guild_id=guild_id)
+        schedule_status_updates(guild, changed_channels, include_summary=total_changed)
+
+@tasks.loop(minutes=HISTORY_PERSIST_INTERVAL_MINUTES)
+async def periodic_history_persist():
+    if not is_active_instance(): return
+    written = occupancy_history.persist_dirty()
+    if written and log_enabled("DEBUG"): print_debug("人数履歴を%d件書き出し。(系列数: %d, メモリ: %dKiB)", written, len(occupancy_history.series), occupancy_history.nbytes() // 1024)
+
+@tasks.loop(seconds=ORPHAN_SWEEP_INTERVAL_SECONDS)
+async def periodic_orphan_sweep():
+    if not is_active_instance(): return
+    await orphan_sweeper.step()
+
+@tasks.loop(seconds=STATE_SNAPSHOT_SAVE_INTERVAL_SECONDS)
+async def periodic_state_snapshot():
+    if state_snapshot_dirty or state_snapshot_has_pending: await save_state_snapshot()
 
 @tasks.loop(minutes=1)
 async def periodic_keep_alive_ping():
-    print_info("Periodic keep-alive log")
+    if not log_enabled("INFO"): return
+    lane_summary = ", ".join(f"{name}: depth={st['depth']} avg_wait={st['avg_wait']}s max_wait={st['max_wait']}s" for name, st in rest_dispatcher.get_lane_stats().items())
+    profile_summary = f" | slow callbacks: {runtime_profiler.slow_callback_count}" if runtime_profiler.enabled else ""
+    print_info(f"Periodic keep-alive log | REST lanes: {lane_summary} | loop lag max: {event_loop_lag['max'] * 1000:.1f}ms{profile_summary}")
+
+# --- Bulk Purge Engine ---
+# --- 一括削除エンジン ---
+# 履歴をページ単位で読みながら条件に合うメッセージを集め、14日以内のものは100件ずつbulk_delete、
+# それより古いもの(bulk_delete不可)は1件ずつ削除するキューへ回して毎秒の件数を絞る。読み込みと削除は並行して進める。
+PURGE_MAX_MESSAGES = int(os.getenv("PURGE_MAX_MESSAGES", "10000"))
+PURGE_MAX_SCANNED = int(os.getenv("PURGE_MAX_SCANNED", "50000")) # user:/contains: で一致が少ないと履歴を延々と読むので、確認件数にも上限を設ける
+PURGE_BULK_DELETE_SIZE = 100 # bulk_deleteの上限
+PURGE_BULK_MAX_AGE = timedelta(days=14, minutes=-5) # 14日ちょうどは境界で弾かれることがあるので余裕を持たせる
+PURGE_OLD_DELETE_RATE_PER_SECOND = float(os.getenv("PURGE_OLD_DELETE_RATE_PER_SECOND", "1.0"))
+PURGE_PROGRESS_INTERVAL_SECONDS = 3.0
+PURGE_RELATIVE_TIME_UNITS = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+active_purges = {} # guild_id -> PurgeJob
+
+def parse_purge_time(text):
+    # "30m" "2h" "7d" "1w" は現在からの相対時間、それ以外はISO形式の日時 (タイムゾーン省略時はUTC)
+    match = re.fullmatch(r"(\d+)([mhdw])", text.strip().lower())
+    if match: return datetime.now(timezone.utc) - timedelta(**{PURGE_RELATIVE_TIME_UNITS[match.group(2)]: int(match.group(1))})
+    value = datetime.fromisoformat(text.strip())
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+class PurgeJob:
+    def __init__(self, channels, limit, author_id=None, contains=None, after=None, before=None):
+        self.channels = channels
+        self.limit = limit
+        self.author_id = author_id
+        self.contains = contains.lower() if contains else None
+        self.after = after
+        self.before = before
+        self.scanned = self.matched = self.deleted = self.failed = 0
+        self.scan_limited = False
+        self.bulk_calls = self.single_calls = 0
+        self.current_channel = None
+        self.progress_message = None
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def matches(self, message):
+        if self.author_id and message.author.id != self.author_id: return False
+        if self.contains and self.contains not in message.content.lower(): return False
+        return True
+
+    def cancel(self): self.cancelled = True
+
+    def elapsed(self): return (self.finished_at or time.monotonic()) - self.started_at
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.deleted / elapsed if elapsed > 0 else 0.0
+
+    def progress_text(self):
+        where = f" <#{self.current_channel.id}>" if self.current_channel else ""
+        return f"🧹 削除中ニャ...{where} {self.deleted}/{self.limit}件 (確認済み {self.scanned}件, {self.rate():.1f}件/秒) `!!nah_stop` で中止できるニャ"
+
+    def summary_text(self):
+        head = "削除を中止したニャ。" if self.cancelled else ""
+        failed = f", 失敗 {self.failed}件" if self.failed else ""
+        limited = f"\n確認したメッセージが上限の{PURGE_MAX_SCANNED}件に達したので、そこで止めたニャ。" if self.scan_limited else ""
+        return f"{head}{self.deleted}件のメッセージを削除したニャ🐈 ({len(self.channels)}チャンネル, {self.elapsed():.1f}秒, {self.rate():.1f}件/秒{failed}){limited}"
+
+    async def run(self):
+        # 古いメッセージの1件削除はチャンネル毎に並行して進め、その間に次のチャンネルの履歴を読む
+        old_workers = []
+        try:
+            for channel in self.channels:
+                if self.cancelled or self.scan_limited or self.matched >= self.limit: break
+                self.current_channel = channel
+                old_queue = asyncio.Queue()
+                old_workers.append(asyncio.create_task(self._delete_old_messages(old_queue), name=f"purge-old-{channel.id}"))
+                try: await self._purge_channel(channel, old_queue)
+                finally: old_queue.put_nowait(None)
+            self.current_channel = None
+            await asyncio.gather(*old_workers)
+        finally:
+            for worker in old_workers: worker.cancel()
+            self.finished_at = time.monotonic()
+            self.current_channel = None
+
+    async def _purge_channel(self, channel, old_queue):
+        pending_bulk, batch = None, []
+        try:
+            async for message in channel.history(limit=None, before=self.before, after=self.after, oldest_first=False):
+                if self.cancelled: break
+                if self.scanned >= PURGE_MAX_SCANNED:
+                    self.scan_limited = True; break
+                self.scanned += 1
+                if not self.matches(message): continue
+                self.matched += 1
+                if message.created_at < discord.utils.utcnow() - PURGE_BULK_MAX_AGE:
+                    old_queue.put_nowait(message)
+                else:
+                    batch.append(message)
+                    if len(batch) >= PURGE_BULK_DELETE_SIZE:
+                        if pending_bulk: await pending_bulk # 同じチャンネルのbulk_deleteは1本ずつ。送信中も次のページを読み進める
+                        pending_bulk = asyncio.create_task(self._bulk_delete(channel, batch)); batch = []
+                if self.matched >= self.limit: break
+        finally:
+            if pending_bulk: await pending_bulk
+        if batch and not self.cancelled: await self._bulk_delete(channel, batch)
+
+    async def _bulk_delete(self, channel, messages):
+        try:
+            await rest_dispatcher.submit(LANE_PURGE, lambda: channel.delete_messages(messages, reason="nahコマンドによる一括削除"), timeout=API_CALL_TIMEOUT)
+            self.bulk_calls += 1
+            self.deleted += len(messages)
+            metrics.inc("nekochan_purge_deleted_total", len(messages), mode="bulk")
+        except (discord.HTTPException, asyncio.TimeoutError) as e:
+            self.failed += len(messages)
+            print_warning(f"一括削除に失敗 ({len(messages)}件): {e!r}", guild_id=channel.guild.id, channel_id=channel.id)
+
+    async def _delete_old_messages(self, old_queue):
+        interval = 1.0 / PURGE_OLD_DELETE_RATE_PER_SECOND
+        while (message := await old_queue.get()) is not None and not self.cancelled:
+            started = time.monotonic()
+            try:
+                await rest_dispatcher.submit(LANE_PURGE, message.delete, timeout=API_CALL_TIMEOUT)
+                self.single_calls += 1
+                self.deleted += 1
+                metrics.inc("nekochan_purge_deleted_total", mode="single")
+            except discord.NotFound: pass # 既に消えている
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                self.failed += 1
+                print_warning(f"古いメッセージの削除に失敗: {e!r}", channel_id=message.channel.id, message_id=message.id)
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+async def report_purge_progress(ctx, job):
+    # 短時間で終わる削除では何も出さず、長引いたら進捗メッセージを出して定期的に書き換える
+    while True:
+        await asyncio.sleep(PURGE_PROGRESS_INTERVAL_SECONDS)
+        text = job.progress_text()
+        try:
+            if job.progress_message is None: job.progress_message = await send_interactive(ctx, text)
+            else: await rest_dispatcher.submit(LANE_INTERACTIVE, lambda text=text: job.progress_message.edit(content=text))
+        except discord.HTTPException as e:
+            print_warning(f"削除の進捗表示に失敗: {e}")
+
+class PurgeFlags(commands.FlagConverter):
+    user: discord.User = None
+    contains: str = None
+    after: str = None
+    before: str = None
 
 # --- Bot Commands ---
-@bot.command(name='nah', help="指定した数のメッセージを削除するニャ。 例: !!nah 5")
+@bot.command(name='nah', help="指定した数のメッセージを削除するニャ。 例: !!nah 5 / !!nah 500 #spam user:@荒らし contains:http after:2h")
 @commands.has_permissions(manage_messages=True)
 @commands.bot_has_permissions(manage_messages=True)
-async def nah_command(ctx, num: int):
-    if num <= 0: await ctx.send("1以上の数を指定してニャ🐈"); return
-    if num > 100: await ctx.send("一度に削除できるのは100件までニャ🐈"); return
+async def nah_command(ctx, num: int, channels: commands.Greedy[discord.TextChannel | discord.VoiceChannel | discord.Thread] = None, *, flags: PurgeFlags):
+    guild = ctx.guild
+    if not guild: return
+    if num <= 0: await send_interactive(ctx, "1以上の数を指定してニャ🐈"); return
+    if num > PURGE_MAX_MESSAGES: await send_interactive(ctx, f"一度に削除できるのは{PURGE_MAX_MESSAGES}件までニャ🐈"); return
+    if guild.id in active_purges: await send_interactive(ctx, "このサーバーでは削除を実行中ニャ。`!!nah_stop` で中止できるニャ", delete_after=5); return
+    if flags.contains and not bot.intents.message_content:
+        # message_contentインテントが無いと履歴の本文も空で返るので、何も一致しないまま「0件削除」になってしまう
+        await send_interactive(ctx, "省メモリモード中はメッセージ本文が読めないので `contains:` は使えないニャ😿"); return
+    channels = list(dict.fromkeys(channels or [ctx.channel]))
+    for channel in channels:
+        author_perms, bot_perms = channel.permissions_for(ctx.author), channel.permissions_for(guild.me)
+        if not author_perms.manage_messages or not bot_perms.manage_messages or not bot_perms.read_message_history:
+            await send_interactive(ctx, f"<#{channel.id}> でメッセージを削除する権限が足りないニャ😿"); return
     try:
-        deleted_messages = await ctx.channel.purge(limit=num + 1)
-        response_msg = await ctx.send(f"{len(deleted_messages) -1}件のメッセージを削除したニャ🐈")
-        await asyncio.sleep(5); await response_msg.delete()
+        after = parse_purge_time(flags.after) if flags.after else None
+        before = parse_purge_time(flags.before) if flags.before else None
+    except ValueError:
+        await send_interactive(ctx, "時間の指定がおかしいニャ。例: `after:2h` `before:2024-01-31`"); return
+
+    # コマンド以降のメッセージ(進捗表示を含む)は対象にしない
+    job = PurgeJob(channels, num, author_id=flags.user.id if flags.user else None, contains=flags.contains, after=after, before=before or discord.Object(id=ctx.message.id))
+    active_purges[guild.id] = job
+    reporter = asyncio.create_task(report_purge_progress(ctx, job), name=f"purge-progress-{guild.id}")
+    try:
+        try: await rest_dispatcher.submit(LANE_INTERACTIVE, ctx.message.delete)
+        except discord.HTTPException: pass
+        await job.run()
     except Exception as e:
-        print_error(f"nahコマンドエラー: {e}", exc_info=True)
+        print_error(f"nahコマンドエラー: {e}", exc_info=True, guild_id=guild.id)
+    finally:
+        reporter.cancel()
+        active_purges.pop(guild.id, None)
+    print_info(f"一括削除: {job.summary_text()}", guild_id=guild.id, scanned=job.scanned, scan_limited=job.scan_limited, bulk_calls=job.bulk_calls, single_calls=job.single_calls)
+    try:
+        if job.progress_message:
+            await rest_dispatcher.submit(LANE_INTERACTIVE, lambda: job.progress_message.edit(content=job.summary_text(), delete_after=10))
+        else:
+            await send_interactive(ctx, job.summary_text(), delete_after=5)
+    except discord.HTTPException as e:
+        print_warning(f"削除結果の表示に失敗: {e}", guild_id=guild.id)
 
 @nah_command.error
 async def nah_command_error(ctx, error):
     if isinstance(error, (commands.MissingPermissions, commands.BotMissingPermissions)):
         print_error(f"nah_commandで権限エラー: {error}")
         return
-    elif isinstance(error, commands.BadArgument):
-        await ctx.send("数の指定がおかしいニャ。例: `!!nah 5`")
+    elif isinstance(error, (commands.BadArgument, commands.MissingRequiredArgument)):
+        await send_interactive(ctx, "指定がおかしいニャ。例: `!!nah 5` / `!!nah 500 #spam user:@荒らし contains:http after:2h`")
     else:
         print_error(f"nah_command 未処理エラー: {error}", exc_info=True)
-        await ctx.send("コマンド実行中に予期せぬエラー発生ニャ。")
+        await send_interactive(ctx, "コマンド実行中に予期せぬエラー発生ニャ。")
+
+@bot.command(name='nah_stop', help="実行中の!!nahによる削除を中止するニャ。")
+@commands.has_permissions(manage_messages=True)
+async def nah_stop_command(ctx):
+    job = active_purges.get(ctx.guild.id) if ctx.guild else None
+    if not job: await send_interactive(ctx, "実行中の削除は無いニャ。", delete_after=5); return
+    job.cancel()
+    await send_interactive(ctx, "削除を中止するニャ...", delete_after=5)
 
 @bot.command(name='nah_vc', help="指定VCの人数表示用チャンネルを作成/削除するニャ。")
 @commands.has_permissions(manage_channels=True)
 @commands.bot_has_permissions(manage_channels=True)
 async def nah_vc_command(ctx, *, channel_id_or_name: str):
-    guild = ctx.guild
-    if not guild: return
-    target_vc = None
-    try: vc_id = int(channel_id_or_name); target_vc = guild.get_channel(vc_id)
-    except ValueError:
-        for vc_iter in guild.voice_channels:
-            if vc_iter.name.lower() == channel_id_or_name.lower(): target_vc = vc_iter; break
-        if not target_vc:
-            for vc_iter in guild.voice_channels:
-                if channel_id_or_name.lower() in vc_iter.name.lower(): target_vc = vc_iter; break
-    if not target_vc or not isinstance(target_vc, discord.VoiceChannel) or (target_vc.category and STATUS_CATEGORY_NAME.lower() in target_vc.category.name.lower()):
-        await ctx.send(f"「{channel_id_or_name}」は有効なボイスチャンネルとして見つからなかったニャ😿"); return
+    if not ctx.guild: return
+    await toggle_vc_tracking(ctx.guild, channel_id_or_name, ctx)
+
+async def toggle_vc_tracking(guild, channel_id_or_name, ctx):
+    try: target_vc = guild.get_channel(int(channel_id_or_name))
+    except ValueError: target_vc = channel_index.find_voice_channel(guild, channel_id_or_name)
+    original_id = channel_index.original_for_status(target_vc.id) if target_vc else None
+    if original_id in vc_tracking: # 人数表示用VCを指定されたら元VCの追跡を停止する (元VCが削除済みでも止められる)
+        await unregister_vc_tracking(original_id, guild, send_feedback_to_ctx=ctx); return
+    if not target_vc or not isinstance(target_vc, discord.VoiceChannel) or is_in_status_category(target_vc):
+        await send_interactive(ctx, f"「{channel_id_or_name}」は有効なボイスチャンネルとして見つからなかったニャ😿"); return
     
     if target_vc.id in vc_tracking:
         await unregister_vc_tracking(target_vc.id, guild, send_feedback_to_ctx=ctx)
@@ -427,17 +2842,19 @@ async def nah_vc_command_error(ctx, error):
         print_error(f"nah_vc_commandで権限エラー: {error}")
         return
     elif isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send("どのボイスチャンネルか指定してニャ！ 例: `!!nah_vc General`")
+        await send_interactive(ctx, "どのボイスチャンネルか指定してニャ！ 例: `!!nah_vc General`")
     else:
         print_error(f"nah_vc_command 未処理エラー: {error}", exc_info=True)
-        await ctx.send("コマンド実行中に予期せぬエラー発生ニャ。")
+        await send_interactive(ctx, "コマンド実行中に予期せぬエラー発生ニャ。")
 
 @bot.command(name='nah_sum', help="サーバー全体のVC接続人数を集計する鍵付きVCを作成/削除するニャ。")
 @commands.has_permissions(manage_channels=True)
 @commands.bot_has_permissions(manage_channels=True)
 async def nah_sum_command(ctx):
-    guild = ctx.guild
-    if not guild: return
+    if not ctx.guild: return
+    await toggle_summary_vc(ctx.guild, ctx)
+
+async def toggle_summary_vc(guild, ctx):
     guild_id = guild.id
     now = datetime.now(timezone.utc)
 
@@ -455,29 +2872,28 @@ async def nah_sum_command(ctx):
     try:
         existing_summary_vc_id = summary_vc_tracking.get(guild_id)
         if existing_summary_vc_id:
-            await ctx.send("集計用チャンネルを削除しますニャ...", delete_after=5)
+            await send_interactive(ctx, "集計用チャンネルを削除しますニャ...", delete_after=5)
+            await forget_summary_vc(guild_id)
             summary_vc = guild.get_channel(existing_summary_vc_id)
             if summary_vc:
-                await summary_vc.delete(reason="nah_sumコマンドによる削除")
-            summary_vc_tracking.pop(guild_id, None)
-            await remove_summary_vc_from_db(guild_id)
-            await ctx.send("サーバー全体の人数集計用チャンネルを削除したニャ。", delete_after=5)
+                await run_channel_admin(lambda: summary_vc.delete(reason="nah_sumコマンドによる削除"))
+            await send_interactive(ctx, "サーバー全体の人数集計用チャンネルを削除したニャ。", delete_after=5)
         else:
-            await ctx.send("集計用チャンネルを作成しますニャ...", delete_after=5)
+            await send_interactive(ctx, "集計用チャンネルを作成しますニャ...", delete_after=5)
             status_category = await get_or_create_status_category(guild)
             if not status_category:
-                await ctx.send("STATUSカテゴリの作成/取得に失敗しましたニャ😿", delete_after=10)
+                await send_interactive(ctx, "STATUSカテゴリの作成/取得に失敗しましたニャ😿", delete_after=10)
                 return
             initial_name = "Study/Work：集計中... users"
             overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=False)}
-            new_summary_vc = await guild.create_voice_channel(name=initial_name, category=status_category, overwrites=overwrites)
+            new_summary_vc = await run_channel_admin(lambda: guild.create_voice_channel(name=initial_name, category=status_category, overwrites=overwrites))
             summary_vc_tracking[guild_id] = new_summary_vc.id
             await save_summary_vc_to_db(guild_id, new_summary_vc.id)
             asyncio.create_task(update_summary_vc_name(guild))
-            await ctx.send("サーバー全体の人数集計用チャンネルを作成したニャ！", delete_after=5)
+            await send_interactive(ctx, "サーバー全体の人数集計用チャンネルを作成したニャ！", delete_after=5)
     except Exception as e:
         print_error(f"nah_sumコマンドエラー: {e}", exc_info=True)
-        await ctx.send("コマンドの実行中にエラーが発生しましたニャ😿", delete_after=10)
+        await send_interactive(ctx, "コマンドの実行中にエラーが発生しましたニャ😿", delete_after=10)
     finally:
         summary_vc_processing_flags.pop(guild_id, None)
 
@@ -488,19 +2904,195 @@ async def nah_sum_command_error(ctx, error):
         return
     else:
         print_error(f"nah_sum_command 未処理エラー: {error}", exc_info=True)
-        await ctx.send("コマンド実行中に予期せぬエラーが発生しましたニャ。")
+        await send_interactive(ctx, "コマンド実行中に予期せぬエラーが発生しましたニャ。")
+
+HISTORY_STATS_WINDOWS = (("直近1時間", 3600), ("直近24時間", 86400), ("直近7日間", 7 * 86400), ("直近30日間", 30 * 86400))
+HISTORY_STATS_MAX_CHANNELS = 10
+
+def format_history_stats(key):
+    lines = []
+    for label, window in HISTORY_STATS_WINDOWS:
+        peak, average = occupancy_history.summarize(key, window)
+        lines.append(f"　{label}: 最大 {peak}人 / 平均 {average:.1f}人")
+    empty_since = vc_zero_stats.get(key)
+    if empty_since and time.time() - empty_since >= ZERO_USER_TIMEOUT_DURATION.total_seconds():
+        lines.append(f"　<t:{empty_since}:R> から0人ニャ")
+    return "\n".join(lines)
+
+@bot.command(name='nah_stats', help="VCの人数の履歴(最大/平均)を表示するニャ。 例: !!nah_stats / !!nah_stats General")
+async def nah_stats_command(ctx, *, channel_id_or_name: str = None):
+    guild = ctx.guild
+    if not guild: return
+    if channel_id_or_name:
+        try: target_vc = guild.get_channel(int(channel_id_or_name))
+        except ValueError: target_vc = channel_index.find_voice_channel(guild, channel_id_or_name)
+        if not target_vc or ("vc", target_vc.id) not in occupancy_history.series:
+            await send_interactive(ctx, f"「{channel_id_or_name}」の記録は無いニャ。`!!nah_vc` で追跡中のVCだけ記録するニャ😿"); return
+        await send_interactive(ctx, f"📊 **「{target_vc.name}」の人数の記録だニャ**\n{format_history_stats(('vc', target_vc.id))}"); return
+    sections = []
+    if ("guild", guild.id) in occupancy_history.series:
+        sections.append(f"📊 **サーバー全体の人数の記録だニャ**\n{format_history_stats(('guild', guild.id))}")
+    tracked = [(cid, info) for cid, info in vc_tracking.items() if info["guild_id"] == guild.id and ("vc", cid) in occupancy_history.series]
+    for cid, info in tracked[:HISTORY_STATS_MAX_CHANNELS]:
+        vc = guild.get_channel(cid)
+        sections.append(f"🔹 **{vc.name if vc else info['original_channel_name']}**\n{format_history_stats(('vc', cid))}")
+    if not sections:
+        await send_interactive(ctx, "まだ記録が無いニャ。`!!nah_vc` や `!!nah_sum` で追跡中のVCだけ記録するニャ🐈"); return
+    await send_interactive(ctx, "\n\n".join(sections)[:2000])
+
+group_processing_flags = {}
+
+def describe_group(guild, definition):
+    kind, target = definition["kind"], definition["target"]
+    if kind == "category":
+        category = guild.get_channel(target)
+        return f"カテゴリ「{category.name if category else target}」"
+    if kind == "pattern": return f"名前が `{target}` に一致するVC"
+    if kind == "channels": return "VC " + ", ".join(f"<#{cid}>" for cid in target)
+    return "すべてのVC"
+
+async def create_group(ctx, kind, target, label):
+    guild = ctx.guild
+    if group_processing_flags.get(guild.id): return
+    group_processing_flags[guild.id] = True
+    try:
+        existing = [d for d in group_vc_tracking.values() if d["guild_id"] == guild.id]
+        if len(existing) >= GROUP_MAX_PER_GUILD:
+            await send_interactive(ctx, f"集計グループは1サーバー{GROUP_MAX_PER_GUILD}個までニャ😿"); return
+        if any(d["kind"] == kind and d["target"] == target for d in existing):
+            await send_interactive(ctx, "同じ集計グループがもうあるニャ。`!!nah_group list` で確認してニャ"); return
+        status_category = await get_or_create_status_category(guild)
+        if not status_category:
+            await send_interactive(ctx, "STATUSカテゴリの作成/取得に失敗しましたニャ😿"); return
+        overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=True, connect=False)}
+        group_vc = await run_channel_admin(lambda: guild.create_voice_channel(name=f"{label[:65]}：集計中... users", category=status_category, overwrites=overwrites))
+        definition = {"guild_id": guild.id, "kind": kind, "target": target, "label": label[:65]}
+        group_vc_tracking[group_vc.id] = definition
+        group_aggregator.reload_definitions()
+        await save_group_vc_to_db(group_vc.id, definition)
+        asyncio.create_task(update_group_vc_names(guild, [group_vc.id]))
+        await send_interactive(ctx, f"{describe_group(guild, definition)}の人数を集計するチャンネルを作成したニャ！")
+    except Exception as e:
+        print_error(f"集計グループ作成エラー: {e}", exc_info=True, guild_id=guild.id)
+        await send_interactive(ctx, "集計グループの作成中にエラーが発生しましたニャ😿")
+    finally:
+        group_processing_flags.pop(guild.id, None)
+
+# invoke_without_command=True だとサブコマンド実行時にグループ側のチェックが飛ばされるので付けない (チェックは全サブコマンドに効く)。
+@bot.group(name='nah_group', help="カテゴリ・名前のパターン・指定VC・全体の単位で人数を集計するVCを作成/削除するニャ。")
+@commands.guild_only()
+@commands.has_permissions(manage_channels=True)
+@commands.bot_has_permissions(manage_channels=True)
+async def nah_group_command(ctx):
+    if ctx.invoked_subcommand is None: await nah_group_list(ctx)
+
+@nah_group_command.command(name='list', help="集計グループの一覧を表示するニャ。")
+async def nah_group_list(ctx):
+    groups = [(gid, d) for gid, d in group_vc_tracking.items() if d["guild_id"] == ctx.guild.id]
+    if not groups:
+        await send_interactive(ctx, "集計グループはまだ無いニャ。例: `!!nah_group category ゲーム` `!!nah_group pattern ^作業` `!!nah_group channels #VC1 #VC2` `!!nah_group all`"); return
+    lines = [f"🔹 <#{gid}>: {describe_group(ctx.guild, d)} (現在 {group_aggregator.group_total(ctx.guild, gid)}人)" for gid, d in groups]
+    await send_interactive(ctx, "📊 **集計グループ一覧だニャ**\n" + "\n".join(lines))
+
+@nah_group_command.command(name='category', help="カテゴリ内のVCの合計人数を集計するニャ。 例: !!nah_group category ゲーム")
+async def nah_group_category(ctx, *, category: discord.CategoryChannel):
+    if category.id in channel_index.status_category_ids(ctx.guild):
+        await send_interactive(ctx, "STATUSカテゴリは集計できないニャ😿"); return
+    await create_group(ctx, "category", category.id, category.name)
+
+@nah_group_command.command(name='pattern', help="名前が正規表現に一致するVCの合計人数を集計するニャ。 例: !!nah_group pattern ^作業")
+async def nah_group_pattern(ctx, *, pattern: str):
+    try: validate_group_pattern(pattern)
+    except ValueError as e:
+        await send_interactive(ctx, f"正規表現がおかしいニャ: {e}"); return
+    await create_group(ctx, "pattern", pattern, pattern)
+
+@nah_group_command.command(name='channels', help="指定したVCの合計人数を集計するニャ。 例: !!nah_group channels #VC1 #VC2")
+async def nah_group_channels(ctx, channels: commands.Greedy[discord.VoiceChannel]):
+    channels = [c for c in dict.fromkeys(channels) if not is_in_status_category(c)]
+    if not channels:
+        await send_interactive(ctx, "集計するVCを指定してニャ！ 例: `!!nah_group channels #VC1 #VC2`"); return
+    await create_group(ctx, "channels", sorted(c.id for c in channels), " + ".join(c.name for c in channels))
+
+@nah_group_command.command(name='all', help="すべてのVCの合計人数を集計するニャ。")
+async def nah_group_all(ctx):
+    await create_group(ctx, "all", None, "All VC")
+
+@nah_group_command.command(name='remove', help="集計グループとその表示用VCを削除するニャ。 例: !!nah_group remove 123456789012345678")
+async def nah_group_remove(ctx, *, channel_id_or_name: str):
+    guild = ctx.guild
+    try: group_vc_id = int(channel_id_or_name.strip("<#>"))
+    except ValueError:
+        group_vc = channel_index.find_voice_channel(guild, channel_id_or_name)
+        group_vc_id = group_vc.id if group_vc else None
+    definition = group_vc_tracking.get(group_vc_id)
+    if not definition or definition["guild_id"] != guild.id:
+        await send_interactive(ctx, f"「{channel_id_or_name}」は集計グループとして見つからなかったニャ😿"); return
+    try:
+        group_vc = guild.get_channel(group_vc_id)
+        await remove_group(group_vc_id)
+        if group_vc: await run_channel_admin(lambda: group_vc.delete(reason="nah_groupコマンドによる削除"))
+        await send_interactive(ctx, f"{describe_group(guild, definition)}の集計チャンネルを削除したニャ。")
+    except Exception as e:
+        print_error(f"集計グループ削除エラー: {e}", exc_info=True, guild_id=guild.id)
+        await send_interactive(ctx, "集計グループの削除中にエラーが発生しましたニャ😿")
+
+async def nah_group_command_error(ctx, error):
+    if isinstance(error, (commands.MissingPermissions, commands.BotMissingPermissions, commands.NoPrivateMessage)):
+        print_error(f"nah_group_commandで権限エラー: {error}")
+        return
+    elif isinstance(error, (commands.BadArgument, commands.MissingRequiredArgument)):
+        await send_interactive(ctx, "指定がおかしいニャ。例: `!!nah_group category ゲーム` `!!nah_group pattern ^作業` `!!nah_group channels #VC1 #VC2` `!!nah_group remove [集計VCのID]`")
+    else:
+        print_error(f"nah_group_command 未処理エラー: {error}", exc_info=True)
+        await send_interactive(ctx, "コマンド実行中に予期せぬエラー発生ニャ。")
+
+for _group_subcommand in (nah_group_command, *nah_group_command.commands): _group_subcommand.error(nah_group_command_error)
+
+@bot.command(name='nah_prof', hidden=True, help="(オーナー専用) プロファイリングの切り替えと結果表示。 例: !!nah_prof on / !!nah_prof dump 30")
+@commands.is_owner()
+async def nah_prof_command(ctx, action: str = "status", seconds: int = 30):
+    action = action.lower()
+    if action == "on":
+        runtime_profiler.enable(); await send_interactive(ctx, "プロファイリングを有効にしたニャ。`!!nah_prof` で結果を見られるニャ🔧")
+    elif action == "off":
+        runtime_profiler.disable(); await send_interactive(ctx, "プロファイリングを無効にしたニャ。")
+    elif action == "dump":
+        if runtime_profiler.sampler:
+            await send_interactive(ctx, "もうサンプリング中ニャ。終わるまで待ってニャ"); return
+        seconds = max(1, min(seconds, PROFILE_DUMP_MAX_SECONDS))
+        await send_interactive(ctx, f"{seconds}秒間スタックをサンプリングするニャ…")
+        path, samples = await runtime_profiler.capture(seconds)
+        await send_interactive(ctx, f"サンプル {samples}件を `{path}` に保存したニャ。")
+    else:
+        await send_interactive(ctx, runtime_profiler.status_text()[:2000])
+
+@nah_prof_command.error
+async def nah_prof_command_error(ctx, error):
+    if isinstance(error, commands.NotOwner):
+        print_warning(f"nah_prof_commandをオーナー以外が実行: {ctx.author}")
+    elif isinstance(error, commands.BadArgument):
+        await send_interactive(ctx, "指定がおかしいニャ。例: `!!nah_prof on` `!!nah_prof off` `!!nah_prof dump 30`")
+    else:
+        print_error(f"nah_prof_command 未処理エラー: {error}", exc_info=True)
+        await send_interactive(ctx, "コマンド実行中に予期せぬエラー発生ニャ。")
 
 @bot.command(name='nah_help', help="コマンド一覧を表示するニャ。")
-async def nah_help_prefix(ctx): await ctx.send(HELP_TEXT_CONTENT)
+async def nah_help_prefix(ctx): await send_interactive(ctx, HELP_TEXT_CONTENT)
 
 # --- Main Bot Execution ---
 async def start_bot_main():
     if not DISCORD_TOKEN:
         print_error("DISCORD_TOKEN未設定。Bot起動不可。")
         return
-    if os.getenv("RENDER"): keep_alive()
     async with bot:
-        await bot.start(DISCORD_TOKEN)
+        try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close())) # 再デプロイ時もリースを手放し、書き込みを流してから終わる
+        except NotImplementedError: pass
+        runner = await start_keep_alive_server() if os.getenv("RENDER") or os.getenv("HTTP_SERVER_ENABLED", "false").lower() == "true" else None
+        try:
+            await bot.start(DISCORD_TOKEN)
+        finally:
+            if runner: await runner.cleanup()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,113 @@
+# FirestoreWriteBehind を benchmarks/harness.py の偽Firestoreで確かめるテスト。
+#   python -m pytest -q tests
+import asyncio
+import os
+import sys
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import harness
+import nekochanbot2 as nb
+
+
+class FailingFirestore(harness.FakeFirestore):
+    # 最初のfailures回のコミットを失敗させる
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+        async def failing_commit():
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("commit failed")
+            await commit()
+        batch.commit = failing_commit
+        return batch
+
+
+def test_close_during_inflight_commit_keeps_writes():
+    async def scenario():
+        db = harness.FakeFirestore(latency=0.5)
+        writer = nb.FirestoreWriteBehind(lambda: db)
+        for i in range(3): writer.set("c", i, {"v": i})
+        writer.wakeup.set()
+        await asyncio.sleep(0.1) # フラッシャーがコミットの途中
+        await writer.close()
+        return db
+    db = asyncio.run(scenario())
+    assert db.collections["c"] == {str(i): {"v": i} for i in range(3)}
+
+
+def test_coalesces_per_document_and_batches():
+    async def scenario():
+        db = harness.FakeFirestore()
+        writer = nb.FirestoreWriteBehind(lambda: db)
+        for i in range(nb.FIRESTORE_BATCH_MAX_OPS + 10): writer.set("c", i, {"v": 0})
+        writer.set("c", 1, {"v": 1}) # 最後の操作が優先
+        writer.delete("c", 2)
+        await writer.flush()
+        return db
+    db = asyncio.run(scenario())
+    assert db.commits == 2
+    assert db.collections["c"]["1"] == {"v": 1}
+    assert "2" not in db.collections["c"]
+    assert len(db.collections["c"]) == nb.FIRESTORE_BATCH_MAX_OPS + 9
+
+
+def test_failed_commit_is_retried_without_losing_newer_writes():
+    async def scenario():
+        db = FailingFirestore(failures=1)
+        writer = nb.FirestoreWriteBehind(lambda: db)
+        writer.set("c", 1, {"v": "old"})
+        assert not await writer.flush()
+        writer.set("c", 1, {"v": "new"}) # 失敗中に積まれた新しい値を優先
+        assert await writer.flush()
+        return db, writer
+    db, writer = asyncio.run(scenario())
+    assert db.collections["c"] == {"1": {"v": "new"}}
+    assert not writer.pending and writer.consecutive_failures == 0
+
+
+def test_writes_are_kept_until_connect_succeeds():
+    async def scenario():
+        state = {"db": None, "attempts": 0}
+        async def connect():
+            state["attempts"] += 1
+            if state["attempts"] < 3: return False # 起動直後はFirestoreに繋がらない
+            state["db"] = harness.FakeFirestore(); return True
+        writer = nb.FirestoreWriteBehind(lambda: state["db"], connect=connect)
+        writer.set("c", 1, {"v": 1})
+        assert not await writer.flush()
+        assert not await writer.flush()
+        assert writer.has_pending("c", 1)
+        assert await writer.flush()
+        return state["db"], writer
+    db, writer = asyncio.run(scenario())
+    assert db.collections["c"] == {"1": {"v": 1}}
+    assert not writer.pending
+
+
+def test_unsent_tracking_writes_survive_the_snapshot(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    entry = {"guild_id": 1, "status_channel_id": 20, "original_channel_name": "VC"}
+    pending = {(nb.FIRESTORE_COLLECTION_NAME, "10"): entry, (nb.SUMMARY_FIRESTORE_COLLECTION_NAME, "1"): None}
+    nb._write_state_snapshot(path, {10: entry}, {}, {}, pending)
+    vc_entries, _, _, pending_writes = nb._read_state_snapshot(path)
+    assert vc_entries == {10: entry}
+    assert pending_writes == pending
+
+
+def test_reconcile_keeps_entries_whose_writes_are_still_pending():
+    nb.firestore_writer.pending[(nb.FIRESTORE_COLLECTION_NAME, "10")] = {} # Firestore停止中に追加した分
+    try:
+        target = {10: {"guild_id": 1}, 11: {"guild_id": 1}}
+        diff = nb._apply_tracking_diff(target, {}, nb.FIRESTORE_COLLECTION_NAME, nb.vc_rename_scheduler)
+    finally:
+        nb.firestore_writer.pending.clear()
+    assert list(target) == [10]
+    assert diff == (0, 0, 1)
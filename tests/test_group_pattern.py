@@ -0,0 +1,42 @@
+# 集計グループのパターン検査と nah_group の権限チェックのテスト。
+#   python -m pytest -q tests
+import os
+import re
+import time
+
+import pytest
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+
+import nekochanbot2 as nb
+
+
+@pytest.mark.parametrize("pattern", ["^作業", "ゲーム|雑談", r"^VC\d+$", "(?:作業|勉強)部屋", "a{1,5}b+", "(ゲーム|雑談)?部屋", "^.*作業", r"[\]*]+x"])
+def test_simple_patterns_are_accepted(pattern):
+    assert nb.validate_group_pattern(pattern) == pattern
+
+
+@pytest.mark.parametrize("pattern", ["(a+)+$", "(a*)*", "(a|aa)*", "(?:x+y?)+", r"(a)\1", "(?P<n>a)(?P=n)", "[", "a" * (nb.GROUP_PATTERN_MAX_LENGTH + 1),
+                                     "a*a*a*a*a*a*a*a*a*a*c", ".*a.*", "(a?){30}a{30}", "a?" * 11 + "c"])
+def test_dangerous_or_broken_patterns_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        nb.validate_group_pattern(pattern)
+
+
+def test_accepted_patterns_stay_fast_on_long_names():
+    started = time.perf_counter()
+    for pattern in ["(a|a)(a|a)(a|a)a*c", "a?a?a?a?a?a?a?a?a?aaaaaaaaac", "a*[ab]?[ab]?[ab]?c"]:
+        compiled = re.compile(nb.validate_group_pattern(pattern), re.IGNORECASE)
+        for name in ("a" * nb.CHANNEL_NAME_MAX_LENGTH, "a" * 50 + "b" * 50): compiled.search(name)
+    assert time.perf_counter() - started < 1.0
+
+
+def test_stored_bad_pattern_is_not_loaded():
+    with pytest.raises(ValueError):
+        nb.parse_group_definition({"guild_id": "1", "kind": "pattern", "target": "(a+)+", "label": "x"})
+
+
+def test_group_checks_run_for_subcommands():
+    assert not nb.nah_group_command.invoke_without_command
+    assert len(nb.nah_group_command.checks) == 3
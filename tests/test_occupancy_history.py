@@ -0,0 +1,29 @@
+# 人数履歴のリングバッファ集計のテスト。
+#   python -m pytest -q tests
+import os
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+
+import nekochanbot2 as nb
+
+DAY = 86400
+
+
+def test_window_equal_to_ring_span_keeps_the_oldest_bucket():
+    now = 1_700_000_000 // 3600 * 3600
+    series = nb.OccupancySeries(now - 2 * DAY)
+    series.record(now - DAY, 4) # 24時間前ちょうどから30分間4人
+    series.record(now - DAY + 1800, 0)
+    peak, average = series.summarize(now, DAY)
+    assert peak == 4
+    assert abs(average - 4 * 1800 / DAY) < 1e-9
+
+
+def test_short_window_uses_the_fine_ring():
+    now = 1_700_000_000 // 300 * 300
+    series = nb.OccupancySeries(now - DAY)
+    series.record(now - 600, 2)
+    peak, average = series.summarize(now, 3600)
+    assert peak == 2
+    assert abs(average - 2 * 600 / 3600) < 1e-9
@@ -0,0 +1,29 @@
+# 一括削除エンジン (PurgeJob) を benchmarks/harness.py の偽チャンネルで確かめるテスト。
+#   python -m pytest -q tests
+import asyncio
+import datetime
+import os
+import sys
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+import harness
+import nekochanbot2 as nb
+
+
+def test_filtered_purge_stops_at_the_scan_cap(monkeypatch):
+    monkeypatch.setattr(nb, "PURGE_MAX_SCANNED", 300)
+    async def scenario():
+        guild = harness.FakeGuild(1 << 22, harness.FakeHTTP())
+        channel = guild.add_text_channel("general")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for i in range(1000): channel.add_message(now - datetime.timedelta(seconds=i), 2, "hello") # 一致するメッセージが無い
+        job = nb.PurgeJob([channel], 10, author_id=1)
+        await job.run()
+        return job
+    job = asyncio.run(scenario())
+    assert job.scanned == 300
+    assert job.scan_limited and job.deleted == 0
+    assert "300件" in job.summary_text()
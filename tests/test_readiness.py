@@ -0,0 +1,33 @@
+# /readyz のゲートウェイ接続判定と discord.http の警告の扱いのテスト。
+#   python -m pytest -q tests
+import logging
+import os
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+
+import nekochanbot2 as nb
+
+
+def test_gateway_disconnect_is_not_ready_even_though_discord_py_stays_ready(monkeypatch):
+    monkeypatch.setattr(nb.bot, "is_ready", lambda: True) # discord.pyは切断中もis_ready()がTrueのまま
+    monkeypatch.setattr(nb, "gateway_connected_shards", set())
+    key = 0 if nb.SHARDED_MODE else None
+    if nb.SHARDED_MODE: monkeypatch.setattr(type(nb.bot), "shards", property(lambda self: {0: None}))
+    nb.set_gateway_connected(key, True)
+    assert nb.gateway_connected()
+    nb.set_gateway_connected(key, False)
+    assert not nb.gateway_connected()
+    nb.set_gateway_connected(key, True) # 再開
+    assert nb.gateway_connected()
+
+
+def test_discord_http_warnings_are_counted_and_still_logged(monkeypatch):
+    logged = []
+    monkeypatch.setattr(nb, "print_warning", lambda message, *args, **fields: logged.append(message % args))
+    before = nb.metrics.counters.get(("nekochan_discord_429_total", (("source", "discord.py"),)), 0)
+    logging.getLogger("discord.http").warning("We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.", "PATCH", "/x", 1.5)
+    logging.getLogger("discord.http").warning("Global rate limit has been hit. Retrying in %.2f seconds.", 2.0)
+    assert logged == ["discord.http: We are being rate limited. PATCH /x responded with 429. Retrying in 1.50 seconds.",
+                      "discord.http: Global rate limit has been hit. Retrying in 2.00 seconds."]
+    assert nb.metrics.counters.get(("nekochan_discord_429_total", (("source", "discord.py"),)), 0) == before + 1
@@ -0,0 +1,38 @@
+# RestDispatcher の同時実行枠の配分を確かめるテスト。
+#   python -m pytest -q tests
+import asyncio
+import os
+import time
+
+os.environ.setdefault("LOG_LEVEL_PRINT", "ERROR")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", "")
+
+import nekochanbot2 as nb
+
+
+def test_background_lanes_share_one_cap_and_leave_room_for_interactive():
+    async def scenario():
+        dispatcher = nb.RestDispatcher()
+        slow = lambda: asyncio.sleep(1.0)
+        background = [asyncio.create_task(dispatcher.submit(lane, slow)) for lane in (nb.LANE_RENAME,) * 5 + (nb.LANE_PURGE,) * 3]
+        await asyncio.sleep(0.05)
+        in_flight = dispatcher.background_in_flight
+        started = time.monotonic()
+        await dispatcher.submit(nb.LANE_INTERACTIVE, lambda: asyncio.sleep(0))
+        waited = time.monotonic() - started
+        for task in background: task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        return in_flight, waited
+    in_flight, waited = asyncio.run(scenario())
+    assert in_flight == nb.REST_BACKGROUND_MAX_IN_FLIGHT
+    assert waited < 0.5
+
+
+def test_timeout_releases_the_slot():
+    async def scenario():
+        dispatcher = nb.RestDispatcher()
+        try: await dispatcher.submit(nb.LANE_PURGE, lambda: asyncio.sleep(10), timeout=0.05)
+        except asyncio.TimeoutError: pass
+        await asyncio.sleep(0)
+        return dispatcher.background_in_flight, dispatcher.in_flight
+    assert asyncio.run(scenario()) == (0, 0)